@@ -0,0 +1,492 @@
+"""
+bench_sp_tree.py - sp_tree_json_std_lib.py のベンチマークハーネス
+
+決定的(シード固定)な合成リポジトリを生成し、ダンプ処理の各フェーズ
+(walk, read, summarize, tag, idf, index, search, build_tree, serialize, token_count) の
+所要時間を「コールド(キャッシュなし)」「ウォーム(キャッシュあり)」で計測して JSON で出力します。
+出力した JSON 同士を比較すれば、コミット間の性能劣化を検出できます。
+
+## 合成リポジトリの内容
+- 言語混在: .py / .js / .ts / .go / .rs / .java / .c / .h / .md / .json / .yaml / .txt
+- 深さ 1〜7 のネストしたディレクトリ構成
+- 巨大ファイル (一部は --max-preview-size-mb の上限超え) とバイナリファイル (.png / .bin)
+- 同じシード・同じ規模なら常に同一内容 (生成済みなら再利用)
+
+## 使い方
+    # 1k / 10k / 100k ファイルの全規模を計測して保存
+    $ python bench_sp_tree.py -o bench_before.json
+
+    # 1k と 10k だけ、ウォームは3回計測の中央値
+    $ python bench_sp_tree.py --sizes 1k 10k --repeat 3 -o bench_after.json
+
+    # 2つの結果を比較 (10% 以上遅くなったフェーズを REGRESSION として表示)
+    $ python bench_sp_tree.py --compare bench_before.json bench_after.json
+
+    # ディレクトリ走査だけを計測 (逐次の os.walk と並列走査 --walk-threads の比較)
+    # scandir 1回あたり 2ms の往復遅延を加えて NFS/SMB を模擬する
+    $ python bench_sp_tree.py --walk --walk-latency-ms 2
+
+    # キャッシュ・マニフェストの正しさを検証 (ディレクトリの mtime を変えずにファイルを書き換え、
+    # 次の実行と --since がその変更を拾うことを確認。失敗時は終了コード 1)
+    $ python bench_sp_tree.py --verify
+
+## オプション一覧
+  --sizes SIZE...      計測する規模 (1k, 10k, 100k / 数値指定も可) (デフォルト: 1k 10k 100k)
+  --scenarios NAME...  計測シナリオ: full (全文JSON出力) / search (BM25検索 + 要約テキスト出力)
+  --repeat N           ウォーム計測の繰り返し回数 (中央値を採用, デフォルト: 1)
+  --seed N             合成リポジトリの乱数シード (デフォルト: 42)
+  --workdir DIR        合成リポジトリの生成先 (デフォルト: 一時ディレクトリ/sp_tree_bench)
+  -o, --output FILE    結果JSONの保存先 (未指定時は標準出力)
+  --compare BASE NEW   2つの結果JSONを比較して表示する
+  --threshold FLOAT    比較時に劣化とみなす増加率 (デフォルト: 0.10)
+  --walk               ディレクトリ走査のみを合成の深いツリーで計測する (出力順が逐次走査と一致することも検証)
+  --walk-depth N       --walk の合成ツリーの深さ (デフォルト: 6)
+  --walk-fanout N      --walk の合成ツリーの1ディレクトリあたりのサブディレクトリ数 (デフォルト: 4)
+  --walk-threads N...  --walk で計測するスレッド数 (デフォルト: 1 2 4 8 16)
+  --walk-latency-ms F  --walk で scandir 1回ごとに加える遅延 (ネットワークマウントの模擬, デフォルト: 0)
+  --verify             その場での書き換え (ディレクトリの mtime が変わらない変更) をウォーム実行が検出するか検証する
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import statistics
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+TARGET_SCRIPT = SCRIPT_DIR / "sp_tree_json_std_lib.py"
+
+SIZE_ALIASES = {"1k": 1_000, "10k": 10_000, "100k": 100_000}
+PHASE_ORDER = ["walk", "read", "summarize", "idf", "tag", "index", "search", "build_tree", "serialize", "token_count"]
+SEARCH_QUERY = "user session token storage cache"
+
+# 拡張子ごとの出現比率 (合計100)
+EXT_WEIGHTS = [
+    ('.py', 30), ('.js', 12), ('.ts', 10), ('.go', 6), ('.rs', 5), ('.java', 6), ('.c', 3), ('.h', 2),
+    ('.md', 8), ('.json', 6), ('.yaml', 4), ('.txt', 3), ('.png', 3), ('.bin', 2),
+]
+WORDS = [
+    "user", "session", "token", "cache", "storage", "request", "response", "handler", "config", "parser",
+    "render", "queue", "worker", "index", "search", "record", "client", "server", "metric", "report",
+    "account", "payment", "invoice", "order", "stock", "schedule", "event", "stream", "buffer", "layout",
+]
+DIR_WORDS = ["src", "lib", "core", "api", "services", "utils", "models", "views", "handlers", "common",
+             "internal", "pkg", "modules", "features", "shared", "tools", "docs", "config", "data", "web"]
+
+# ==========================================
+# 1. Synthetic Repository Generation
+# ==========================================
+def parse_size(label: str) -> int:
+    if label.lower() in SIZE_ALIASES:
+        return SIZE_ALIASES[label.lower()]
+    return int(label)
+
+def _sentence(rng: random.Random, n: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+def _ident(rng: random.Random, i: int) -> str:
+    return f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{i}"
+
+def _python_source(rng: random.Random, n_defs: int) -> str:
+    lines = [f'"""{_sentence(rng, 8).capitalize()}."""', "import os", "import json", ""]
+    for i in range(n_defs):
+        if rng.random() < 0.3:
+            lines += [f"class {_ident(rng, i).title().replace('_', '')}:", f'    """{_sentence(rng, 6)}"""', ""]
+            for j in range(rng.randint(1, 4)):
+                lines += [f"    def {_ident(rng, j)}(self, {rng.choice(WORDS)}):",
+                          f"        return self.{rng.choice(WORDS)} + {rng.randint(0, 99)}", ""]
+        else:
+            lines += [f"def {_ident(rng, i)}({rng.choice(WORDS)}, {rng.choice(WORDS)}=None):",
+                      f"    # {_sentence(rng, 5)}",
+                      f"    value = {rng.randint(0, 999)}",
+                      "    return value", ""]
+    return "\n".join(lines) + "\n"
+
+def _brace_source(rng: random.Random, n_defs: int, ext: str) -> str:
+    header = f"/* {_sentence(rng, 8)} */"
+    lines = [header]
+    for i in range(n_defs):
+        name = _ident(rng, i)
+        if ext in ('.js', '.ts'):
+            lines += [f"export function {name}({rng.choice(WORDS)}) {{", f"  return {rng.randint(0, 99)};", "}"]
+        elif ext == '.go':
+            lines += [f"func {name}({rng.choice(WORDS)} int) int {{", f"\treturn {rng.randint(0, 99)}", "}"]
+        elif ext == '.rs':
+            lines += [f"pub fn {name}({rng.choice(WORDS)}: i32) -> i32 {{", f"    {rng.randint(0, 99)}", "}"]
+        elif ext == '.java':
+            lines += [f"public static int {name}(int {rng.choice(WORDS)}) {{", f"    return {rng.randint(0, 99)};", "}"]
+        elif ext == '.h':
+            lines += [f"int {name}(int {rng.choice(WORDS)});"]
+        else:
+            lines += [f"int {name}(int {rng.choice(WORDS)}) {{", f"    return {rng.randint(0, 99)};", "}"]
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+def _text_source(rng: random.Random, ext: str, n_lines: int) -> str:
+    if ext == '.md':
+        return f"# {_sentence(rng, 3).title()}\n\n" + "\n".join(_sentence(rng, 12) for _ in range(n_lines)) + "\n"
+    if ext == '.json':
+        return json.dumps({_ident(rng, i): [rng.randint(0, 999), _sentence(rng, 3)] for i in range(n_lines)}, indent=2) + "\n"
+    if ext == '.yaml':
+        return "\n".join(f"{_ident(rng, i)}: {_sentence(rng, 3)}" for i in range(n_lines)) + "\n"
+    return "\n".join(_sentence(rng, 10) for _ in range(n_lines)) + "\n"
+
+def generate_repo(repo_dir: Path, n_files: int, seed: int):
+    """シード固定の合成リポジトリを生成する"""
+    rng = random.Random(seed)
+    repo_dir.mkdir(parents=True, exist_ok=True)
+    (repo_dir / "README.md").write_text(f"# Synthetic repo\n\n{_sentence(rng, 60)}\n", encoding='utf-8')
+
+    # ディレクトリ構成: 1ディレクトリあたり平均20ファイル程度になるよう、深さ1〜7のパスを作る
+    n_dirs = max(1, n_files // 20)
+    dirs = []
+    for i in range(n_dirs):
+        depth = rng.randint(1, 7)
+        parts = [f"{rng.choice(DIR_WORDS)}{rng.randint(0, 9) if d > 1 else ''}" for d in range(depth)]
+        parts[-1] = f"{parts[-1]}_{i}"
+        dirs.append(Path(*parts))
+
+    exts = [e for e, _ in EXT_WEIGHTS]
+    weights = [w for _, w in EXT_WEIGHTS]
+    for i in range(n_files - 1):
+        ext = rng.choices(exts, weights)[0]
+        target = repo_dir / rng.choice(dirs) / f"{_ident(rng, i)}{ext}"
+        target.parent.mkdir(parents=True, exist_ok=True)
+        is_large = rng.random() < 0.005
+        if ext in ('.png', '.bin'):
+            target.write_bytes(rng.randbytes(rng.randint(512, 64 * 1024)))
+            continue
+        if ext == '.py':
+            content = _python_source(rng, 400 if is_large else rng.randint(2, 25))
+        elif ext in ('.md', '.json', '.yaml', '.txt'):
+            content = _text_source(rng, ext, 20000 if is_large else rng.randint(5, 80))
+        else:
+            content = _brace_source(rng, 3000 if is_large else rng.randint(2, 25), ext)
+        target.write_text(content, encoding='utf-8')
+
+def ensure_repo(workdir: Path, n_files: int, seed: int) -> Path:
+    """生成済み(完了マーカーあり)なら再利用し、なければ生成する"""
+    repo_dir = workdir / f"synthetic_{n_files}_s{seed}"
+    marker = workdir / f"synthetic_{n_files}_s{seed}.done"
+    if marker.exists() and repo_dir.exists():
+        print(f"[LOG] Reusing synthetic repo: {repo_dir}", file=sys.stderr)
+        return repo_dir
+    print(f"[LOG] Generating synthetic repo ({n_files:,} files): {repo_dir}", file=sys.stderr)
+    start = time.perf_counter()
+    generate_repo(repo_dir, n_files, seed)
+    marker.write_text(str(n_files), encoding='utf-8')
+    print(f"[LOG] Generated in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    return repo_dir
+
+# ==========================================
+# 2. Measurement
+# ==========================================
+def scenario_args(scenario: str, repo_dir: Path, out_path: Path) -> List[str]:
+    if scenario == "search":
+        return ["-p", str(repo_dir), "-s", SEARCH_QUERY, "--text", "-o", str(out_path)]
+    return ["-p", str(repo_dir), "-o", str(out_path)]
+
+def clear_caches(repo_dir: Path):
+    """cold 計測の前に、ツールが対象ディレクトリへ書き出すキャッシュをすべて消す"""
+    from sp_tree_json_std_lib import CACHE_FILE_NAME, BLOB_DB_NAME, INDEX_DB_NAME, ONNX_CACHE_DIR_NAME
+    for name in (CACHE_FILE_NAME, BLOB_DB_NAME, BLOB_DB_NAME + "-journal", INDEX_DB_NAME, INDEX_DB_NAME + "-journal"):
+        cache_file = repo_dir / name
+        if cache_file.exists():
+            cache_file.unlink()
+    # 埋め込みキャッシュが残っていると cold でもエンコードが省かれ、rerank の計測が warm 相当になる
+    shutil.rmtree(repo_dir / ONNX_CACHE_DIR_NAME, ignore_errors=True)
+
+def run_worker(tool_args: List[str], result_path: str):
+    """別プロセスで1回分のダンプを実行し、フェーズ別の計測値を書き出す"""
+    sys.path.insert(0, str(SCRIPT_DIR))
+    import sp_tree_json_std_lib as tool
+
+    tool.PROFILER.enabled = True
+    sys.argv = [str(TARGET_SCRIPT)] + tool_args
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            tool.main()
+        finally:
+            sys.stdout = stdout
+    # summarize のように読み込み段の中でファイル単位に計測する処理も、フェーズとして含める
+    timings = {name: phase["wall_s"] for name, phase in tool.PROFILER.phase_totals().items()}
+    timings["total"] = time.perf_counter() - start
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump(timings, f)
+
+def measure_once(tool_args: List[str]) -> Dict[str, float]:
+    fd, result_path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        cmd = [sys.executable, str(Path(__file__).resolve()), "--worker", result_path, "--"] + tool_args
+        res = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if res.returncode != 0:
+            raise RuntimeError(f"worker failed: {res.stderr[-2000:]}")
+        with open(result_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    finally:
+        os.remove(result_path)
+
+def median_timings(runs: List[Dict[str, float]]) -> Dict[str, float]:
+    keys = sorted({k for r in runs for k in r})
+    return {k: statistics.median(r.get(k, 0.0) for r in runs) for k in keys}
+
+def run_benchmarks(args) -> Dict:
+    sys.path.insert(0, str(SCRIPT_DIR))
+    workdir = Path(args.workdir).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    results = {}
+    for label in args.sizes:
+        n_files = parse_size(label)
+        repo_dir = ensure_repo(workdir, n_files, args.seed)
+        results[label] = {}
+        for scenario in args.scenarios:
+            out_path = workdir / f"out_{n_files}_{scenario}.txt"
+            tool_args = scenario_args(scenario, repo_dir, out_path)
+
+            clear_caches(repo_dir)
+            print(f"[LOG] {label} / {scenario} / cold ...", file=sys.stderr)
+            cold = measure_once(tool_args)
+
+            warm_runs = []
+            for i in range(args.repeat):
+                print(f"[LOG] {label} / {scenario} / warm ({i + 1}/{args.repeat}) ...", file=sys.stderr)
+                warm_runs.append(measure_once(tool_args))
+            results[label][scenario] = {"cold": cold, "warm": median_timings(warm_runs)}
+            print(f"[LOG]   cold {cold['total']:.2f}s / warm {results[label][scenario]['warm']['total']:.2f}s", file=sys.stderr)
+    return results
+
+def git_revision() -> str:
+    try:
+        res = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR, capture_output=True, text=True)
+        if res.returncode == 0:
+            dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=SCRIPT_DIR, capture_output=True, text=True)
+            return res.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+    except Exception:
+        pass
+    return "unknown"
+
+# ==========================================
+# 2.5. Directory Walk
+# ==========================================
+def ensure_deep_tree(workdir: Path, depth: int, fanout: int) -> Path:
+    """深さ depth・分岐 fanout の完全木 (各ディレクトリにファイル3つと除外対象の node_modules) を生成する"""
+    tree_dir = workdir / f"deep_d{depth}_f{fanout}"
+    marker = workdir / f"deep_d{depth}_f{fanout}.done"
+    if marker.exists() and tree_dir.exists():
+        print(f"[LOG] Reusing deep tree: {tree_dir}", file=sys.stderr)
+        return tree_dir
+    print(f"[LOG] Generating deep tree (depth {depth}, fanout {fanout}): {tree_dir}", file=sys.stderr)
+    level = [tree_dir]
+    for d in range(depth + 1):
+        next_level = []
+        for parent in level:
+            parent.mkdir(parents=True, exist_ok=True)
+            for i in range(3):
+                (parent / f"file_{i}.py").write_text("", encoding='utf-8')
+            if d < depth:
+                (parent / "node_modules" / "pkg").mkdir(parents=True, exist_ok=True)
+                next_level.extend(parent / f"dir{d}_{i}" for i in range(fanout))
+        level = next_level
+    marker.write_text("", encoding='utf-8')
+    return tree_dir
+
+def run_walk_benchmarks(args) -> Dict:
+    """逐次の os.walk (walk_disk) と並列走査 (parallel_walk) を同じツリーで計測する"""
+    sys.path.insert(0, str(SCRIPT_DIR))
+    import sp_tree_json_std_lib as tool
+
+    workdir = Path(args.workdir).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    tree_dir = ensure_deep_tree(workdir, args.walk_depth, args.walk_fanout)
+    excludes = list(tool.DEFAULT_EXCLUDES)
+
+    # os.walk も os.scandir を使うため、ここに遅延を入れれば両方の走査に同じ往復待ちが乗る
+    scandir = os.scandir
+    if args.walk_latency_ms > 0:
+        def slow_scandir(path='.'):
+            time.sleep(args.walk_latency_ms / 1000)
+            return scandir(path)
+        os.scandir = slow_scandir
+    try:
+        baseline = None
+        timings = {}
+        for threads in args.walk_threads:
+            runs = []
+            for _ in range(max(1, args.repeat)):
+                start = time.perf_counter()
+                walked = list(tool.walk_disk(tree_dir, excludes, threads))
+                runs.append(time.perf_counter() - start)
+            if baseline is None:
+                baseline = walked
+            elif walked != baseline:
+                raise RuntimeError(f"walk order differs with {threads} threads")
+            timings[str(threads)] = statistics.median(runs)
+            print(f"[LOG] walk threads={threads}: {timings[str(threads)]:.3f}s ({len(walked):,} dirs)", file=sys.stderr)
+    finally:
+        os.scandir = scandir
+    return {
+        "depth": args.walk_depth,
+        "fanout": args.walk_fanout,
+        "latency_ms": args.walk_latency_ms,
+        "dirs": len(baseline or []),
+        "seconds": timings,
+    }
+
+# ==========================================
+# 2.6. Incremental Correctness
+# ==========================================
+VERIFY_MARKER = "verify_in_place_edit_marker"
+
+def run_cli(tool_args: List[str]) -> str:
+    """ツールを別プロセスで実行し、標準エラー出力を返す (失敗時は RuntimeError)"""
+    res = subprocess.run([sys.executable, str(TARGET_SCRIPT)] + tool_args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if res.returncode != 0:
+        raise RuntimeError(f"tool failed: {res.stderr[-2000:]}")
+    return res.stderr
+
+def append_in_place(path: Path, text: str):
+    """ファイルをその場で書き換え、親ディレクトリの mtime は元に戻す (エディタの上書き保存と同じ状況)"""
+    st = path.parent.stat()
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(text)
+    os.utime(path.parent, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+def run_incremental_checks(args) -> int:
+    """
+    ウォーム実行 (キャッシュ・ディレクトリのマニフェストあり) が、その場で書き換えられたファイルを
+    取りこぼさないことを確かめる。戻り値: 失敗した検証の数
+    """
+    repo_dir = Path(args.workdir).resolve() / "verify_repo"
+    shutil.rmtree(repo_dir, ignore_errors=True)
+    generate_repo(repo_dir, 200, args.seed)
+    out_path = repo_dir.parent / "verify_out.txt"
+    target = sorted(repo_dir.rglob("*.py"))[0]
+    base = ["-p", str(repo_dir), "--text", "-o", str(out_path)]
+
+    checks = {
+        "minify output": base + ["--minify", "2"],
+        "outline output": base + ["--outline"],
+        "since output": base + ["--since", "verify"],
+    }
+    # 書き換え前に各モードを実行し、キャッシュ済みの成果物 (minify・アウトライン) とマニフェストを揃えておく
+    run_cli(base + ["--snapshot", "verify"])
+    for tool_args in checks.values():
+        run_cli(tool_args)
+    append_in_place(target, f"\n\ndef {VERIFY_MARKER}():\n    return 1\n")
+
+    failures = 0
+    try:
+        for label, tool_args in checks.items():
+            # 変更なしと判定された場合は出力されないため、前回の出力を消してから実行する
+            out_path.unlink(missing_ok=True)
+            run_cli(tool_args)
+            ok = out_path.exists() and VERIFY_MARKER in out_path.read_text(encoding='utf-8')
+            failures += not ok
+            print(f"[{'OK' if ok else 'FAIL'}] in-place edit of {target.relative_to(repo_dir)} reflected in {label}", file=sys.stderr)
+    finally:
+        shutil.rmtree(repo_dir, ignore_errors=True)
+        out_path.unlink(missing_ok=True)
+    return failures
+
+# ==========================================
+# 3. Comparison
+# ==========================================
+def iter_timings(data: Dict):
+    for size, scenarios in data.get("results", {}).items():
+        for scenario, states in scenarios.items():
+            for state, timings in states.items():
+                for phase, value in timings.items():
+                    yield (size, scenario, state, phase), value
+
+def _phase_sort_key(item: Tuple) -> Tuple:
+    size, scenario, state, phase = item
+    order = PHASE_ORDER.index(phase) if phase in PHASE_ORDER else len(PHASE_ORDER)
+    return (parse_size(size), scenario, state, order)
+
+def compare_results(base_path: str, new_path: str, threshold: float) -> int:
+    with open(base_path, 'r', encoding='utf-8') as f:
+        base = json.load(f)
+    with open(new_path, 'r', encoding='utf-8') as f:
+        new = json.load(f)
+    base_t = dict(iter_timings(base))
+    new_t = dict(iter_timings(new))
+
+    print(f"base: {base.get('meta', {}).get('revision', '?')}  new: {new.get('meta', {}).get('revision', '?')}")
+    print(f"{'size':>6} {'scenario':<8} {'state':<5} {'phase':<12} {'base(s)':>9} {'new(s)':>9} {'ratio':>7}")
+    regressions = 0
+    for key in sorted(set(base_t) & set(new_t), key=_phase_sort_key):
+        b, n = base_t[key], new_t[key]
+        ratio = n / b if b > 0 else float('inf') if n > 0 else 1.0
+        # 数ミリ秒程度の揺らぎは劣化とみなさない
+        flag = ""
+        if ratio > 1.0 + threshold and n - b > 0.005:
+            flag = "  REGRESSION"
+            regressions += 1
+        size, scenario, state, phase = key
+        print(f"{size:>6} {scenario:<8} {state:<5} {phase:<12} {b:>9.3f} {n:>9.3f} {ratio:>6.2f}x{flag}")
+    print(f"\n{regressions} regression(s) over {threshold:.0%} threshold.")
+    return 1 if regressions else 0
+
+def main():
+    parser = argparse.ArgumentParser(description="sp_tree_json_std_lib.py のフェーズ別ベンチマーク")
+    parser.add_argument('--sizes', nargs='+', default=['1k', '10k', '100k'], help='計測する規模 (1k, 10k, 100k または数値)')
+    parser.add_argument('--scenarios', nargs='+', choices=['full', 'search'], default=['full', 'search'], help='計測シナリオ')
+    parser.add_argument('--repeat', type=int, default=1, help='ウォーム計測の繰り返し回数 (中央値を採用)')
+    parser.add_argument('--seed', type=int, default=42, help='合成リポジトリの乱数シード')
+    parser.add_argument('--workdir', default=str(Path(tempfile.gettempdir()) / "sp_tree_bench"), help='合成リポジトリの生成先')
+    parser.add_argument('--output', '-o', default='', help='結果JSONの保存先 (未指定時は標準出力)')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='2つの結果JSONを比較する')
+    parser.add_argument('--threshold', type=float, default=0.10, help='比較時に劣化とみなす増加率')
+    parser.add_argument('--walk', action='store_true', help='ディレクトリ走査のみを合成の深いツリーで計測する')
+    parser.add_argument('--walk-depth', type=int, default=6, help='--walk の合成ツリーの深さ')
+    parser.add_argument('--walk-fanout', type=int, default=4, help='--walk の合成ツリーの分岐数')
+    parser.add_argument('--walk-threads', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='--walk で計測するスレッド数')
+    parser.add_argument('--walk-latency-ms', type=float, default=0.0, help='--walk で scandir 1回ごとに加える遅延 (ms)')
+    parser.add_argument('--verify', action='store_true', help='その場での書き換えをウォーム実行と --since が検出するか検証する')
+    parser.add_argument('--worker', default=None, help=argparse.SUPPRESS)
+    args, rest = parser.parse_known_args()
+
+    if args.worker:
+        run_worker([a for a in rest if a != '--'], args.worker)
+        return
+
+    if args.compare:
+        sys.exit(compare_results(args.compare[0], args.compare[1], args.threshold))
+
+    if args.verify:
+        sys.exit(1 if run_incremental_checks(args) else 0)
+
+    results = run_walk_benchmarks(args) if args.walk else run_benchmarks(args)
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": args.seed,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        ("walk" if args.walk else "results"): results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"Saved to {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,12 @@ LLM共有用プロジェクトダンプツール (All-in-One Version)
 4. インタラクティブモード: 検索でヒットしたファイル一覧を見ながら、ファイルごとに
    「全文出力 / 要約のみ / アウトラインのみ / 除外」をキーボードで対話的に選択可能。
 5. キャッシュ機構: パース・要約・タグ付けの結果を自動で `.context_cache.json` に保存。
+   結果はファイル内容のハッシュ単位で保存されるため、同一内容のファイルや複数ルート間でも共有されます。
+   大きな成果物 (MinHash・minify後の本文・アウトライン・チャンク・サンプリング結果・トークン数) は `.context_cache.db`
+   (SQLite) に分けて置き、起動時に全体を読み込まず必要な分だけを引きます。
+   ※ 本文は上限付きの LRU (32MB) にだけ保持し、解析・Focus・grep・検索・出力の各段で共有します。
+      LRU に収まらない規模のプロジェクトでは、キャッシュのない初回は出力するファイルを解析時と出力時の
+      2回読みます (同時に保持する本文は LRU の上限 + ワーカー数程度に抑えられます)。
    巨大なプロジェクトでも2回目以降の実行は一瞬で完了し、ノートPCのバッテリーとCPUに優しい設計です。
 
 ==================================================
@@ -52,15 +58,48 @@ LLM共有用プロジェクトダンプツール (All-in-One Version)
 【オプション一覧】
 
 1. 入出力・基本設定
-  -p, --path PATH             処理対象のルートディレクトリ (デフォルト: ".")
+  -p, --path PATH...          処理対象のルートディレクトリ (デフォルト: ".")
+                              ※ 複数指定すると各ルートを並列に走査し、キャッシュ・IDF・検索インデックスを共有します
+                                (出力ツリーのパスは「ルート名/...」になります)
+                              ※ .zip / .tar / .tar.gz を指定すると展開せずにメンバを直接読み込みます
+                                (除外・プレビュー対象の判定もメンバ単位で適用、キャッシュキーはメンバのCRC32)
+  --cache-dir DIR             キャッシュ(.context_cache.json / .context_cache.db / .context_trigrams.db / .onnx_cache)の保存先
+                              (デフォルト: 単一ルートはルート直下、複数ルートは共通の親ディレクトリ)
   -o, --outfile FILE          結果を指定ファイルに出力 (未指定時は標準出力)
   -c, --copy                  結果をクリップボードにコピー (要 pyperclip)
-  --debug                     デバッグログを表示
+  --debug                     デバッグログを表示 (各行に起動からの経過秒数が付きます)
+  --profile [FILE]            フェーズ別(walk/read/summarize/tag/index/search/build_tree/serialize/token_count等)の
+                              Wall/CPU時間、読み込みファイル数・バイト数、成果物別キャッシュヒット率、
+                              言語別パース回数、最大メモリ、遅いファイル上位N件をJSONで出力
+                              (FILE省略時は標準エラー出力)
+                              ※ summarize は読み込み段の中でファイルごとに行うため、ファイルごとの時間の合計
+                                 ("per_file_sum": true) として出力します
+  --profile-top INT           --profile で表示する遅いファイルの件数 (デフォルト: 5)
   --tree                      tree構造で視覚的に表示（中身なし）
   --text                      Markdown風のテキスト形式で出力（トークン節約）
+  --split-tokens N             出力を1パートあたり N トークン以内のパートに分割する (1メッセージに収まらない場合)
+                              ファイル/ディレクトリの境界で区切り、各パートに「Part i/n」の見出しを付ける
+                              -o 指定時は連番ファイル (context.part01.md ...)、-c 指定時は1パートずつコピー
+                              ※ トークン数はファイル単位でキャッシュするため、分割のための数え直しは発生しません
+  --no-dedup                  重複排除を無効化する
+                              ※ デフォルトでは、出力内容が同一のファイル(vendorのコピー等)は2回目以降を
+                                 {"same_as": "最初のパス"} という参照にまとめ、節約トークン数を表示します
+  --near-dup [THRESHOLD]      類似ファイル(テンプレートのコピー、ロケール別ファイル等)をMinHash/LSHで検出し、
+                              代表1件の全文 + 他は代表との差分 ("similar_to", "diff") にまとめる (閾値既定: 0.8)
 
 2. 抽出・軽量化モード (LLMコンテキスト最適化)
   --summary-only              ファイルの中身を省き、冒頭の「要約コメント」と「タグ」のみを出力する
+  --minify [LEVEL]            全文出力するコードを、構文を保ったまま縮める (値なしは 2)
+                              1: 行末の空白を削除し、連続する空行を1行にまとめる
+                              2: 1 + コメントと docstring を削除
+                              3: 2 + 空行をすべて削除し、インデントを1段1スペースにする
+                              ※ Python は tokenize/ast、その他は Tree-sitter 対応言語のみ (未導入時は Python のみ)。
+                                 文字列リテラルの内側は変更せず、結果が構文エラーになるファイルは元のまま出力します
+                              ※ 縮めた結果は内容ハッシュ+レベル単位でキャッシュし、ファイルごとの節約トークン数を表示します
+  --depth-summary N           深さN (ルート=0) のディレクトリを、配下ごと1つの「ロールアップ」にまとめる
+                              (ファイル数・上位タグ・子要素ごとの要約1行。深さN未満のファイルは通常どおり出力)
+                              ※ ロールアップはサブディレクトリから順に積み上げてキャッシュし、
+                                 内容が変わったファイルの祖先ディレクトリだけを再計算します
   --outline                   ファイルの中身を省き、クラスや関数のシグネチャ（アウトライン）のみを出力する
   --full FILES...             全体を要約出力にする場合でも、指定したファイル名を含む場合は詳細(全文)を出力する
   --interactive, -i           対話モード: 抽出されたファイルごとに「全文/要約/アウトライン/除外」を個別に選択する
@@ -69,8 +108,23 @@ LLM共有用プロジェクトダンプツール (All-in-One Version)
 3. 自然言語検索 ＆ タグ検索
   -s, --search QUERY          自然言語で「作りたい・直したい機能」を検索し、関連ファイルを出力する（BM25アルゴリズム）
   --semantic-search           ONNXを用いたローカルでの意味検索（セマンティック検索）を有効化 (要 onnxruntime)
+  --onnx-threads INT          意味検索の推論スレッド数 (0で自動: CPU数と4の小さい方)。複数のダンプを並列に
+                              動かす場合は小さくすると奪い合いを防げます (待機スレッドのスピンは常に無効)
+  --onnx-inter-threads INT    演算子間の並列スレッド数 (--onnx-execution-mode parallel 時のみ, デフォルト: 1)
+  --onnx-execution-mode MODE  ONNXグラフの実行方式: sequential (デフォルト) / parallel
+                              ※ 初回読み込み時に最適化したグラフを .onnx_cache に保存し、2回目以降はそれを読み込みます
+                                (読み込み・推論時間は --profile の onnx_session / onnx_inference に表示)
   --search-full               検索対象を「要約+タグ」だけでなく、ファイル全体（全文）に拡張する
+  --search-chunks             ファイルを関数/クラス単位のチャンクに分割して索引化し、ヒットしたチャンクのみを出力する
+                              (巨大ファイルの後半も検索対象になります。--top-k はチャンク数として扱われます。
+                               分割結果は内容ハッシュ単位でキャッシュされ、変更のないファイルは読み直しません)
   --top-k INT                 検索時に関連度の高い上位N件のみを抽出する (デフォルト: 5)
+  --rerank-candidates INT     意味検索時、BM25等で絞った上位N件のみをONNXで再採点する (デフォルト: 50, 0で全件)
+                              ※ 語の一致する文書がN件に満たない場合は残りの文書で補充し、文書数がN以下なら全件を再採点します
+                              ※ リポジトリが大きくなってもクエリ毎の推論コストが一定になります
+  --prefilter MODE            候補抽出に使う軽量スコアラー: bm25 (デフォルト) / trigram (文字3-gram, 部分一致向け)
+                              ※ bm25 では、一致する文書がN件に満たない時だけ trigram で補充します
+  --fusion MODE               スコア統合方法: linear (BM25 3割 + ONNX 7割, デフォルト) / rrf (Reciprocal Rank Fusion)
   --tag TAGS...               指定したタグを完全に含むファイルのみを厳密に抽出する
   --vocab-file FILE           プロジェクト全体の共通タグ(ドメイン用語)を抽出するためのファイル (デフォルト: README.md)
   --dry-run                   ファイルを出力せず、検索や抽出の結果（対象ファイル一覧とタグ）のみをターミナルに表示する
@@ -83,6 +137,16 @@ LLM共有用プロジェクトダンプツール (All-in-One Version)
                               (デフォルト: .py .md .txt .json .js .ts .html .css 等)
   --preview-lines INT         1ファイルあたりの最大読み込み行数 (デフォルト: 2000)
   --max-preview-size-mb FLOAT 1ファイルあたりの最大サイズ(MB) (デフォルト: 1.0)
+  --max-file-tokens INT       1ファイルあたりの最大トークン数 (指定時は --preview-lines の代わりに使用)
+                              超えるファイルは先頭と末尾を残し、中間を「// ... [N lines elided ...] ...」(Python等は「#」) に置き換える
+                              ※ 関数/クラス定義が抽出できるファイルは定義の途中で切らず、定義単位で残します
+                              ※ minify済みの1行ファイルは文字単位で先頭・末尾を残します
+  --sample-data [MB]          MB (値なしは 1.0) を超えるデータファイルを、全文の代わりに構造のプレビューにする
+                              (.json .ndjson .jsonl .csv .tsv .yaml .yml .sql .txt .log。これらはプレビュー対象に追加)
+                              JSON/NDJSON/CSV はスキーマ (キー・型) とレコード例、YAML はトップレベルのキー、
+                              SQLダンプは表ごとの CREATE TABLE と INSERT 件数、ログ等は先頭と無作為な位置の行
+                              ※ 読むのは先頭256KBと無作為な5箇所 (各64KB) だけなので、数GBのファイルでも一定時間で終わります
+                              ※ --max-preview-size-mb を超えるファイルも対象です
 
 3. フィルタリング (除外・Git)
   -e, --exclude PATTERNS...   除外するファイル/フォルダのパターン (例: "*.log" "tmp*")
@@ -91,6 +155,19 @@ LLM共有用プロジェクトダンプツール (All-in-One Version)
 
   --use-gitignore            .gitignoreの記述を解析し、除外リストに追加されます。
 
+  --rescan                   ディレクトリのマニフェストを使わず、全ディレクトリを一覧し直す
+                              ※ 通常は前回の実行でディレクトリの mtime と一覧を .context_cache.json に記録し、
+                                 mtime が変わっていないディレクトリは一覧の取得 (scandir) を省略します
+                                 (ネットワークドライブ上の巨大なツリーで有効)
+                              ※ ファイル自体は毎回 stat するため、その場で上書きされた変更も常に検出されます
+
+  --walk-threads INT         ディレクトリ走査のスレッド数 (デフォルト: 1 = 従来どおり逐次走査)
+                              ※ 2以上を指定すると、独立したサブディレクトリの一覧取得 (scandir) を並列に発行します
+                                 (手の空いたスレッドは他スレッドの未処理ディレクトリを引き取る、ワークスティーリング方式)
+                              ※ 1回ごとに往復が発生する NFS/SMB 上の巨大なツリーで有効です (目安: 8〜32)。
+                                 ローカルディスクではほぼ差がありません
+                              ※ 除外パターンでの枝刈りと出力順は逐次走査と同じです
+
   --git-filter MODE           Gitの状態に基づいて絞り込み
                               [モード]
                               - None     : フィルタなし (デフォルト)
@@ -98,15 +175,43 @@ LLM共有用プロジェクトダンプツール (All-in-One Version)
                               - Staged   : git add 済みのファイルのみ (レビュー用)
                               - Modified : 変更があるファイルのみ (作業ログ用)
 
+  --rev COMMIT-ISH            作業ツリーではなく指定リビジョンのツリーを出力 (チェックアウト不要)
+                              git ls-tree で一覧し、内容は常駐する git cat-file --batch から読み込み。
+                              blob の SHA をキャッシュキーに使うため、同じリビジョンの再ダンプはほぼ解析不要
+
+  --snapshot NAME             出力したファイルのパスと内容ハッシュを NAME として記録する (.context_cache.json, 最大20件)
+  --since NAME                スナップショット NAME 以降に追加・変更されたファイルだけを出力し、削除を含む
+                              変更一覧を印付きのツリー ([+] 追加, [~] 変更, [-] 削除) で先頭に付ける
+                              ※ 内容ハッシュで比較するため、変更のないファイルは読み込みません
+                              ※ --since NAME --snapshot NAME で、送るたびに基準を更新できます
+
+  --hunks                     --git-filter Staged/Modified と併用。git diff -U0 の各ハンクを、それを含む
+                              関数/クラス定義にまとめ、その定義だけを変更行の印 ("+", "-") 付きで出力
+                              ※ 未追跡ファイルは全文を出力します
+
 4. Focusモード (特定コードの切り抜き)
   -f, --focus KEYWORD         指定したキーワード(関数名/クラス名)に関連するコードのみ抽出
                               ※ Tree-sitter導入時は文法レベルで正確に抽出
   --resolve-deps              Focusモード時、依存関係(import)にあるファイルも含める
                               (要 networkx)
+  --grep PATTERN              正規表現に一致する行を含むファイルだけを、一致行の前後のみ (">" 印付き) 出力する
+                              ※ ファイルごとの trigram (3文字の並び) 索引を専用の .context_trigrams.db に保持し (必要な分だけ読み込み)、
+                                 パターン中の文字列を含み得るファイルだけを読んで照合します (Focusモードも同じ索引を使用)
+  --grep-ignore-case          --grep で大文字小文字を区別しない
+  --grep-context N            --grep で一致行の前後に出力する行数 (デフォルト: 2)
+  --grep-defs                 --grep で一致行を含む関数/クラス定義全体を出力する
 
 5. その他
   --model NAME                トークン計算に使用するモデル名 (デフォルト: gpt-4o)
 
+6. エージェント連携 (常駐ツールサーバー)
+  --serve                     一度だけ走査してインデックスを保持したまま常駐し、標準入出力で
+                              JSON-RPC 2.0 (1行1メッセージ, MCPの stdio 形式) のツール呼び出しを受け付ける
+                              [ツール] search / focus / grep / outline / summary / read_range / tree / rescan
+                              (tools/list で各ツールの JSON Schema を返します)
+  --page-size INT             1回の応答の最大文字数 (デフォルト: 20000)。超える結果はページ分割し、
+                              応答の next_page を page 引数に指定して続きを取得する
+
 ==================================================
 
 【コマンド使用例】
@@ -124,6 +229,15 @@ LLM共有用プロジェクトダンプツール (All-in-One Version)
    # 結果をファイルに保存 (Markdown形式)
    python sp_tree_json_std_lib.py --text -o context.md
 
+   # 1メッセージ 8000 トークン以内に分割して保存 (context.part01.md, context.part02.md, ...)
+   python sp_tree_json_std_lib.py --text --split-tokens 8000 -o context.md
+
+   # 隣接する複数リポジトリをまとめて1つのコンテキストにする (キャッシュ・検索は共通)
+   python sp_tree_json_std_lib.py -p ../api ../web ../shared -s "認証フロー" --text --copy
+
+   # 送られてきたスナップショット (zip / tar.gz) を展開せずにそのまま読む
+   python sp_tree_json_std_lib.py -p snapshot.tar.gz --outline --text
+
 2. AI支援・検索機能の活用（作りたい・変更したい機能から探す）
    # 「ユーザーログイン処理の不具合を直したい」という意図から関連ファイルを探し、
    # インタラクティブモードでどれをLLMに渡すか選ぶ（ONNX意味検索を使用）
@@ -132,6 +246,12 @@ LLM共有用プロジェクトダンプツール (All-in-One Version)
    # 検索結果の上位3件の「要約」と、そのファイルが依存している別ファイルの「アウトライン」をセットで取得
    python sp_tree_json_std_lib.py -s "データベースへの保存処理" --top-k 3 --smart-context --text --copy
 
+   # 大規模リポジトリ向け: BM25上位30件だけをONNXで再採点し、順位ベース(RRF)で統合する
+   python sp_tree_json_std_lib.py -s "認証トークンの更新" --semantic-search --rerank-candidates 30 --fusion rrf --text --copy
+
+   # 関数/クラス単位で検索し、ヒットした定義だけを出力（ファイル全体は出さない）
+   python sp_tree_json_std_lib.py -s "パスワードのハッシュ化" --search-chunks --semantic-search --text --copy
+
    # 全文検索を用いて、「API」と「認証」に関連するファイルを探し、結果だけをプレビュー（出力しない）
    python sp_tree_json_std_lib.py -s "API 認証" --search-full --dry-run
 
@@ -145,6 +265,12 @@ LLM共有用プロジェクトダンプツール (All-in-One Version)
    # 全ファイルは「要約」だけ出力しつつ、"main.py" と "config.py" だけは中身を「全文」出力する
    python sp_tree_json_std_lib.py --summary-only --full main.py config.py --copy
 
+   # コメント・docstringを削り、インデントを1スペースにして全文出力 (構文は保たれる)
+   python sp_tree_json_std_lib.py --minify 3 --text
+
+   # 巨大リポジトリの全体像: 直下のファイルは要約、2階層目以下のディレクトリは1ノードのロールアップにまとめる
+   python sp_tree_json_std_lib.py --summary-only --depth-summary 2 --text
+
 4. プロジェクト構造の把握（トークン節約）
    # ディレクトリ構造のみを表示（ファイル名は非表示）
    # -> フォルダ構成だけをAIに伝えたい時に最適
@@ -167,6 +293,16 @@ LLM共有用プロジェクトダンプツール (All-in-One Version)
    # -> 作業中の内容について相談したい時
    python sp_tree_json_std_lib.py --git-filter Modified
 
+   # チェックアウトせずに別ブランチ/タグの内容を出力
+   python sp_tree_json_std_lib.py --rev origin/main --outline
+
+   # ステージ済みの変更を含む関数/クラスだけを出力 (巨大なファイルの数行の変更のレビュー向け)
+   python sp_tree_json_std_lib.py --git-filter Staged --hunks --copy
+
+   # 長いLLMセッションで、前回送った時点からの変更だけを送る (送るたびに基準を更新)
+   python sp_tree_json_std_lib.py --text --snapshot chat1 --copy
+   python sp_tree_json_std_lib.py --text --since chat1 --snapshot chat1 --copy
+
    # Git管理下のファイルのみ出力（ゴミファイルや未管理ファイルを除外）
    python sp_tree_json_std_lib.py --git-filter Tracked
 
@@ -190,13 +326,42 @@ LLM共有用プロジェクトダンプツール (All-in-One Version)
    # "FIXME" という単語を含む箇所を抽出してコピー
    python sp_tree_json_std_lib.py --focus "FIXME" --copy
 
-7. フィルタリングとサイズ制御
+   # 正規表現で検索し、一致行を含む関数/クラス定義ごと出力
+   python sp_tree_json_std_lib.py --grep "TODO|FIXME" --grep-defs --text
+
+7. 性能調査
+   # どのフェーズ(走査/読み込み/解析/検索/出力)が遅いか、キャッシュが効いているかを確認する
+   python sp_tree_json_std_lib.py -s "ログイン" --profile -o context.json
+
+   # プロファイル結果をJSONファイルに保存 (遅いファイル上位10件)
+   python sp_tree_json_std_lib.py --profile profile.json --profile-top 10 -o context.json
+
+8. エージェント連携・ライブラリとして使う
+   # インデックスを温めたまま常駐し、エージェントから必要な箇所だけを都度取得させる
+   python sp_tree_json_std_lib.py --serve --semantic-search
+   #   -> {"jsonrpc": "2.0", "id": 1, "method": "tools/call",
+   #       "params": {"name": "search", "arguments": {"query": "ログイン処理"}}}
+
+   # Pythonから直接使う (キャッシュ・インデックス・モデルは呼び出し間で保持される)
+   #   from sp_tree_json_std_lib import ContextBuilder
+   #   with ContextBuilder(["./src"], semantic_search=True) as builder:
+   #       builder.scan()
+   #       hits = builder.search("ログイン処理の不具合")
+   #       print(builder.render(builder.build_tree({h["path"] for h in hits}, outline=True), text=True))
+
+9. フィルタリングとサイズ制御
    # ログファイル、一時フォルダ、特定の設定ファイルを除外
    python sp_tree_json_std_lib.py --exclude "*.log" "temp*" "secret.yaml"
 
    # 1ファイルあたりの読み込みを先頭500行までに制限（巨大ファイル対策）
    python sp_tree_json_std_lib.py --preview-lines 500
 
+   # 1ファイルあたり2000トークンまで (巨大なファイルやminify済みJSは先頭と末尾だけ残す)
+   python sp_tree_json_std_lib.py --max-file-tokens 2000 --text
+
+   # 1MBを超える CSV / JSON / SQLダンプ等はスキーマとサンプルだけを出力 (数GBでも先頭と数箇所しか読まない)
+   python sp_tree_json_std_lib.py --sample-data --text
+
    # .py と .md だけ中身を表示し、他は除外（ツリーにも出さない）
    python sp_tree_json_std_lib.py --preview-exts .py .md
 
@@ -220,11 +385,29 @@ import fnmatch
 import re
 import ast
 import math
+import time
+import heapq
+import io
+import csv
+import random
+import tokenize
+import bisect
+import base64
+import difflib
+import hashlib
+import functools
+import tarfile
+import zipfile
+import zlib
+import sqlite3
+import threading
 import urllib.request
-from collections import Counter
+from array import array
+from collections import Counter, OrderedDict, deque
 from pathlib import Path
-from typing import List, Set, Optional, Dict
+from typing import List, Set, Optional, Dict, Tuple
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 # ==========================================
 # Optional Dependencies
@@ -262,7 +445,7 @@ except ImportError:
     pass
 
 try:
-    from tree_sitter_languages import get_parser
+    from tree_sitter_languages import get_parser, get_language
     HAS_TREESITTER = True
 except ImportError:
     pass
@@ -289,6 +472,17 @@ TREESITTER_EXT_MAP = {
     '.html': 'html',
 }
 
+@functools.lru_cache(maxsize=(os.cpu_count() or 4) * 2)
+def parse_treesitter(content: str, lang_name: str):
+    """
+    Tree-sitterでの解析結果 (tree, content_bytes) を返す。
+    同じ内容を アウトライン/シンボル/タグ/Focus で使い回すため、内容単位でキャッシュして1回だけ解析する。
+    """
+    parser = get_parser(lang_name)
+    content_bytes = content.encode('utf-8')
+    PROFILER.count_parse(f"tree-sitter:{lang_name}")
+    return parser.parse(content_bytes), content_bytes
+
 # ==========================================
 # Config
 # ==========================================
@@ -306,10 +500,11 @@ DEFAULT_PREVIEW_EXTS = [
     '.dockerfile', 'Dockerfile', '.toml', '.ini'
 ]
 
-def parse_args():
+def build_arg_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="LLM共有用プロジェクトダンプツール")
     
-    parser.add_argument('--path', '-p', default='.', help='対象ディレクトリパス')
+    parser.add_argument('--path', '-p', nargs='+', default=['.'], help='対象ディレクトリパス (複数指定可: 並列に走査し、キャッシュと検索インデックスを共有 / .zip .tar .tar.gz は展開せずに読み込み)')
+    parser.add_argument('--cache-dir', default='', help='キャッシュの保存先 (未指定時: 単一ルートはルート直下、複数ルートは共通の親ディレクトリ)')
     parser.add_argument('--exclude', '-e', nargs='*', default=DEFAULT_EXCLUDES, help='除外パターン')
     parser.add_argument('--outfile', '-o', default='', help='出力先ファイルパス')
     parser.add_argument('--directories-only', action='store_true', help='ファイルを含めずディレクトリ構造のみ出力')
@@ -317,54 +512,262 @@ def parse_args():
     
     parser.add_argument('--preview-exts', nargs='*', default=DEFAULT_PREVIEW_EXTS, help='対象拡張子')
     parser.add_argument('--preview-lines', type=int, default=2000, help='最大行数')
+    parser.add_argument('--max-file-tokens', type=int, default=0, help='1ファイルあたりの最大トークン数。超えるファイルは先頭と末尾を(定義単位で)残して中間を省略する (指定時は --preview-lines の代わりに使用)')
     parser.add_argument('--max-preview-size-mb', type=float, default=1.0, help='最大サイズ(MB)')
     
     parser.add_argument('--git-filter', choices=['None', 'Tracked', 'Staged', 'Modified'], default='None', help='Git状態フィルタ')
+    parser.add_argument('--rev', default='', help='作業ツリーの代わりに指定したGitリビジョン(ブランチ/タグ/コミット)の内容をチェックアウトせずに出力')
+    parser.add_argument('--snapshot', default=None, metavar='NAME', help='出力したファイルのパスと内容ハッシュを名前付きで記録する (--since で差分ダンプの基準にする)')
+    parser.add_argument('--since', default=None, metavar='NAME', help='スナップショット NAME 以降に追加・変更・削除されたファイルのみを、ツリー差分付きで出力する')
+    parser.add_argument('--hunks', action='store_true', help='--git-filter Staged/Modified 時、変更箇所を含む定義(関数/クラス)のみを変更行の印付きで出力')
     
     parser.add_argument('--focus', '-f', default=None, help='指定したキーワード(関数名・クラス名)を抽出')
+    parser.add_argument('--grep', default=None, metavar='PATTERN', help='正規表現に一致する行を含むファイルだけを、一致行の周辺のみ出力する (trigram索引で候補を絞り込む)')
+    parser.add_argument('--grep-ignore-case', action='store_true', help='--grep で大文字小文字を区別しない')
+    parser.add_argument('--grep-context', type=int, default=GREP_CONTEXT_LINES, metavar='N', help=f'--grep で一致行の前後に出力する行数 (デフォルト: {GREP_CONTEXT_LINES})')
+    parser.add_argument('--grep-defs', action='store_true', help='--grep で一致行を含む関数/クラス定義全体を出力する')
     parser.add_argument('--resolve-deps', action='store_true', help='Focus時、依存ファイルも含める (要networkx)')
 
     parser.add_argument('--summary-only', action='store_true', help='ファイルの中身の代わりに冒頭の要約コメントのみを出力する')
+    parser.add_argument('--minify', type=int, nargs='?', const=2, default=0, choices=[0, *MINIFY_LEVELS], help='全文出力するコードを縮める (1: 空行の圧縮 / 2: +コメント・docstring削除 / 3: +空行削除・1スペースインデント, 値なしは2)')
+    parser.add_argument('--sample-data', type=float, nargs='?', const=DATA_SAMPLE_DEFAULT_MB, default=None, metavar='MB', help='MBを超えるデータファイル (JSON/NDJSON/CSV/YAML/SQL/ログ) を、先頭と無作為な数箇所だけを読んだ構造のプレビュー (スキーマ・レコード例・DDL) にする (値なしは1.0)')
+    parser.add_argument('--depth-summary', type=int, default=None, metavar='N', help='深さN (ルート=0) のディレクトリを配下ごと1つのロールアップ (件数・上位タグ・子要素の1行要約) にまとめる')
     parser.add_argument('--outline', action='store_true', help='ファイルの中身の代わりに関数やクラスのシグネチャ(アウトライン)を抽出して出力する')
     parser.add_argument('--smart-context', action='store_true', help='対象ファイルの依存先ファイルを自動検出し、アウトライン形式でコンテキストに追加する')
     parser.add_argument('--interactive', '-i', action='store_true', help='対話モード: ヒットしたファイルの出力形式を個別に選択する')
     parser.add_argument('--search', '-s', default=None, help='自然言語クエリで要約やタグをBM25検索し、関連ファイルを出力する')
     parser.add_argument('--search-full', action='store_true', help='検索対象を「要約+タグ」だけでなく「ファイル全体（全文）」に拡張する')
+    parser.add_argument('--search-chunks', action='store_true', help='ファイルを関数/クラス単位のチャンクに分割して検索し、ヒットしたチャンクのみを出力する')
     parser.add_argument('--semantic-search', action='store_true', help='ONNXによる意味検索（セマンティック検索）を有効化')
+    parser.add_argument('--onnx-threads', type=int, default=0, help='意味検索の推論スレッド数 (intra-op, 0で自動: CPU数と4の小さい方)')
+    parser.add_argument('--onnx-inter-threads', type=int, default=1, help='意味検索の演算子間の並列スレッド数 (inter-op, --onnx-execution-mode parallel 時のみ有効, デフォルト: 1)')
+    parser.add_argument('--onnx-execution-mode', choices=['sequential', 'parallel'], default='sequential', help='ONNXグラフの実行方式 (デフォルト: sequential)')
     parser.add_argument('--full', nargs='*', default=[], help='全体を要約出力にする場合でも、指定したファイル名を含む場合は詳細(全文)を出力する')
     parser.add_argument('--top-k', type=int, default=5, help='検索時に関連度の高い上位N件のみを抽出する（デフォルト: 5）')
+    parser.add_argument('--rerank-candidates', type=int, default=50, help='意味検索時、BM25/トライグラムで絞り込んだ上位N件のみをONNXで再採点する (0で全件, デフォルト: 50)')
+    parser.add_argument('--prefilter', choices=['bm25', 'trigram'], default='bm25', help='意味検索の候補抽出に使う軽量スコアラー (デフォルト: bm25)')
+    parser.add_argument('--fusion', choices=['linear', 'rrf'], default='linear', help='BM25とONNXスコアの統合方法: linear=0.3/0.7の線形結合, rrf=Reciprocal Rank Fusion')
 
     parser.add_argument('--tag', nargs='*', help='指定したタグを完全に含むファイルのみを厳密に抽出する')
     parser.add_argument('--vocab-file', default='README.md', help='プロジェクト全体の共通タグ（ドメイン用語集）を抽出するためのファイル')
+    parser.add_argument('--serve', action='store_true', help='常駐モード: インデックスを保持したまま標準入出力で JSON-RPC のツール呼び出し (search/focus/grep/outline/summary/read_range/tree) を受け付ける')
+    parser.add_argument('--page-size', type=int, default=20000, help='--serve 時、1回の応答で返す最大文字数 (超える結果はページ分割, デフォルト: 20000)')
     parser.add_argument('--dry-run', action='store_true', help='ファイルを出力せず、検索や抽出の結果（対象ファイル一覧とタグ）のみをターミナルに表示する')
     
     parser.add_argument('--copy', '-c', action='store_true', help='クリップボードにコピー (要pyperclip)')
     parser.add_argument('--model', default='gpt-4o', help='トークン計算モデル (要tiktoken)')
     parser.add_argument('--debug', action='store_true', help='デバッグログ')
+    parser.add_argument('--profile', nargs='?', const='-', default=None, help='フェーズ別の処理時間・キャッシュヒット率などをJSONで出力 (ファイル指定なしで標準エラー出力)')
+    parser.add_argument('--profile-top', type=int, default=5, help='--profile で表示する、フェーズ別の遅いファイルの件数 (デフォルト: 5)')
+    parser.add_argument('--walk-threads', type=int, default=1, help='ディレクトリ走査のスレッド数 (2以上でワークスティーリング方式の並列走査。NFS/SMB 等で有効, デフォルト: 1)')
+    parser.add_argument('--rescan', action='store_true', help='ディレクトリのマニフェストを信用せず、全ディレクトリを一覧し直す')
     parser.add_argument('--use-gitignore', action='store_true', help='.gitignoreのパターンを除外リストに追加')
 
     parser.add_argument('--tree', action='store_true', help='視覚的なツリー形式で出力（ファイルの中身は省略されます）')
 
     parser.add_argument('--text', action='store_true', help='Markdown風のテキスト形式で出力（トークン節約）')
+    parser.add_argument('--split-tokens', type=int, default=0, help='出力を1パートあたりN トークン以内に、ファイル/ディレクトリの境界で分割する (-o は連番ファイル, -c は1パートずつコピー)')
+    parser.add_argument('--no-dedup', action='store_true', help='内容が同一のファイルも参照(same_as)にまとめず、すべて本文を出力する')
+    parser.add_argument('--near-dup', nargs='?', type=float, const=0.8, default=None, help='類似度(推定Jaccard)が閾値以上のファイルを代表1件+差分にまとめる (閾値省略時: 0.8)')
 
-    return parser.parse_args()
+    return parser
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    if args.grep is not None:
+        try:
+            re.compile(args.grep)
+        except re.error as e:
+            parser.error(f"--grep の正規表現が不正です: {e}")
+    if args.grep_context < 0:
+        parser.error("--grep-context には0以上の整数を指定してください")
+    if args.depth_summary is not None and args.depth_summary < 0:
+        parser.error("--depth-summary には0以上の整数を指定してください")
+    if args.sample_data is not None and args.sample_data < 0:
+        parser.error("--sample-data には0以上のサイズ(MB)を指定してください")
+    if args.walk_threads < 1:
+        parser.error("--walk-threads には1以上の整数を指定してください")
+    if args.max_file_tokens < 0:
+        parser.error("--max-file-tokens には正の整数を指定してください")
+    if args.split_tokens < 0:
+        parser.error("--split-tokens には正の整数を指定してください")
+    if args.hunks and args.git_filter not in ('Staged', 'Modified'):
+        parser.error("--hunks は --git-filter Staged または Modified と併用してください")
+    if args.rev and args.git_filter != 'None':
+        parser.error("--rev と --git-filter は併用できません")
+    return args
+
+_START_TIME = time.perf_counter()
 
 def log_debug(msg: str, is_debug: bool):
     if is_debug:
-        print(f"[DEBUG] {msg}", file=sys.stderr)
+        print(f"[DEBUG +{time.perf_counter() - _START_TIME:.3f}s] {msg}", file=sys.stderr)
+
+def _peak_rss_mb() -> Optional[float]:
+    """プロセスの最大常駐メモリ(MB)。取得できない環境では None"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux は KB 単位、macOS はバイト単位
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize / (1024 * 1024)
+    except Exception:
+        pass
+    return None
+
+class Profiler:
+    """
+    処理フェーズ(walk, read, summarize ...)ごとの Wall/CPU 時間、読み込み量、キャッシュのヒット率、
+    言語別のパース回数、フェーズ別の遅いファイル上位N件を集計する。無効時は何もしない。
+    ※ CPU時間はプロセス全体の値のため、並列フェーズではスレッド分も含まれます。
+    ※ 並列段の中でファイル単位に計測する処理 (timed: summarize 等) は、ファイルごとの時間の合計も集計し、
+       独立したフェーズとして計測していなければ phase_totals() にフェーズとして加えます。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.top_n = 5
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.wall: Dict[str, float] = {}
+        self.cpu: Dict[str, float] = {}
+        self.counters: Counter = Counter()
+        self.cache: Dict[str, Counter] = {}
+        self.parses: Counter = Counter()
+        self.slowest: Dict[str, List[tuple]] = {}
+        self.file_wall: Dict[str, float] = {}
+        self.file_cpu: Dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.wall[name] = self.wall.get(name, 0.0) + (time.perf_counter() - start)
+                self.cpu[name] = self.cpu.get(name, 0.0) + (time.process_time() - cpu_start)
+
+    def timed(self, phase: str, label: str, fn, *fn_args):
+        """fn(*fn_args) を実行し、ファイル単位の所要時間をフェーズ別ランキングに記録する"""
+        if not self.enabled:
+            return fn(*fn_args)
+        start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            return fn(*fn_args)
+        finally:
+            elapsed = time.perf_counter() - start
+            cpu = time.thread_time() - cpu_start
+            with self._lock:
+                self.file_wall[phase] = self.file_wall.get(phase, 0.0) + elapsed
+                self.file_cpu[phase] = self.file_cpu.get(phase, 0.0) + cpu
+                ranking = self.slowest.setdefault(phase, [])
+                if len(ranking) < self.top_n:
+                    heapq.heappush(ranking, (elapsed, label))
+                elif elapsed > ranking[0][0]:
+                    heapq.heapreplace(ranking, (elapsed, label))
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += n
+
+    def cache_event(self, artifact: str, hit: bool, n: int = 1):
+        if self.enabled:
+            with self._lock:
+                self.cache.setdefault(artifact, Counter())["hit" if hit else "miss"] += n
+
+    def count_parse(self, parser_name: str):
+        if self.enabled:
+            with self._lock:
+                self.parses[parser_name] += 1
+
+    def phase_totals(self) -> Dict[str, Dict]:
+        """
+        フェーズ別の {"wall_s", "cpu_s"}。読み込み段に含まれる summarize のように、ファイル単位でのみ計測した処理は
+        ファイルごとの時間の合計 (並列時は実時間より大きくなり得る) を "per_file_sum": True 付きで加える
+        """
+        totals = {name: {"wall_s": round(self.wall[name], 6), "cpu_s": round(self.cpu.get(name, 0.0), 6)} for name in self.wall}
+        for name, wall in self.file_wall.items():
+            if name not in totals:
+                totals[name] = {"wall_s": round(wall, 6), "cpu_s": round(self.file_cpu.get(name, 0.0), 6), "per_file_sum": True}
+        return totals
+
+    def report(self) -> Dict:
+        peak_rss = _peak_rss_mb()
+        return {
+            "phases": self.phase_totals(),
+            "counters": dict(self.counters),
+            "cache": {name: {"hit": c["hit"], "miss": c["miss"]} for name, c in sorted(self.cache.items())},
+            "parses": dict(sorted(self.parses.items())),
+            "peak_rss_mb": round(peak_rss, 1) if peak_rss is not None else None,
+            "slowest_files": {
+                phase: [{"file": label, "seconds": round(sec, 6)} for sec, label in sorted(ranking, reverse=True)]
+                for phase, ranking in self.slowest.items()
+            },
+        }
+
+    def emit(self, destination: str):
+        """プロファイル結果をJSONで出力する ('-' なら標準エラー出力)"""
+        report = json.dumps(self.report(), ensure_ascii=False, indent=2)
+        if destination == '-':
+            print(f"[Profile]\n{report}", file=sys.stderr)
+        else:
+            with open(destination, 'w', encoding='utf-8') as f:
+                f.write(report)
+            print(f"Profile saved to {destination}", file=sys.stderr)
+
+# --profile やベンチマーク (bench_sp_tree.py) から有効化して参照する
+PROFILER = Profiler()
 
 # ==========================================
 # 0. Cache Management
 # ==========================================
 CACHE_FILE_NAME = ".context_cache.json"
+CACHE_VERSION = 3
+# 大きな成果物 (ファイルごとに数KB〜本文と同程度) は .context_cache.json に入れず、BLOB_DB_NAME に置いて必要な分だけ引く
+BLOB_DB_NAME = ".context_cache.db"
+LAZY_ARTIFACTS = {"chunks", "minhash", "minify", "outline", "sample", "tokens"}
+# trigram 索引は専用のファイルに、圧縮済みのバイト列のまま (JSON・base64 を介さずに) 置く
+INDEX_DB_NAME = ".context_trigrams.db"
+INDEX_ARTIFACTS = {"trigrams"}
+BLOB_FLUSH_EVERY = 256  # 新しい成果物をまとめて書き込む件数 (メモリに溜める量の上限)
 
 def load_cache(root_path: Path, is_debug: bool) -> Dict:
     cache_path = root_path / CACHE_FILE_NAME
     if cache_path.exists():
         try:
             with open(cache_path, 'r', encoding='utf-8') as f:
-                log_debug(f"Loaded cache from {cache_path}", is_debug)
-                return json.load(f)
+                data = json.load(f)
+            # 旧形式 (パス -> mtime/要約) のキャッシュは互換性がないため破棄して作り直す
+            if data.get("version") != CACHE_VERSION:
+                log_debug(f"Discarding cache with old format: {cache_path}", is_debug)
+                return {}
+            log_debug(f"Loaded cache from {cache_path}", is_debug)
+            return data
         except Exception as e:
             log_debug(f"Failed to load cache: {e}", is_debug)
     return {}
@@ -373,11 +776,200 @@ def save_cache(root_path: Path, cache_data: Dict, is_debug: bool):
     cache_path = root_path / CACHE_FILE_NAME
     try:
         with open(cache_path, 'w', encoding='utf-8') as f:
-            json.dump(cache_data, f, ensure_ascii=False, indent=2)
+            json.dump(cache_data, f, ensure_ascii=False, separators=(',', ':'))
         log_debug(f"Saved cache to {cache_path}", is_debug)
     except Exception as e:
         log_debug(f"Failed to save cache: {e}", is_debug)
 
+def compute_content_key(content: str) -> str:
+    """ファイル内容のハッシュ (キャッシュキー)"""
+    return hashlib.sha1(content.encode('utf-8', errors='surrogatepass')).hexdigest()
+
+# 本文なし (空・読み込み失敗・サイズ超過・プレビュー対象外) のファイルのキー
+EMPTY_CONTENT_KEY = compute_content_key("")
+
+class BlobStore:
+    """
+    (キー, 成果物名) -> bytes の永続ストア (SQLite)。.context_cache.json と違って起動時に全体を読み込まず、
+    要求された1件ずつを引く。新しい値は BLOB_FLUSH_EVERY 件ずつまとめて書き込む。
+    ファイルは最初に使われた時点で開き、開けない場合はキャッシュなしとして動作を続ける。
+    読み込み段のワーカーから並列に呼ばれるため、操作はロックで直列化する。
+    """
+
+    def __init__(self, path: Path, is_debug: bool = False):
+        self.path = path
+        self.is_debug = is_debug
+        self._conn: Optional[sqlite3.Connection] = None
+        self._failed = False
+        self._pending: Dict[Tuple[str, str], bytes] = {}
+        self._lock = threading.Lock()
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if self._conn is None and not self._failed:
+            try:
+                self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+                self._conn.execute("CREATE TABLE IF NOT EXISTS blobs (key TEXT, name TEXT, value BLOB, PRIMARY KEY (key, name)) WITHOUT ROWID")
+            except sqlite3.Error as e:
+                log_debug(f"Failed to open {self.path}: {e}", self.is_debug)
+                self._failed, self._conn = True, None
+        return self._conn
+
+    def get(self, key: str, name: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._pending.get((key, name))
+            if value is not None:
+                return value
+            conn = self._connect()
+            if conn is None:
+                return None
+            try:
+                row = conn.execute("SELECT value FROM blobs WHERE key = ? AND name = ?", (key, name)).fetchone()
+            except sqlite3.Error:
+                return None
+            return row[0] if row else None
+
+    def put(self, key: str, name: str, value: bytes):
+        with self._lock:
+            self._pending[(key, name)] = value
+            if len(self._pending) >= BLOB_FLUSH_EVERY:
+                self._flush()
+
+    def _flush(self):
+        conn = self._connect() if self._pending else None
+        if conn is not None:
+            try:
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)",
+                                     [(key, name, value) for (key, name), value in self._pending.items()])
+            except sqlite3.Error as e:
+                log_debug(f"Failed to write {self.path}: {e}", self.is_debug)
+        self._pending.clear()
+
+    def prune(self, live_keys: Set[str]):
+        """溜めた値を書き込み、live_keys 以外のキーの成果物を削除する (今回開いていなくても、ファイルがあれば整理する)"""
+        with self._lock:
+            self._flush()
+            if self._conn is None and not self.path.exists():
+                return
+            conn = self._connect()
+            if conn is None:
+                return
+            try:
+                with conn:
+                    conn.execute("CREATE TEMP TABLE IF NOT EXISTS live (key TEXT PRIMARY KEY)")
+                    conn.execute("DELETE FROM live")
+                    conn.executemany("INSERT OR IGNORE INTO live VALUES (?)", ((k,) for k in live_keys))
+                    conn.execute("DELETE FROM blobs WHERE key NOT IN (SELECT key FROM live)")
+            except sqlite3.Error as e:
+                log_debug(f"Failed to prune {self.path}: {e}", self.is_debug)
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class ArtifactCache:
+    """
+    コンテンツハッシュをキーにした解析結果(要約・タグ等)の共有キャッシュ。
+    同一内容のファイルは、パスやルートが異なっても一度しか解析しない。
+    LAZY_ARTIFACTS の成果物は blobs (BlobStore) に JSON で、INDEX_ARTIFACTS (bytes) は index にそのまま置き、
+    要求された分だけ読み込む。index がない場合、INDEX_ARTIFACTS は保存せずに毎回計算する。
+
+    構造: {"version", "files": {絶対パス: {"mtime", "size", "key"}}, "artifacts": {キー: {成果物名: 値}}}
+    """
+
+    def __init__(self, data: Dict, blobs: Optional[BlobStore] = None, index: Optional[BlobStore] = None):
+        self.data = data
+        self.data["version"] = CACHE_VERSION
+        self.files: Dict[str, Dict] = self.data.setdefault("files", {})
+        self.artifacts: Dict[str, Dict] = self.data.setdefault("artifacts", {})
+        self.blobs = blobs
+        self.index = index
+        self.live_keys: Set[str] = set()
+        self.seen_paths: Set[str] = set()
+
+    def key_for(self, path: Path, content, stat: Optional[Tuple[float, int]] = None) -> str:
+        """
+        ファイルのキャッシュキーを返す。stat(mtime, size)が一致すればハッシュ計算を省略する
+        (content に本文を返す関数を渡せば、一致した場合は読み込み自体も省略される。
+         stat に走査時の (mtime, size) を渡せば、ファイルごとの stat も省略される)
+        """
+        path_str = str(path)
+        self.seen_paths.add(path_str)
+        if stat is not None:
+            mtime, size = stat
+        else:
+            try:
+                st = path.stat()
+                mtime, size = st.st_mtime, st.st_size
+            except Exception:
+                mtime, size = 0, -1
+        record = self.files.get(path_str)
+        if record and record.get("mtime") == mtime and record.get("size") == size and mtime:
+            PROFILER.cache_event("content_key", True)
+            key = record["key"]
+        else:
+            PROFILER.cache_event("content_key", False)
+            key = compute_content_key(_materialize(content))
+            self.files[path_str] = {"mtime": mtime, "size": size, "key": key}
+        return key
+
+    def rekey(self, path: Path, content: str) -> str:
+        """記録済みのキーが本文と合わない場合 (プレビュー対象やサイズ上限の変更時) にキーを付け直す"""
+        key = compute_content_key(content)
+        record = self.files.get(str(path))
+        if record:
+            record["key"] = key
+        return key
+
+    def get_or_compute(self, key: str, name: str, compute):
+        """成果物を取得し、なければ compute() の結果を保存して返す"""
+        self.live_keys.add(key)
+        artifact = name.split(':')[0]
+        if artifact in INDEX_ARTIFACTS:
+            if self.index is None:
+                return compute()
+            value = self.index.get(key, name)
+            PROFILER.cache_event(artifact, value is not None)
+            if value is None:
+                value = compute()
+                self.index.put(key, name, value)
+            return value
+        if self.blobs is not None and artifact in LAZY_ARTIFACTS:
+            raw = self.blobs.get(key, name)
+            PROFILER.cache_event(artifact, raw is not None)
+            if raw is not None:
+                return json.loads(raw)
+            value = compute()
+            self.blobs.put(key, name, json.dumps(value, ensure_ascii=False).encode('utf-8'))
+            return value
+        entry = self.artifacts.setdefault(key, {})
+        if name in entry:
+            PROFILER.cache_event(name.split(':')[0], True)
+            return entry[name]
+        PROFILER.cache_event(name.split(':')[0], False)
+        value = compute()
+        entry[name] = value
+        return value
+
+    def prune(self):
+        """消えたファイルの記録と、どのファイルからも参照されなくなった成果物を削除する"""
+        for path_str in [p for p in self.files if p not in self.seen_paths and not os.path.exists(p)]:
+            del self.files[path_str]
+        referenced = {r.get("key") for r in self.files.values()} | self.live_keys
+        for key in [k for k in self.artifacts if k not in referenced]:
+            del self.artifacts[key]
+        for store in (self.blobs, self.index):
+            if store is not None:
+                store.prune(referenced)
+
+    def close(self):
+        for store in (self.blobs, self.index):
+            if store is not None:
+                store.close()
+
 # ==========================================
 # 1. Dependency Analysis (Graph Logic)
 # ==========================================
@@ -388,6 +980,7 @@ def extract_imports(file_path: Path, content: str) -> Set[str]:
 
     if ext == '.py':
         try:
+            PROFILER.count_parse("ast:python")
             tree = ast.parse(content)
             for node in ast.walk(tree):
                 if isinstance(node, ast.Import):
@@ -411,15 +1004,16 @@ def extract_imports(file_path: Path, content: str) -> Set[str]:
                 imports.add(os.path.basename(m).split('.')[0])
     return imports
 
-def build_dependency_graph(file_map: Dict[Path, str], is_debug: bool):
+def build_dependency_graph(file_imports: Dict[Path, List[str]], is_debug: bool):
+    """file_imports: {ファイル: extract_imports の結果} (読み込み段で抽出済みのもの)"""
     if not HAS_NETWORKX:
         return None
     G = nx.DiGraph()
-    name_to_path = {p.stem: p for p in file_map.keys()}
+    name_to_path = {p.stem: p for p in file_imports.keys()}
     
     log_debug("Building dependency graph...", is_debug)
-    for path, content in file_map.items():
-        for name in extract_imports(path, content):
+    for path, names in file_imports.items():
+        for name in names:
             if name in name_to_path and name_to_path[name] != path:
                 G.add_edge(path, name_to_path[name])
     return G
@@ -446,9 +1040,7 @@ def extract_code_block_treesitter(content: str, ext: str, keyword: str) -> Optio
         return None
 
     try:
-        parser = get_parser(lang_name)
-        content_bytes = content.encode('utf-8')
-        tree = parser.parse(content_bytes)
+        tree, content_bytes = parse_treesitter(content, lang_name)
         
         extracted_parts = []
         
@@ -490,6 +1082,7 @@ def extract_code_block_treesitter(content: str, ext: str, keyword: str) -> Optio
 def extract_code_block_ast(code: str, keyword: str) -> Optional[str]:
     """Python AST fallback"""
     try:
+        PROFILER.count_parse("ast:python")
         tree = ast.parse(code)
         lines = code.splitlines()
         extracted = []
@@ -606,35 +1199,85 @@ def extract_summary(content: str, ext: str, is_debug: bool = False) -> str:
 # ==========================================
 # 3.5.5. TF-IDF & Global Vocabulary Helpers
 # ==========================================
-def compute_idf(documents: List[str]) -> Dict[str, float]:
-    """コーパス全体から各単語の希少性(IDF)を計算する"""
-    doc_count = len(documents)
-    df = Counter()
+def summary_terms(doc: str) -> Set[str]:
+    """DF集計用: 要約に含まれる単語の集合 (ストップワード除外)"""
     stop_words = {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'is', 'are', 'was', 'were', 'it', 'this', 'that'}
-    for doc in documents:
-        if not doc: continue
-        words = set([w.lower() for w in re.findall(r'\b[a-zA-Z_][a-zA-Z0-9_]{2,}\b', doc)])
-        words = words - stop_words
-        df.update(words)
-    
+    words = set([w.lower() for w in re.findall(r'\b[a-zA-Z_][a-zA-Z0-9_]{2,}\b', doc)]) if doc else set()
+    return words - stop_words
+
+def idf_from_df(df: Dict[str, int], doc_count: int) -> Dict[str, float]:
     idf = {}
     for word, count in df.items():
         # ゼロ除算回避とスムージングを入れたIDF
         idf[word] = math.log(doc_count / (1 + count)) + 1.0
     return idf
 
-def build_global_vocab(vocab_path: Path, is_debug: bool) -> Set[str]:
-    """READMEなどからプロジェクト特有の重要語彙を抽出する"""
+def compute_idf(documents: List[str]) -> Dict[str, float]:
+    """コーパス全体から各単語の希少性(IDF)を計算する"""
+    df = Counter()
+    for doc in documents:
+        df.update(summary_terms(doc))
+    return idf_from_df(df, len(documents))
+
+class CorpusStats:
+    """
+    TF-IDF用の文書頻度(DF)を永続化し、前回から内容が変わった文書の差分だけで更新する。
+    構造: cache_data["corpus"] = {"docs": {パス: 内容キー}, "df": {単語: 文書数}}
+    各文書の単語集合は内容キー単位の成果物 "terms" として保持し、消えた・変わった文書の引き算に使う。
+    """
+
+    def __init__(self, data: Dict, cache: ArtifactCache):
+        self.data = data.setdefault("corpus", {})
+        self.cache = cache
+
+    def _terms(self, key: str, summary: str) -> List[str]:
+        return self.cache.get_or_compute(key, "terms", lambda: sorted(summary_terms(summary)))
+
+    def update(self, docs: Dict[str, Tuple[str, str]]) -> Dict[str, float]:
+        """docs: {パス: (内容キー, 要約)} を現在のコーパスとしてDFを更新し、IDFを返す"""
+        prev: Dict[str, str] = self.data.get("docs", {})
+        df = Counter(self.data.get("df", {}))
+        changed = [path for path, (key, _) in docs.items() if prev.get(path) != key]
+        removed = [(path, key) for path, key in prev.items() if docs.get(path, (None,))[0] != key]
+
+        old_terms = [self.cache.artifacts.get(key, {}).get("terms") for _, key in removed]
+        if any(terms is None for terms in old_terms):
+            # 引き算に必要な単語集合が残っていなければ全件から作り直す
+            df, changed = Counter(), list(docs)
+        else:
+            for terms in old_terms:
+                df.subtract(terms)
+        for path in changed:
+            key, summary = docs[path]
+            df.update(self._terms(key, summary))
+        for path, (key, _) in docs.items():
+            self.cache.live_keys.add(key)
+
+        df = +df  # 0以下になった単語を除く
+        PROFILER.count("df_docs_updated", len(changed))
+        PROFILER.count("df_docs_removed", len(removed))
+        self.data["docs"] = {path: key for path, (key, _) in docs.items()}
+        self.data["df"] = dict(df)
+        return idf_from_df(df, len(docs))
+
+def extract_vocab(content: str) -> List[str]:
+    """READMEなどの本文から、出現頻度上位50件をドメイン用語（共通タグ）として抽出する"""
+    stop_words = {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'is', 'are', 'was', 'were', 'it', 'this', 'that'}
+    words = [w.lower() for w in re.findall(r'\b[a-zA-Z_][a-zA-Z0-9_]{2,}\b', content)]
+    filtered = [w for w in words if w not in stop_words]
+    return [w for w, c in Counter(filtered).most_common(50)]
+
+def build_global_vocab(vocab_path: Path, is_debug: bool, cache: Optional[ArtifactCache] = None) -> Set[str]:
+    """READMEなどからプロジェクト特有の重要語彙を抽出する (cache 指定時は語彙ファイルの内容ハッシュ単位で再利用)"""
     if not vocab_path.exists():
         log_debug(f"Global vocab file not found: {vocab_path}", is_debug)
         return set()
     try:
         content = vocab_path.read_text(encoding='utf-8', errors='ignore')
-        stop_words = {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'is', 'are', 'was', 'were', 'it', 'this', 'that'}
-        words = [w.lower() for w in re.findall(r'\b[a-zA-Z_][a-zA-Z0-9_]{2,}\b', content)]
-        filtered = [w for w in words if w not in stop_words]
-        # 出現頻度上位50件をドメイン用語（共通タグ）としてセット
-        top_words = {w for w, c in Counter(filtered).most_common(50)}
+        if cache is not None:
+            top_words = set(cache.get_or_compute(cache.key_for(vocab_path, content), "vocab", lambda: extract_vocab(content)))
+        else:
+            top_words = set(extract_vocab(content))
         log_debug(f"Loaded global vocab from {vocab_path.name}: {len(top_words)} words", is_debug)
         return top_words
     except Exception as e:
@@ -682,9 +1325,7 @@ def extract_tags(content: str, summary: str, ext: str, is_debug: bool = False, g
         lang_name = TREESITTER_EXT_MAP.get(ext)
         if lang_name:
             try:
-                parser = get_parser(lang_name)
-                content_bytes = content.encode('utf-8')
-                tree = parser.parse(content_bytes)
+                tree, content_bytes = parse_treesitter(content, lang_name)
                 
                 # 定義とみなすキーワード
                 DEF_KEYWORDS = {'function', 'method', 'class', 'struct', 'interface'}
@@ -715,6 +1356,7 @@ def extract_tags(content: str, summary: str, ext: str, is_debug: bool = False, g
     # 2. Python ASTによる抽出 (フォールバック)
     if ext == '.py':
         try:
+            PROFILER.count_parse("ast:python")
             tree = ast.parse(content)
             for node in ast.walk(tree):
                 if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
@@ -740,31 +1382,326 @@ def extract_tags(content: str, summary: str, ext: str, is_debug: bool = False, g
 
     return sorted(list(tags))
 
+# ==========================================
+# 3.6.4. Cached File Analysis (Summary / Tags)
+# ==========================================
+def _materialize(content) -> str:
+    """本文、または本文を返す関数 (キャッシュにない時だけ読み込むための遅延指定) を文字列にする"""
+    return content() if callable(content) else content
+
+def get_file_summary(cache: ArtifactCache, key: str, content, ext: str) -> str:
+    """要約を内容ハッシュ単位でキャッシュから取得 (未計算なら抽出。content は本文か、本文を返す関数)"""
+    return cache.get_or_compute(key, "summary", lambda: extract_summary(_materialize(content), ext, False))
+
+def get_file_tags(cache: ArtifactCache, key: str, content, ext: str, summary: str,
+                  global_vocab: Set[str], idf_dict: Dict[str, float], is_debug: bool = False) -> List[str]:
+    """タグを内容ハッシュ単位でキャッシュから取得 (言語判定が拡張子依存のため、成果物名に拡張子を含める)"""
+    return cache.get_or_compute(key, f"tags:{ext}", lambda: extract_tags(_materialize(content), summary, ext, is_debug, global_vocab, idf_dict))
+
+def format_summary_block(summary: str, tags: List[str]) -> str:
+    """要約とタグを出力・検索用の1ブロックにまとめる"""
+    if tags:
+        return f"{summary}\n\n[Tags: {', '.join(tags)}]"
+    return summary
+
+# ==========================================
+# 3.6.4.5. Directory Rollups (--depth-summary)
+# ==========================================
+ROLLUP_TOP_TAGS = 10      # ロールアップに表示するタグの数
+ROLLUP_KEEP_TAGS = 50     # 親ディレクトリへ引き継ぐタグ集計の上限 (キャッシュの肥大化防止)
+ROLLUP_MAX_LINES = 15     # ロールアップに表示する子要素 (ファイル/サブディレクトリ) の1行要約の数
+ROLLUP_LINE_CHARS = 100   # 1行要約の最大文字数
+
+def first_summary_line(summary: str) -> str:
+    """要約の最初の空でない行 (長すぎる場合は切り詰める)"""
+    line = next((l.strip() for l in (summary or "").splitlines() if l.strip()), "")
+    return line if len(line) <= ROLLUP_LINE_CHARS else line[:ROLLUP_LINE_CHARS - 3] + "..."
+
+def rollup_key(entries: List[Tuple[str, str]]) -> str:
+    """子要素の (名前, キー) からディレクトリのキーを作る (子のどれかの内容が変わればキーも変わる)"""
+    return compute_content_key("\n".join(f"{name}\t{key}" for name, key in entries))
+
+def merge_rollup(children: List[Tuple[str, Dict]]) -> Dict:
+    """
+    子要素の集計をディレクトリ1件分のロールアップにまとめる。
+    children: [(名前, 集計)]。ファイルの集計は {"summary", "tags"}、サブディレクトリは merge_rollup の結果。
+    戻り値: {"files", "dirs", "tags": {タグ: 件数}, "lines": [子要素ごとの1行要約]}
+    """
+    tags: Counter = Counter()
+    files = dirs = 0
+    lines = []
+    for name, child in children:
+        if "files" in child:
+            tags.update(child["tags"])
+            files += child["files"]
+            dirs += child["dirs"] + 1
+            top = ", ".join(list(child["tags"])[:5])
+            lines.append(f"{name}/ ({child['files']} files){': ' + top if top else ''}")
+        else:
+            tags.update(child["tags"])
+            files += 1
+            line = first_summary_line(child["summary"])
+            lines.append(f"{name}{': ' + line if line else ''}")
+    return {"files": files, "dirs": dirs, "tags": dict(tags.most_common(ROLLUP_KEEP_TAGS)), "lines": lines}
+
+def format_rollup(rollup: Dict) -> str:
+    """ロールアップを出力用のテキストにする"""
+    out = [f"[Rollup: {rollup['files']} files in {rollup['dirs'] + 1} dirs]"]
+    top = list(rollup["tags"].items())[:ROLLUP_TOP_TAGS]
+    if top:
+        out.append(f"[Top tags: {', '.join(f'{tag} ({n})' for tag, n in top)}]")
+    out.extend(f"- {line}" for line in rollup["lines"][:ROLLUP_MAX_LINES])
+    if len(rollup["lines"]) > ROLLUP_MAX_LINES:
+        out.append(f"- ... (+{len(rollup['lines']) - ROLLUP_MAX_LINES} more)")
+    return "\n".join(out)
+
 # ==========================================
 # 3.6.5. Outline (Signature) Extraction
 # ==========================================
-def extract_outline(content: str, ext: str, is_debug: bool = False) -> str:
-    """ファイルからクラスや関数のシグネチャを抽出し、アウトラインを作成する"""
-    log_debug(f"Extracting outline for extension: {ext}", is_debug)
+# 定義ノードを捕捉する言語ごとのクエリ (@definition: 定義本体, @decorator: デコレータ, @doc: docstring)
+OUTLINE_QUERIES = {
+    'python': """
+        (function_definition) @definition
+        (class_definition) @definition
+        (decorated_definition (decorator) @decorator)
+        (function_definition body: (block . (expression_statement (string) @doc)))
+        (class_definition body: (block . (expression_statement (string) @doc)))
+    """,
+    'javascript': """
+        (function_declaration) @definition
+        (generator_function_declaration) @definition
+        (class_declaration) @definition
+        (method_definition) @definition
+        (lexical_declaration (variable_declarator value: [(arrow_function) (function)])) @definition
+    """,
+    'typescript': """
+        (function_declaration) @definition
+        (generator_function_declaration) @definition
+        (class_declaration) @definition
+        (abstract_class_declaration) @definition
+        (method_definition) @definition
+        (interface_declaration) @definition
+        (type_alias_declaration) @definition
+        (enum_declaration) @definition
+        (lexical_declaration (variable_declarator value: [(arrow_function) (function)])) @definition
+    """,
+    'java': """
+        (class_declaration) @definition
+        (interface_declaration) @definition
+        (enum_declaration) @definition
+        (record_declaration) @definition
+        (method_declaration) @definition
+        (constructor_declaration) @definition
+    """,
+    'go': """
+        (function_declaration) @definition
+        (method_declaration) @definition
+        (type_declaration) @definition
+    """,
+    'rust': """
+        (function_item) @definition
+        (struct_item) @definition
+        (enum_item) @definition
+        (trait_item) @definition
+        (impl_item) @definition
+        (mod_item) @definition
+    """,
+    'c': """
+        (function_definition) @definition
+        (struct_specifier body: (_)) @definition
+    """,
+    'cpp': """
+        (function_definition) @definition
+        (class_specifier body: (_)) @definition
+        (struct_specifier body: (_)) @definition
+        (namespace_definition) @definition
+    """,
+    'c_sharp': """
+        (namespace_declaration) @definition
+        (class_declaration) @definition
+        (interface_declaration) @definition
+        (struct_declaration) @definition
+        (method_declaration) @definition
+        (constructor_declaration) @definition
+    """,
+    'ruby': """
+        (module) @definition
+        (class) @definition
+        (method) @definition
+        (singleton_method) @definition
+    """,
+    'php': """
+        (class_declaration) @definition
+        (interface_declaration) @definition
+        (function_definition) @definition
+        (method_declaration) @definition
+    """,
+}
+
+# Tree-sitterが使えない場合のフォールバック (事前コンパイル済み)
+OUTLINE_PATTERNS = {
+    'js': [
+        re.compile(r'^(export\s+)?(default\s+)?(abstract\s+)?(class|function\*?|interface|type|enum)\s+'),
+        re.compile(r'^(export\s+)?const\s+\w+\s*=\s*(async\s+)?(\(.*?\)|[^=\s]+)\s*=>'),
+    ],
+    'c_like': [
+        re.compile(r'^((public|private|protected|internal|export|func|fn)\s+)?(static\s+)?(class|struct|interface|impl)\s+'),
+        re.compile(r'^((public|private|protected|internal|export|func|fn)\s+)?(static\s+)?[a-zA-Z_]\w*(<.*?>)?\s+[a-zA-Z_]\w*\s*\('),
+    ],
+}
+# 「型 名前(」の形に見えるが定義ではない行 (return foo(...) 等の呼び出し) の先頭語
+NON_DEF_KEYWORDS = {'return', 'else', 'new', 'throw', 'case', 'await', 'yield', 'delete', 'typeof', 'echo', 'goto', 'defer', 'go'}
+# シグネチャ末尾の行コメント (引用符を含まないもののみ)
+TRAILING_COMMENT_PATTERN = re.compile(r'\s*(#|//)[^\'"]*$')
+
+def _join_signature(text: str) -> str:
+    """複数行にまたがるシグネチャを、行コメントを除いて1行にまとめる"""
+    return " ".join(" ".join(TRAILING_COMMENT_PATTERN.sub('', line) for line in text.splitlines()).split())
+
+@functools.lru_cache(maxsize=None)
+def _outline_query(lang_name: str):
+    """言語ごとのクエリを1回だけコンパイルする (未対応・コンパイル失敗時は None)"""
+    source = OUTLINE_QUERIES.get(lang_name)
+    if not source:
+        return None
+    try:
+        return get_language(lang_name).query(source)
+    except Exception:
+        return None
+
+def _comment_first_line(text: str) -> str:
+    for line in text.splitlines():
+        line = line.strip().lstrip('/*#!').rstrip('*/').strip()
+        if line:
+            return line
+    return ""
+
+def _outline_treesitter(content: str, ext: str) -> Optional[str]:
+    lang_name = TREESITTER_EXT_MAP.get(ext)
+    if not HAS_TREESITTER or not lang_name:
+        return None
+    query = _outline_query(lang_name)
+    if query is None:
+        return None
+    try:
+        tree, content_bytes = parse_treesitter(content, lang_name)
+        captures = query.captures(tree.root_node)
+    except Exception:
+        return None
+    if isinstance(captures, dict):  # py-tree-sitter 0.22+ は {capture名: [node]} を返す
+        captures = [(node, name) for name, nodes in captures.items() for node in nodes]
+
+    def text(start, end):
+        return content_bytes[start:end].decode('utf-8', errors='ignore')
+
+    definitions, decorators, docs = {}, {}, {}
+    for node, name in captures:
+        if name == 'definition':
+            definitions[node.id] = node
+        elif name == 'decorator':
+            target = node.parent.child_by_field_name('definition')
+            if target is not None:
+                decorators.setdefault(target.id, []).append(node)
+        elif name == 'doc':
+            # string -> expression_statement -> block -> 定義
+            docs[node.parent.parent.parent.id] = node
+
+    comment_marker = '#' if lang_name in ('python', 'ruby') else '//'
     outlines = []
+    open_ends = []  # 外側の定義の終了位置 (ネストの深さの判定用)
+    for node in sorted(definitions.values(), key=lambda n: (n.start_byte, -n.end_byte)):
+        while open_ends and open_ends[-1] <= node.start_byte:
+            open_ends.pop()
+        indent = "    " * len(open_ends)
+        open_ends.append(node.end_byte)
+
+        # export 文や宣言の外側ラッパーは先頭に含める
+        head = node.parent if node.parent is not None and node.parent.type == 'export_statement' else node
+
+        # シグネチャ = 定義の先頭から本体の直前まで (複数行のシグネチャは1行にまとめる)
+        body = node.child_by_field_name('body')
+        if body is None and node.type == 'lexical_declaration':
+            declarator = node.named_children[0] if node.named_children else None
+            value = declarator.child_by_field_name('value') if declarator is not None else None
+            body = value.child_by_field_name('body') if value is not None else None
+        if body is not None and body.start_byte > node.start_byte:
+            signature = _join_signature(text(head.start_byte, body.start_byte))
+        else:
+            signature = " ".join(text(head.start_byte, head.end_byte).splitlines()[0].split())
+
+        doc = docs.get(node.id)
+        if doc is None and lang_name != 'python':
+            prev = head.prev_named_sibling
+            if prev is not None and 'comment' in prev.type and prev.end_point[0] >= head.start_point[0] - 1:
+                doc = prev
+
+        if doc is not None and lang_name != 'python':
+            first = _comment_first_line(text(doc.start_byte, doc.end_byte))
+            if first:
+                outlines.append(f"{indent}{comment_marker} {first}")
+        for deco in decorators.get(node.id, []):
+            outlines.append(f"{indent}{' '.join(text(deco.start_byte, deco.end_byte).split())}")
+
+        if body is None and signature.endswith('{'):
+            outlines.append(f"{indent}{signature[:-1].rstrip()} {{ ... }}")
+        elif body is None:
+            outlines.append(f"{indent}{signature}")
+        elif signature.endswith(':') or lang_name in ('python', 'ruby'):
+            outlines.append(f"{indent}{signature} ...")
+        else:
+            outlines.append(f"{indent}{signature} {{ ... }}")
+
+        if doc is not None and lang_name == 'python':
+            first = _comment_first_line(text(doc.start_byte, doc.end_byte).strip('"\'').strip())
+            if first:
+                outlines.append(f'{indent}    """{first}"""')
+    return "\n".join(outlines)
+
+def _outline_ast(content: str) -> Optional[str]:
+    """Python用: ASTからデコレータ・複数行シグネチャ・docstring先頭行を含むアウトラインを作る"""
+    try:
+        PROFILER.count_parse("ast:python")
+        tree = ast.parse(content)
+    except Exception:
+        return None
     lines = content.splitlines()
+    outlines = []
 
-    if ext == '.py':
-        # Python: class, def, async def の行を抽出
-        for line in lines:
-            if re.match(r'^\s*(class|def|async\s+def)\s+', line):
-                clean_line = line.rstrip()
-                if clean_line.endswith(':'):
-                    outlines.append(f"{clean_line} ...")
-                else:
-                    outlines.append(f"{clean_line}: ...")
+    def visit(node, depth):
+        for child in ast.iter_child_nodes(node):
+            if not isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                visit(child, depth)
+                continue
+            indent = "    " * depth
+            for deco in child.decorator_list:
+                outlines.append(f"{indent}@{' '.join((ast.get_source_segment(content, deco) or '').split())}")
+            # シグネチャ = 定義行から本体の直前まで (複数行のシグネチャは1行にまとめる)
+            first_stmt = child.body[0]
+            if first_stmt.lineno == child.lineno:  # def f(): return 1 のような1行定義
+                sig_lines = [lines[child.lineno - 1][:first_stmt.col_offset]]
+            else:
+                sig_lines = lines[child.lineno - 1:first_stmt.lineno - 1]
+            signature = _join_signature("\n".join(sig_lines))
+            outlines.append(f"{indent}{signature} ...")
+            docstring = ast.get_docstring(child)
+            if docstring:
+                first = _comment_first_line(docstring)
+                if first:
+                    outlines.append(f'{indent}    """{first}"""')
+            visit(child, depth + 1)
+
+    visit(tree, 0)
+    return "\n".join(outlines)
+
+def _outline_regex(content: str, ext: str) -> Optional[str]:
+    outlines = []
+    lines = content.splitlines()
 
-    elif ext in ['.js', '.jsx', '.ts', '.tsx']:
+    if ext in ['.js', '.jsx', '.ts', '.tsx']:
         # JS/TS: class, function, interface, type, const arrow functions
         for line in lines:
             stripped = line.strip()
-            if re.match(r'^(export\s+)?(default\s+)?(class|function|interface|type)\s+', stripped) or \
-               re.match(r'^(export\s+)?const\s+\w+\s*=\s*(\(.*?\)|[^=\s]+)\s*=>', stripped):
+            if any(p.match(stripped) for p in OUTLINE_PATTERNS['js']):
                 clean_line = line.rstrip()
                 if '{' in clean_line:
                     outlines.append(f"{clean_line.split('{')[0].rstrip()} {{ ... }}")
@@ -775,101 +1712,1214 @@ def extract_outline(content: str, ext: str, is_debug: bool = False) -> str:
         # 他言語: クラスや関数っぽい定義行
         for line in lines:
             stripped = line.strip()
-            # 簡略化した正規表現でシグネチャを検知
-            if re.match(r'^((public|private|protected|internal|export|func|fn)\s+)?(static\s+)?(class|struct|interface|impl)\s+', stripped) or \
-               re.match(r'^((public|private|protected|internal|export|func|fn)\s+)?(static\s+)?[a-zA-Z_]\w*(<.*?>)?\s+[a-zA-Z_]\w*\s*\(', stripped):
+            if stripped.split(' ', 1)[0] in NON_DEF_KEYWORDS:
+                continue  # return foo(...) などの呼び出しは定義ではない
+            if any(p.match(stripped) for p in OUTLINE_PATTERNS['c_like']):
                 if stripped.endswith(';'): continue # プロトタイプ宣言などはスキップ
                 clean_line = line.rstrip()
                 if '{' in clean_line:
                     outlines.append(f"{clean_line.split('{')[0].rstrip()} {{ ... }}")
                 else:
                     outlines.append(f"{clean_line} ...")
-
     else:
+        return None
+    return "\n".join(outlines)
+
+def extract_outline(content: str, ext: str, is_debug: bool = False) -> str:
+    """
+    ファイルからクラスや関数のシグネチャを抽出し、アウトラインを作成する。
+    Tree-sitterのクエリ -> (Python) AST -> 正規表現 の順にフォールバックする。
+    """
+    log_debug(f"Extracting outline for extension: {ext}", is_debug)
+    outline = _outline_treesitter(content, ext)
+    if outline is None and ext == '.py':
+        outline = _outline_ast(content)
+    if outline is None:
+        outline = _outline_regex(content, ext)
+    if outline is None:
         # その他の言語の場合はフォールバックとして要約を返す
         return extract_summary(content, ext, is_debug)
+    return outline or "(No clear outline found)"
 
-    if outlines:
-        return "\n".join(outlines)
-    else:
-        return "(No clear outline found)"
+def get_file_outline(cache: ArtifactCache, key: str, content, ext: str) -> str:
+    """アウトラインを内容ハッシュ単位でキャッシュから取得 (言語判定が拡張子依存のため、成果物名に拡張子を含める)"""
+    return cache.get_or_compute(key, f"outline:{ext}", lambda: extract_outline(_materialize(content), ext, False))
 
 # ==========================================
-# 3.7. Lightweight BM25 Search Engine
+# 3.6.6. Symbol Ranges & Definition-level Chunks
 # ==========================================
-class SimpleBM25:
-    """標準ライブラリのみで実装した軽量BM25検索エンジン"""
-    def __init__(self, corpus: List[str], k1=1.5, b=0.75):
-        self.k1 = k1
-        self.b = b
-        self.corpus_size = len(corpus)
-        self.avgdl = 0
-        self.doc_freqs = []
-        self.idf = {}
-        self.doc_len = []
-        
-        self._initialize(corpus)
+CHUNK_MAX_LINES = 60  # 1チャンクの最大行数 (Ruriの512トークン上限に収まる目安)
 
-    def _tokenize(self, text: str) -> List[str]:
-        text = text.lower()
-        # 1. 英数字のまとまりを抽出
-        alphanumeric = re.findall(r'[a-z0-9_]+', text)
-        
-        # 2. 日本語（漢字、ひらがな、カタカナなど）の抽出とバイグラム化（2文字ずつのペア）
-        japanese_text = re.sub(r'[a-z0-9_\s\W]+', '', text)
-        bigrams = [japanese_text[i:i+2] for i in range(len(japanese_text) - 1)] if len(japanese_text) > 1 else [japanese_text] if japanese_text else []
-        
-        tokens = alphanumeric + bigrams
-        return [t for t in tokens if t]
+SYMBOL_DEF_PATTERN = re.compile(
+    r'^\s*(?:export\s+)?(?:default\s+)?(?:(?:public|private|protected|internal|static|async|pub)\s+)*'
+    r'(class|def|function|struct|interface|impl|fn|func)\s+([a-zA-Z_][a-zA-Z0-9_]*)'
+)
+BRACE_EXTS = {'.js', '.jsx', '.ts', '.tsx', '.java', '.go', '.rs', '.c', '.h', '.cpp', '.hpp', '.cs', '.php', '.css'}
 
-    def _initialize(self, corpus: List[str]):
-        nd = {}
-        num_doc = 0
-        for document in corpus:
-            self.doc_len.append(len(document))
-            num_doc += len(document)
+def _symbols_treesitter(content: str, ext: str) -> Optional[List[Dict]]:
+    lang_name = TREESITTER_EXT_MAP.get(ext)
+    if not HAS_TREESITTER or not lang_name:
+        return None
+    try:
+        tree, content_bytes = parse_treesitter(content, lang_name)
+    except Exception:
+        return None
 
-            frequencies = Counter(self._tokenize(document))
-            self.doc_freqs.append(frequencies)
+    DEF_KEYWORDS = {'function', 'method', 'class', 'struct', 'impl', 'interface', 'definition'}
+    symbols = []
+
+    def visit(node, depth):
+        child_depth = depth
+        if any(k in node.type for k in DEF_KEYWORDS):
+            name_node = node.child_by_field_name('name')
+            if name_node:
+                # Pythonのデコレータは decorated_definition 側に付くため範囲を親まで広げる
+                start_node = node.parent if node.parent is not None and node.parent.type == 'decorated_definition' else node
+                symbols.append({
+                    "kind": node.type,
+                    "name": content_bytes[name_node.start_byte:name_node.end_byte].decode('utf-8', errors='ignore'),
+                    "start": start_node.start_point[0] + 1,
+                    "end": node.end_point[0] + 1,
+                    "depth": depth,
+                })
+                child_depth = depth + 1
+        for child in node.children:
+            visit(child, child_depth)
+
+    visit(tree.root_node, 0)
+    return symbols
+
+def _symbols_ast(content: str) -> Optional[List[Dict]]:
+    try:
+        PROFILER.count_parse("ast:python")
+        tree = ast.parse(content)
+    except Exception:
+        return None
+    symbols = []
+
+    def visit(node, depth):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                start = child.lineno
+                if child.decorator_list:
+                    start = min(d.lineno for d in child.decorator_list)
+                kind = 'class' if isinstance(child, ast.ClassDef) else ('async function' if isinstance(child, ast.AsyncFunctionDef) else 'function')
+                symbols.append({"kind": kind, "name": child.name, "start": start, "end": child.end_lineno, "depth": depth})
+                visit(child, depth + 1)
+            else:
+                visit(child, depth)
 
-            for word, freq in frequencies.items():
-                if word not in nd:
-                    nd[word] = 0
-                nd[word] += 1
+    visit(tree, 0)
+    return symbols
 
-        self.avgdl = num_doc / self.corpus_size if self.corpus_size > 0 else 0
+def _symbols_regex(content: str, ext: str) -> List[Dict]:
+    """定義行を正規表現で検出し、波括弧の対応 or インデントで終了行を推定する"""
+    lines = content.splitlines()
+    symbols = []
+    open_ranges = []  # (end, depth) 入れ子判定用
+    for i, line in enumerate(lines):
+        m = SYMBOL_DEF_PATTERN.match(line)
+        if not m:
+            continue
+        end = i
+        if ext in BRACE_EXTS:
+            balance, started = 0, False
+            for j in range(i, len(lines)):
+                balance += lines[j].count('{') - lines[j].count('}')
+                if balance > 0:
+                    started = True
+                if (started and balance <= 0) or (not started and lines[j].rstrip().endswith(';')):
+                    end = j
+                    break
+            else:
+                end = len(lines) - 1 if started else i
+        else:
+            indent = len(line) - len(line.lstrip())
+            for j in range(i + 1, len(lines)):
+                if lines[j].strip() and len(lines[j]) - len(lines[j].lstrip()) <= indent:
+                    break
+                if lines[j].strip():
+                    end = j
+        open_ranges = [(e, d) for e, d in open_ranges if e >= i]
+        depth = len(open_ranges)
+        kind = m.group(1)
+        symbols.append({"kind": 'function' if kind in ('def', 'fn', 'func') else kind, "name": m.group(2), "start": i + 1, "end": end + 1, "depth": depth})
+        open_ranges.append((end, depth))
+    return symbols
+
+def extract_symbols(content: str, ext: str) -> List[Dict]:
+    """
+    関数/クラス等の定義の行範囲を抽出する (Tree-sitter -> AST -> 正規表現の順にフォールバック)。
+    戻り値: [{"kind", "name", "start", "end", "depth"}] (行番号は1始まり・両端含む、start順)
+    """
+    if not content:
+        return []
+    symbols = _symbols_treesitter(content, ext)
+    if not symbols and ext == '.py':
+        symbols = _symbols_ast(content)
+    if not symbols:
+        symbols = _symbols_regex(content, ext)
+    return sorted(symbols, key=lambda s: (s["start"], s["depth"]))
+
+def extract_chunks(content: str, ext: str, max_lines: int = CHUNK_MAX_LINES) -> List[Dict]:
+    """
+    ファイルを定義単位のチャンクに分割する。
+    大きなクラスはメソッド単位まで掘り下げ、定義の間のモジュールレベルのコードも独立したチャンクにする。
+    戻り値: [{"name", "kind", "start", "end", "text", "hash"}]
+    """
+    lines = content.splitlines()
+    if not lines:
+        return []
+    symbols = extract_symbols(content, ext)
+
+    def cover(start, end, depth, parent_name):
+        ranges = []
+        cur = start
+        inner = [s for s in symbols if s["depth"] == depth and s["start"] >= start and s["end"] <= end]
+        for s in inner:
+            if s["start"] < cur:
+                continue  # 重複した範囲はスキップ
+            if s["start"] > cur:
+                ranges.append((cur, s["start"] - 1, parent_name, 'module' if depth == 0 else 'body'))
+            has_children = any(c["depth"] == depth + 1 and s["start"] <= c["start"] and c["end"] <= s["end"] for c in symbols)
+            if s["end"] - s["start"] + 1 > max_lines and has_children:
+                ranges.extend(cover(s["start"], s["end"], depth + 1, s["name"]))
+            else:
+                ranges.append((s["start"], s["end"], s["name"], s["kind"]))
+            cur = s["end"] + 1
+        if cur <= end:
+            ranges.append((cur, end, parent_name, 'module' if depth == 0 else 'body'))
+        return ranges
+
+    chunks = []
+    for start, end, name, kind in cover(1, len(lines), 0, ""):
+        # 長すぎる範囲は max_lines ごとの窓に分割する
+        for w_start in range(start, end + 1, max_lines):
+            w_end = min(end, w_start + max_lines - 1)
+            text = "\n".join(lines[w_start - 1:w_end])
+            if not text.strip():
+                continue
+            chunks.append({
+                "name": name or "",
+                "kind": kind,
+                "start": w_start,
+                "end": w_end,
+                "text": text,
+                "hash": hashlib.sha1(text.encode('utf-8')).hexdigest(),
+            })
+    return chunks
+
+def render_chunks(chunks: List[Dict]) -> str:
+    """検索でヒットしたチャンクのみを、行範囲ヘッダ付きで連結する"""
+    parts = []
+    for ch in sorted(chunks, key=lambda c: c["start"]):
+        label = f" {ch['name']}" if ch["name"] else ""
+        parts.append(f"// [Chunk L{ch['start']}-{ch['end']}{label}]\n{ch['text']}")
+    return "\n// ...\n".join(parts)
+
+ELISION_HEAD_RATIO = 0.5  # 先頭に割り当てる予算の割合 (残りは末尾。片側で余った分はもう片側に回す)
+HASH_COMMENT_EXTS = {'.py', '.rb', '.sh', '.bash', '.zsh', '.yaml', '.yml', '.toml', '.ini', '.cfg', '.conf', '.r', '.pl', '.mk'}
+
+def elide_middle(content: str, ext: str, max_tokens: int, count) -> str:
+    """
+    max_tokens を超える本文の先頭と末尾を残し、中間を省略の印に置き換える。
+    定義 (関数/クラス) が抽出できる場合は定義の途中で切らず、定義単位で残す。
+    1行が長すぎる (minify済み等) 場合は文字単位で切る。count(text) はトークン数。
+    """
+    comment_marker = '#' if ext in HASH_COMMENT_EXTS else '//'
+    lines = content.splitlines()
+    # 残す単位: トップレベルの定義は丸ごと、それ以外は1行ずつ
+    segments: List[Tuple[int, int]] = []
+    cur = 1
+    for sym in extract_symbols(content, ext):
+        if sym["depth"] != 0 or sym["start"] < cur:
+            continue
+        segments.extend((n, n) for n in range(cur, sym["start"]))
+        segments.append((sym["start"], sym["end"]))
+        cur = sym["end"] + 1
+    segments.extend((n, n) for n in range(cur, len(lines) + 1))
+
+    costs: Dict[Tuple[int, int], int] = {}
+
+    def cost(seg: Tuple[int, int]) -> int:
+        if seg not in costs:
+            costs[seg] = count("\n".join(lines[seg[0] - 1:seg[1]])) + 1
+        return costs[seg]
+
+    total = count(content)
+    marker_tokens = count(f"{comment_marker} ... [{len(lines):,} lines elided: L{len(lines)}-{len(lines)}, ~{total:,} tokens] ...") + 1
+    budget = max(1, max_tokens - marker_tokens)
+    head: List[Tuple[int, int]] = []
+    tail: List[Tuple[int, int]] = []
+    middle = list(segments)
+    used = 0
+
+    def grow(side: List[Tuple[int, int]], from_end: bool, limit: float):
+        nonlocal used
+        while middle:
+            index = -1 if from_end else 0
+            seg = middle[index]
+            if used + cost(seg) <= limit:
+                used += cost(seg)
+                side.append(middle.pop(index))
+            elif not side and seg[1] > seg[0]:
+                # 片側に何も残せない大きな定義は、行単位に分けて残せる分だけ残す
+                middle[index:index + 1 if index == 0 else None] = [(n, n) for n in range(seg[0], seg[1] + 1)]
+            else:
+                break
 
-        # IDFの計算
-        for word, freq in nd.items():
-            # BM25+ の式を少しアレンジして負のスコアを防ぐ
-            idf_score = math.log(1 + (self.corpus_size - freq + 0.5) / (freq + 0.5))
-            self.idf[word] = idf_score
+    grow(head, False, budget * ELISION_HEAD_RATIO)
+    grow(tail, True, budget)
+    grow(head, False, budget)
+    if not middle:
+        return content
+    if not head and not tail:
+        # 1行が予算を超える場合: トークンあたりの平均文字数から、先頭と末尾の文字数を見積もって切る
+        keep = int(len(content) * budget / max(total, 1) / 2)
+        marker = f"{comment_marker} ... [{len(content) - keep * 2:,} chars elided, ~{max(total - budget, 0):,} tokens] ..."
+        return f"{content[:keep]}\n{marker}\n{content[len(content) - keep:]}" if keep else marker
+
+    first, last = middle[0][0], middle[-1][1]
+    marker = f"{comment_marker} ... [{last - first + 1:,} lines elided: L{first}-{last}, ~{max(total - used, 0):,} tokens] ..."
+    kept_head = "\n".join(lines[:first - 1])
+    kept_tail = "\n".join(lines[last:])
+    return "\n".join(part for part in (kept_head, marker, kept_tail) if part)
 
-    def get_scores(self, query: str, is_debug: bool = False) -> List[float]:
-        score = [0.0] * self.corpus_size
-        query_words = self._tokenize(query)
-        if is_debug:
-            print(f"[DEBUG BM25] Query tokens: {query_words}", file=sys.stderr)
-            
-        for q_word in query_words:
-            if q_word not in self.idf:
-                continue
-            for index, frequencies in enumerate(self.doc_freqs):
-                if q_word in frequencies:
-                    freq = frequencies[q_word]
-                    numerator = self.idf[q_word] * freq * (self.k1 + 1)
-                    denominator = freq + self.k1 * (1 - self.b + self.b * self.doc_len[index] / self.avgdl)
-                    score[index] += numerator / denominator
-        return score
+# ==========================================
+# 3.6.8. Near-duplicate Detection (MinHash / LSH)
+# ==========================================
+MINHASH_PERM = 64     # シグネチャ長
+MINHASH_BANDS = 16    # LSHのバンド数 (1バンド = 64/16 = 4行)
+SHINGLE_SIZE = 5      # 単語5-gramをシングルとする
+NEAR_DUP_MAX_DIFF_RATIO = 0.5  # 差分がプレビューの半分を超える場合はまとめない
+
+def compute_minhash(content: str, num_perm: int = MINHASH_PERM) -> str:
+    """
+    単語5-gramのMinHashシグネチャを計算する (One Permutation Hashing + 循環補完)。
+    1シングルあたりハッシュ1回で済むため、通常のk回置換より大幅に速い。
+    戻り値: 32bit値 × num_perm を base64 化した文字列 (キャッシュ保存用)
+    """
+    tokens = re.findall(r'\w+', content.lower())
+    if not tokens:
+        return ""
+    shingles = {" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(max(1, len(tokens) - SHINGLE_SIZE + 1))}
+    empty = 0xFFFFFFFF
+    sig = [empty] * num_perm
+    for sh in shingles:
+        h = int.from_bytes(hashlib.blake2b(sh.encode('utf-8'), digest_size=8).digest(), 'big')
+        b, v = h % num_perm, (h // num_perm) & 0xFFFFFFFE
+        if v < sig[b]:
+            sig[b] = v
+    # 空のビンは右隣の値で補完する (densification)。シングルが少ない小さなファイル対策
+    filled = [i for i in range(num_perm) if sig[i] != empty]
+    for i in range(num_perm):
+        if sig[i] == empty:
+            j = next(k for k in filled if k > i) if any(k > i for k in filled) else filled[0]
+            sig[i] = sig[j] | 1  # 補完値であることを最下位ビットで区別
+    return base64.b64encode(array('I', sig).tobytes()).decode('ascii')
+
+def _decode_minhash(sig: str) -> List[int]:
+    arr = array('I')
+    arr.frombytes(base64.b64decode(sig))
+    return arr.tolist()
+
+def find_near_duplicate_clusters(sketches: Dict[str, str], threshold: float) -> List[List[str]]:
+    """
+    LSHバンディングで候補ペアを絞り込み、推定Jaccard類似度が閾値以上のものをクラスタにまとめる。
+    sketches: {ID: compute_minhash の結果} (IDの並び順が出力順)
+    戻り値: 2件以上のクラスタのリスト (各クラスタ内は sketches の並び順)
+    """
+    order = {k: i for i, k in enumerate(sketches)}
+    sigs = {k: _decode_minhash(v) for k, v in sketches.items() if v}
+    rows = MINHASH_PERM // MINHASH_BANDS
+    parent = {k: k for k in sigs}
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    checked = set()
+    for band in range(MINHASH_BANDS):
+        buckets: Dict[tuple, List[str]] = {}
+        for k, sig in sigs.items():
+            buckets.setdefault(tuple(sig[band * rows:(band + 1) * rows]), []).append(k)
+        for members in buckets.values():
+            for i in range(len(members)):
+                for j in range(i + 1, len(members)):
+                    a, b = members[i], members[j]
+                    if (a, b) in checked:
+                        continue
+                    checked.add((a, b))
+                    similarity = sum(1 for x, y in zip(sigs[a], sigs[b]) if x == y) / MINHASH_PERM
+                    if similarity >= threshold:
+                        parent[find(b)] = find(a)
+
+    clusters: Dict[str, List[str]] = {}
+    for k in sigs:
+        clusters.setdefault(find(k), []).append(k)
+    return [sorted(c, key=order.get) for c in clusters.values() if len(c) > 1]
+
+def estimate_similarity(sig_a: str, sig_b: str) -> float:
+    a, b = _decode_minhash(sig_a), _decode_minhash(sig_b)
+    return sum(1 for x, y in zip(a, b) if x == y) / MINHASH_PERM
+
+def collapse_near_duplicates(root_node: Dict, node_sketches: Dict[int, str], threshold: float) -> Dict:
+    """
+    類似ファイルのクラスタごとに、出力順で最初のファイルを代表として全文を残し、
+    残りは代表との差分 ("similar_to" + "diff") か、空白のみの違いなら一行メモ ("note") に置き換える。
+    node_sketches: {id(ファイルノード): MinHash}
+    戻り値: {"files": 置き換えた件数, "previews": 省略したプレビュー本文, "diffs": 代わりに出力した差分}
+    """
+    stats = {"files": 0, "previews": [], "diffs": []}
+    nodes = {}
+    sketches = {}
+    for path, node in iter_file_nodes(root_node):
+        if node.get("preview") and id(node) in node_sketches:
+            nodes[path] = node
+            sketches[path] = node_sketches[id(node)]
+
+    for cluster in find_near_duplicate_clusters(sketches, threshold):
+        rep_path = cluster[0]
+        rep_lines = nodes[rep_path]["preview"].splitlines()
+        for path in cluster[1:]:
+            node = nodes[path]
+            preview = node["preview"]
+            similarity = estimate_similarity(sketches[rep_path], sketches[path])
+            diff_lines = [l for l in difflib.unified_diff(rep_lines, preview.splitlines(), n=0, lineterm='')
+                          if not l.startswith(('---', '+++'))]
+            changed = [l for l in diff_lines if l.startswith(('+', '-')) and l[1:].strip()]
+            if not changed:
+                note = f"identical to {rep_path} except whitespace/blank lines"
+                node.update({"similar_to": rep_path, "similarity": round(similarity, 2), "note": note})
+                replacement = note
+            else:
+                diff_text = "\n".join(diff_lines)
+                if len(diff_text) > len(preview) * NEAR_DUP_MAX_DIFF_RATIO:
+                    continue
+                node.update({"similar_to": rep_path, "similarity": round(similarity, 2), "diff": diff_text})
+                replacement = diff_text
+            del node["preview"]
+            stats["files"] += 1
+            stats["previews"].append(preview)
+            stats["diffs"].append(replacement)
+    return stats
 
 # ==========================================
-# 3.8. ONNX Semantic Search Engine
+# 3.6.9. Trigram Index (Substring / Regex Prefilter)
 # ==========================================
+# codesearch/zoekt と同様に、各ファイルに現れる3バイト列 (trigram) の集合を内容ハッシュ単位で保持し、
+# 検索語に含まれる trigram をすべて持つファイルだけを候補として本文を照合する。
+# 索引は専用ファイル (INDEX_DB_NAME) に置き、起動時に全体を読まず、照合するファイルの分だけを引く。
+# 大文字小文字を区別しない検索にも使えるよう、本文も検索語も小文字化してから trigram にする。
+VERBOSE_FLAG_PATTERN = re.compile(r'\(\?[a-zA-Z]*x')
+REPEAT_PATTERN = re.compile(r'\{(\d*)(?:,\d*)?\}')
+REGEX_CLASS_ESCAPES = set('dDwWsSbBAZntrfva')  # 1文字で完結するエスケープ (リテラルの連続はここで切る)
+
+def compute_trigrams(content: str) -> bytes:
+    """本文の trigram 集合を、昇順の整数配列として zlib 圧縮したバイト列で返す (索引ファイル保存用)"""
+    data = content.lower().encode('utf-8')
+    grams = sorted(int.from_bytes(g, 'big') for g in {data[i:i + 3] for i in range(len(data) - 2)})
+    return zlib.compress(array('I', grams).tobytes())
+
+def decode_trigrams(encoded: bytes) -> array:
+    grams = array('I')
+    grams.frombytes(zlib.decompress(encoded))
+    return grams
+
+def literal_trigrams(literals: List[str]) -> List[int]:
+    """検索語 (必ず含まれる文字列) の trigram。3バイト未満の語は絞り込みに使わない"""
+    grams = set()
+    for literal in literals:
+        data = literal.lower().encode('utf-8')
+        grams.update(int.from_bytes(data[i:i + 3], 'big') for i in range(len(data) - 2))
+    return sorted(grams)
+
+def contains_trigrams(grams: array, needed: List[int]) -> bool:
+    """昇順の trigram 配列が needed をすべて含むか (二分探索)"""
+    for g in needed:
+        i = bisect.bisect_left(grams, g)
+        if i == len(grams) or grams[i] != g:
+            return False
+    return True
+
+def required_literals(pattern: str) -> List[str]:
+    """
+    正規表現に一致する文字列に必ず含まれる部分文字列 (トップレベルで連続するリテラル) を取り出す。
+    判定できない構文 (トップレベルの |、数値のエスケープ、verboseフラグ等) は空リスト (= 絞り込まない) を返す。
+    """
+    if VERBOSE_FLAG_PATTERN.search(pattern):
+        return []
+    literals: List[str] = []
+    run: List[str] = []
+
+    def flush():
+        if run:
+            literals.append("".join(run))
+            run.clear()
+
+    depth, i, n = 0, 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        atom = None
+        if c == '\\':
+            nxt = pattern[i + 1:i + 2]
+            if not nxt:
+                return []
+            if nxt.isalnum() and nxt not in REGEX_CLASS_ESCAPES:
+                return []  # \x41 / \u... / \1 等は長さが不定のため諦める
+            atom = None if nxt.isalnum() else nxt
+            i += 2
+        elif c == '[':
+            # 文字クラスは読み飛ばす (先頭の ] と ^] はクラスの一部)
+            j = i + 1
+            if pattern[j:j + 1] == '^':
+                j += 1
+            if pattern[j:j + 1] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 2 if pattern[j] == '\\' else 1
+            i = j + 1
+        elif c == '(':
+            depth += 1
+            i += 1
+        elif c == ')':
+            depth -= 1
+            i += 1
+        elif c == '|':
+            if depth == 0:
+                return []
+            i += 1
+        elif c == '{' and REPEAT_PATTERN.match(pattern, i):
+            i = REPEAT_PATTERN.match(pattern, i).end()
+        elif c in '.^$*+?':
+            i += 1
+        else:
+            atom = c
+            i += 1
+
+        if depth > 0 or atom is None:
+            flush()
+            continue
+        # 直後の量指定子: 0回を許すものは直前の1文字を外し、1回以上なら直前の文字までで区切る
+        quant = pattern[i:i + 1]
+        repeat = REPEAT_PATTERN.match(pattern, i) if quant == '{' else None
+        if quant in ('*', '?') or (repeat and repeat.group(1) in ('', '0')):
+            flush()
+        elif quant == '+' or repeat:
+            run.append(atom)
+            flush()
+        else:
+            run.append(atom)
+    flush()
+    return [l for l in literals if l]
+
+# ==========================================
+# 3.6.10. Minification (--minify)
+# ==========================================
+# 1: 行末の空白を削除し、連続する空行を1行にまとめる
+# 2: 1 + コメントと docstring を削除
+# 3: 2 + 空行をすべて削除し、インデントを1段1スペースにする
+# 文字列リテラルの内側の行には手を付けない。結果が構文エラーになる場合は元の本文を返す。
+MINIFY_LEVELS = (1, 2, 3)
+MINIFY_NO_REINDENT = {'html'}  # インデントの意味が変わり得る言語は再インデントしない
+
+def _minify_lines(lines: List[Optional[str]], protected: Set[int], level: int, depths: Optional[Dict[int, int]] = None) -> str:
+    """
+    行単位の仕上げ: 行末の空白削除・空行の圧縮・再インデント (protected は文字列の内側の行番号, 0始まり)。
+    depths には行ごとのインデントの段数を渡す (省略時は先頭の空白幅から推定する)。
+    None の行 (コメント等の削除で中身がなくなった行) は空行も残さずに取り除く。
+    """
+    out: List[str] = []
+    widths = [0]
+    for i, line in enumerate(lines):
+        if line is None:
+            continue
+        if i in protected:
+            out.append(line)
+            continue
+        line = line.rstrip()
+        if not line:
+            if level < 3 and out and out[-1] != "":
+                out.append("")
+            continue
+        if level >= 3:
+            body = line.lstrip()
+            if depths is not None and i in depths:
+                depth = depths[i]
+            else:
+                # 先頭の空白幅の段差からネストの深さを推定する (Python の字句解析と同じスタック方式)
+                width = len(line.expandtabs(4)) - len(body)
+                while widths[-1] > width:
+                    widths.pop()
+                if width > widths[-1]:
+                    widths.append(width)
+                depth = len(widths) - 1
+            line = " " * depth + body
+        out.append(line)
+    while out and out[-1] == "":
+        out.pop()
+    return "\n".join(out)
+
+def minify_python(content: str, level: int) -> str:
+    """tokenize と ast で Python のコメント・docstring を削除する (インデントは INDENT/DEDENT から1スペースずつに)"""
+    tree = ast.parse(content)
+    lines = content.splitlines()
+    tokens = list(tokenize.generate_tokens(io.StringIO(content).readline))
+
+    def char_col(lineno: int, byte_col: int) -> int:
+        # ast の列番号は UTF-8 のバイト位置のため、文字位置に直す
+        return len(lines[lineno - 1].encode('utf-8')[:byte_col].decode('utf-8', errors='ignore'))
+
+    removals: List[Tuple[Tuple[int, int], Tuple[int, int], str]] = []
+    if level >= 2:
+        for tok in tokens:
+            if tok.type == tokenize.COMMENT:
+                removals.append((tok.start, tok.end, ""))
+        for node in ast.walk(tree):
+            if not isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)) or not node.body:
+                continue
+            first = node.body[0]
+            if isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant) and isinstance(first.value.value, str):
+                # 本体が docstring だけの定義は、本体が空にならないよう ... に置き換える
+                replacement = "..." if len(node.body) == 1 and not isinstance(node, ast.Module) else ""
+                removals.append(((first.lineno, char_col(first.lineno, first.col_offset)),
+                                 (first.end_lineno, char_col(first.end_lineno, first.end_col_offset)), replacement))
+
+    protected: Set[int] = set()
+    depths: Dict[int, int] = {}
+    depth = 0
+    for tok in tokens:
+        if tok.type == tokenize.INDENT:
+            depth += 1
+        elif tok.type == tokenize.DEDENT:
+            depth -= 1
+        elif tok.type not in (tokenize.NL, tokenize.NEWLINE, tokenize.COMMENT) and tok.start[0] - 1 not in depths:
+            depths[tok.start[0] - 1] = depth
+        if tok.type not in (tokenize.NL, tokenize.NEWLINE) and tok.end[0] > tok.start[0]:
+            protected.update(range(tok.start[0], tok.end[0]))
+    # 括弧内・行継続の2行目以降は、属する文の深さ + 1
+    current = 0
+    for i in range(len(lines)):
+        if i in depths:
+            current = depths[i]
+        else:
+            depths[i] = current + 1
+
+    result: List[Optional[str]] = list(lines)
+    for (srow, scol), (erow, ecol), replacement in sorted(removals, reverse=True):
+        merged = result[srow - 1][:scol] + replacement + result[erow - 1][ecol:]
+        result[srow - 1:erow] = [merged if merged.strip() else None] + [None] * (erow - srow)
+        protected.difference_update(range(srow, erow))
+    return _minify_lines(result, protected, level, depths)
+
+def minify_treesitter(content: str, lang_name: str, level: int) -> Optional[str]:
+    """Tree-sitter の構文木でコメントを削除する (文字列の内側の行は保護)。解析できない場合は None"""
+    try:
+        tree, content_bytes = parse_treesitter(content, lang_name)
+    except Exception:
+        return None
+    comments: List[Tuple[int, int]] = []
+    protected: Set[int] = set()
+    stack = [tree.root_node]
+    while stack:
+        node = stack.pop()
+        if 'comment' in node.type:
+            comments.append((node.start_byte, node.end_byte))
+            continue
+        if ('string' in node.type or 'template' in node.type) and node.end_point[0] > node.start_point[0]:
+            protected.update(range(node.start_point[0] + 1, node.end_point[0] + 1))
+            continue
+        stack.extend(node.children)
+
+    data = content_bytes
+    if level >= 2:
+        for start, end in sorted(comments, reverse=True):
+            # 行の途中のブロックコメントは、前後の字句がくっつかないよう空白1つに置き換える
+            before = data[start - 1:start] if start else b"\n"
+            after = data[end:end + 1] or b"\n"
+            gap = b" " if not before.isspace() and not after.isspace() else b""
+            if before == b" " and after == b" ":
+                end += 1
+            # コメントだけの行は行ごと取り除く (空行として残さない)
+            line_start = data.rfind(b"\n", 0, start) + 1
+            line_end = data.find(b"\n", end)
+            line_end = len(data) if line_end < 0 else line_end
+            if not data[line_start:start].strip() and not data[end:line_end].strip():
+                start, end, gap = line_start, min(line_end + 1, len(data)), b""
+            elif not data[line_start:start].strip():
+                # 行頭のコメントの後ろの空白も詰める (インデントは元の行頭の空白を残す)
+                rest = data[end:line_end]
+                end += len(rest) - len(rest.lstrip())
+            data = data[:start] + gap + data[end:]
+    text = data.decode('utf-8', errors='replace')
+    if level >= 2 and comments:
+        # コメントの削除で行がずれるため、文字列の位置を取り直す
+        try:
+            tree, _ = parse_treesitter(text, lang_name)
+        except Exception:
+            return None
+        protected = set()
+        stack = [tree.root_node]
+        while stack:
+            node = stack.pop()
+            if ('string' in node.type or 'template' in node.type) and node.end_point[0] > node.start_point[0]:
+                protected.update(range(node.start_point[0] + 1, node.end_point[0] + 1))
+                continue
+            stack.extend(node.children)
+    return _minify_lines(text.splitlines(), protected, level if lang_name not in MINIFY_NO_REINDENT else min(level, 2))
+
+def minify_content(content: str, ext: str, level: int) -> str:
+    """
+    本文を言語に応じて縮める (Python は tokenize/ast、その他は Tree-sitter の対応言語のみ)。
+    対応外の言語や、結果が構文エラーになる場合は元の本文をそのまま返す。
+    """
+    if not content or level <= 0:
+        return content
+    if ext == '.py':
+        try:
+            minified = minify_python(content, level)
+            ast.parse(minified)
+            return minified
+        except (SyntaxError, ValueError, tokenize.TokenError, IndentationError):
+            return content
+    lang_name = TREESITTER_EXT_MAP.get(ext)
+    if not HAS_TREESITTER or not lang_name:
+        return content
+    minified = minify_treesitter(content, lang_name, level)
+    if minified is None:
+        return content
+    try:
+        # 元が構文エラーなしなら、縮めた結果も構文エラーなしであること
+        if not parse_treesitter(content, lang_name)[0].root_node.has_error and parse_treesitter(minified, lang_name)[0].root_node.has_error:
+            return content
+    except Exception:
+        return content
+    return minified
+
+# ==========================================
+# 3.6.11. Data File Sampling (--sample-data)
+# ==========================================
+# 巨大なデータファイルは全文の代わりに「構造のプレビュー」を出力する。
+# 読むのは先頭 SAMPLE_HEAD_BYTES と、先頭以降の区間を等分した各区間内の無作為な位置の SAMPLE_WINDOW_BYTES だけなので、
+# 数GBのファイルでも読み込み量と時間は一定。乱数はファイルサイズで固定し、同じファイルなら毎回同じ結果になる。
+DATA_SAMPLE_EXTS = ['.json', '.ndjson', '.jsonl', '.csv', '.tsv', '.yaml', '.yml', '.sql', '.txt', '.log']
+DATA_SAMPLE_DEFAULT_MB = 1.0       # --sample-data を値なしで指定した場合のしきい値 (MB)
+SAMPLE_HEAD_BYTES = 256 * 1024     # 先頭から読む量 (スキーマ推定・DDL抽出用)
+SAMPLE_WINDOWS = 5                 # 先頭以降から無作為に読む位置の数
+SAMPLE_WINDOW_BYTES = 64 * 1024    # 無作為な位置ごとに読む量
+SAMPLE_HEAD_RECORDS = 200          # スキーマ推定に使う先頭のレコード数の上限
+SAMPLE_SHOW_RECORDS = 3            # 出力する先頭のレコード数 (無作為に取り出したものは別に最大 SAMPLE_WINDOWS 件)
+SAMPLE_LINE_CHARS = 200            # 出力する1行の最大文字数
+SQL_CREATE_PATTERN = re.compile(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?([`"\[]?[\w.$]+[`"\]]?)\s*\(', re.IGNORECASE)
+SQL_INSERT_PATTERN = re.compile(r'^\s*(?:INSERT\s+INTO|COPY)\s+([`"\[]?[\w.$]+[`"\]]?)', re.IGNORECASE | re.MULTILINE)
+SQL_CONSTRAINT_WORDS = ('PRIMARY', 'KEY', 'UNIQUE', 'CONSTRAINT', 'INDEX', 'FOREIGN', 'CHECK', 'FULLTEXT', 'SPATIAL')
+
+def _clip(text: str, limit: int = SAMPLE_LINE_CHARS) -> str:
+    text = text.rstrip()
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+def format_bytes(size: float) -> str:
+    if size < 1024:
+        return f"{int(size):,} B"
+    for unit in ('KB', 'MB'):
+        size /= 1024
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+    return f"{size / 1024:.1f} GB"
+
+def _read_sample_regions(f, size: int) -> Tuple[str, List[str]]:
+    """先頭と、無作為な位置の領域 (行頭から始まり、行末で終わるように切り詰めたもの) を読む。改行のない (1行の) ファイルは切り詰めない"""
+    head = f.read(SAMPLE_HEAD_BYTES)
+    if len(head) < size:
+        # 途中で切れた最後の行は捨てる
+        head = head[:head.rfind(b"\n") + 1] or head
+    rng = random.Random(size)
+    windows = []
+    start = len(head)
+    span = size - start
+    if span > 0:
+        for i in range(SAMPLE_WINDOWS):
+            f.seek(start + int(span * (i + rng.random()) / SAMPLE_WINDOWS))
+            data = f.read(SAMPLE_WINDOW_BYTES)
+            first, last = data.find(b"\n"), data.rfind(b"\n")
+            if first < 0:
+                windows.append(data.decode('utf-8', errors='ignore'))
+            elif last > first:
+                windows.append(data[first + 1:last + 1].decode('utf-8', errors='replace'))
+    return head.decode('utf-8', errors='replace'), windows
+
+def _value_type(value) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, list):
+        inner = sorted({_value_type(v) for v in value[:20]})
+        return f"array<{'|'.join(inner)}>" if inner else "array"
+    return "object"
+
+def infer_schema(records: List, max_depth: int = 2) -> List[str]:
+    """レコード (dict) の並びから「キー: 型 (出現率) 例」の一覧を作る。入れ子の object は "親.子" で展開する"""
+    fields: Dict[str, Dict] = {}
+
+    def visit(record: Dict, prefix: str, depth: int):
+        for key, value in record.items():
+            name = f"{prefix}{key}"
+            if isinstance(value, dict) and value and depth < max_depth:
+                visit(value, f"{name}.", depth + 1)
+                continue
+            field = fields.setdefault(name, {"types": [], "count": 0, "example": None})
+            field["count"] += 1
+            kind = _value_type(value)
+            if kind not in field["types"]:
+                field["types"].append(kind)
+            if field["example"] is None and value not in (None, "", [], {}):
+                field["example"] = value
+
+    dicts = [r for r in records if isinstance(r, dict)]
+    for record in dicts:
+        visit(record, "", 1)
+    lines = []
+    for name, field in fields.items():
+        optional = "" if field["count"] == len(dicts) else f" ({field['count']}/{len(dicts)})"
+        example = f"  e.g. {_clip(json.dumps(field['example'], ensure_ascii=False), 60)}" if field["example"] is not None else ""
+        lines.append(f"  {name}: {'|'.join(field['types'])}{optional}{example}")
+    return lines
+
+def _decode_json_values(text: str, pos: int, limit: int) -> Tuple[List, int]:
+    """text[pos] の '[' から始まる配列の要素を、途中で切れるまで (最大 limit 件) 取り出す。戻り値: (要素, 読んだ位置)"""
+    decoder = json.JSONDecoder()
+    values = []
+    pos += 1
+    while len(values) < limit:
+        while pos < len(text) and text[pos] in ' \t\r\n,':
+            pos += 1
+        if pos >= len(text) or text[pos] == ']':
+            break
+        try:
+            value, end = decoder.raw_decode(text, pos)
+        except ValueError:
+            break
+        values.append(value)
+        pos = end
+    return values, pos
+
+def _sample_json_records(windows: List[str], keys: Set[str]) -> List[Dict]:
+    """無作為な位置の領域から、先頭のレコードとキーが半分以上重なる object を1件ずつ探す"""
+    decoder = json.JSONDecoder()
+    found = []
+    for window in windows:
+        pos = window.find('{')
+        while 0 <= pos and pos < len(window):
+            try:
+                value, _ = decoder.raw_decode(window, pos)
+                if isinstance(value, dict) and len(keys & set(value)) * 2 >= max(len(keys), 1):
+                    found.append(value)
+                    break
+            except ValueError:
+                pass
+            pos = window.find('{', pos + 1)
+    return found
+
+def _preview_records(label: str, head_records: List, sampled: List, total_hint: str) -> List[str]:
+    out = [f"// Schema ({label}, inferred from {len(head_records) + len(sampled)} records{total_hint}):"]
+    out.extend(infer_schema(head_records + sampled))
+    out.append("// First records:")
+    out.extend(_clip(json.dumps(r, ensure_ascii=False)) for r in head_records[:SAMPLE_SHOW_RECORDS])
+    if sampled:
+        out.append("// Random records:")
+        out.extend(_clip(json.dumps(r, ensure_ascii=False)) for r in sampled)
+    return out
+
+def _estimate_rows(head: str, size: int) -> str:
+    lines = head.count("\n")
+    return f", ~{int(size / (len(head.encode('utf-8')) / lines)):,} rows est." if lines and head else ""
+
+def _preview_ndjson(head: str, windows: List[str], size: int) -> List[str]:
+    records = []
+    for line in head.splitlines()[:SAMPLE_HEAD_RECORDS]:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    sampled = []
+    for window in windows:
+        line = window.split("\n", 1)[0]
+        try:
+            sampled.append(json.loads(line))
+        except ValueError:
+            continue
+    return _preview_records("NDJSON", records, sampled, _estimate_rows(head, size))
+
+def _preview_json(head: str, windows: List[str], size: int) -> List[str]:
+    text = head.lstrip()
+    if text.startswith('['):
+        records, end = _decode_json_values(text, 0, SAMPLE_HEAD_RECORDS)
+        keys = {k for r in records if isinstance(r, dict) for k in r}
+        sampled = _sample_json_records(windows, keys) if keys else []
+        if records and not any(isinstance(r, dict) for r in records):
+            return [f"// Top-level array of {', '.join(sorted({_value_type(r) for r in records}))}",
+                    *(_clip(json.dumps(r, ensure_ascii=False)) for r in records[:SAMPLE_SHOW_RECORDS])]
+        # 読めた要素が占めるバイト数から全体の件数を見積もる
+        used = len(text[:end].encode('utf-8'))
+        estimate = f", ~{int(size * len(records) / used):,} records est." if records and used < size else ""
+        return _preview_records("top-level array", records, sampled, estimate)
+    if not text.startswith('{'):
+        return head.splitlines()[:SAMPLE_SHOW_RECORDS * 5]
+
+    # 巨大な object: 先頭から キー: 値 を順に読み、途中で切れた値は先頭の記号から型だけを推定する
+    decoder = json.JSONDecoder()
+    out = ["// Top-level object keys:"]
+    pos = 1
+    while pos < len(text):
+        while pos < len(text) and text[pos] in ' \t\r\n,':
+            pos += 1
+        if pos >= len(text) or text[pos] == '}':
+            break
+        try:
+            key, pos = decoder.raw_decode(text, pos)
+            pos = text.index(':', pos) + 1
+            while pos < len(text) and text[pos] in ' \t\r\n':
+                pos += 1
+        except ValueError:
+            break
+        try:
+            value, pos = decoder.raw_decode(text, pos)
+            out.append(f"  {key}: {_value_type(value)}  e.g. {_clip(json.dumps(value, ensure_ascii=False), 80)}")
+        except ValueError:
+            # ファイルの大半を占める値 (多くはレコードの配列)。先頭の要素からスキーマを推定する
+            if text[pos:pos + 1] == '[':
+                records, _ = _decode_json_values(text, pos, SAMPLE_HEAD_RECORDS)
+                keys = {k for r in records if isinstance(r, dict) for k in r}
+                sampled = _sample_json_records(windows, keys) if keys else []
+                out.append(f"  {key}: array (truncated; large)")
+                out.extend(_preview_records(f"{key}[]", records, sampled, ""))
+            else:
+                out.append(f"  {key}: {'object' if text[pos:pos + 1] == '{' else 'value'} (truncated; large)")
+            break
+    return out
+
+def _csv_records(lines: List[str], delimiter: str, limit: Optional[int] = None):
+    """(解析した行, 元の行) を返す。引用符内に改行を含むレコードは複数行にまたがるため、reader.line_num で元の行を切り出す"""
+    reader = csv.reader(lines, delimiter=delimiter)
+    start = 0
+    for n, row in enumerate(reader, 1):
+        yield row, "\n".join(lines[start:reader.line_num])
+        start = reader.line_num
+        if limit is not None and n >= limit:
+            return
+
+def _preview_csv(head: str, windows: List[str], size: int, delimiter: str) -> List[str]:
+    # 表示には解析前の行をそのまま使う (引用符付きの値を join し直すと列の区切りが崩れて見えるため)
+    records = list(_csv_records(head.splitlines(), delimiter))
+    if not records:
+        return []
+    # 行数の見積もりは先頭全体のレコード単位 (1レコードが複数行にまたがることがあるため、改行の数は使わない)
+    used = sum(len(raw.encode('utf-8')) + 1 for _, raw in records)
+    estimate = f", ~{int(size * (len(records) - 1) / used):,} rows est." if len(records) > 1 and used < size else ""
+    records = records[:SAMPLE_HEAD_RECORDS + 1]
+    header = records[0][0]
+    # 領域の境界で途切れたレコード (列数が合わない、引用符が閉じていない) は使わない
+    complete = lambda row, raw: len(row) == len(header) and raw.count('"') % 2 == 0
+    body = [(row, raw) for row, raw in records[1:] if complete(row, raw)]
+    raw_rows = [records[0][1]] + [raw for _, raw in body]
+    sampled, raw_sampled = [], []
+    for window in windows:
+        # 領域はレコードの途中 (引用符の内側) から始まり得るため、先頭から順に最初の完全なレコードを探す
+        for row, raw in _csv_records(window.splitlines(), delimiter, 10):
+            if complete(row, raw):
+                sampled.append(row)
+                raw_sampled.append(raw)
+                break
+
+    def column_type(values: List[str]) -> str:
+        kinds = []
+        for v in values:
+            v = v.strip()
+            if not v:
+                continue
+            if re.fullmatch(r'[-+]?\d+', v):
+                kind = "int"
+            elif re.fullmatch(r'[-+]?(\d+\.\d*|\.\d+|\d+)([eE][-+]?\d+)?', v):
+                kind = "float"
+            elif v.lower() in ('true', 'false'):
+                kind = "bool"
+            elif re.fullmatch(r'\d{4}-\d{2}-\d{2}([T ][\d:.]+)?.*', v):
+                kind = "date"
+            else:
+                kind = "string"
+            if kind not in kinds:
+                kinds.append(kind)
+        if kinds == ["int", "float"] or kinds == ["float", "int"]:
+            return "float"
+        return "|".join(kinds) or "empty"
+
+    all_rows = [row for row, _ in body] + sampled
+    out = [f"// Columns ({len(header)}, types inferred from {len(all_rows)} rows{estimate}):"]
+    for i, name in enumerate(header):
+        values = [r[i] for r in all_rows if i < len(r)]
+        example = next((v for v in values if v.strip()), "")
+        out.append(f"  {name}: {column_type(values)}{'  e.g. ' + _clip(example, 60) if example else ''}")
+    out.append("// First rows:")
+    out.extend(_clip(r) for r in raw_rows[:SAMPLE_SHOW_RECORDS + 1])
+    if raw_sampled:
+        out.append("// Random rows:")
+        out.extend(_clip(r) for r in raw_sampled)
+    return out
+
+def _preview_yaml(head: str, windows: List[str], size: int) -> List[str]:
+    lines = head.splitlines()
+    out = [f"// Documents in head: {max(1, sum(1 for l in lines if l.startswith('---')))}", "// Top-level keys:"]
+    keys: List[List] = []
+    for line in lines:
+        if not line.strip() or line.lstrip().startswith('#') or line.startswith('---'):
+            continue
+        m = re.match(r'^([^\s#\-][^:]*):(?:\s+(.*))?$', line)
+        if m:
+            keys.append([m.group(1), m.group(2) or "", 0])
+        elif keys and line[:1].isspace():
+            keys[-1][2] += 1
+    for i, (name, value, children) in enumerate(keys[:50]):
+        # 先頭で途切れた最後のキーは、配下の行数が読んだ分より多い
+        more = "+" if windows and i == len(keys) - 1 else ""
+        out.append(f"  {name}: {_clip(value, 60) if value else f'({children}{more} nested lines)'}")
+    if len(keys) > 50:
+        out.append(f"  ... (+{len(keys) - 50} more keys)")
+    out.append("// Head:")
+    out.extend(_clip(l) for l in lines[:SAMPLE_SHOW_RECORDS * 5])
+    return out
+
+def _preview_sql(head: str, windows: List[str], size: int) -> List[str]:
+    """CREATE TABLE の列定義と、INSERT/COPY の件数を表ごとにまとめる (先頭と無作為な位置の領域から)"""
+    tables: Dict[str, List[str]] = {}
+    inserts: Counter = Counter()
+    examples: Dict[str, str] = {}
+    for text in [head] + windows:
+        for m in SQL_CREATE_PATTERN.finditer(text):
+            # 括弧の対応をとって列定義を取り出す
+            depth, pos = 1, m.end()
+            while pos < len(text) and depth:
+                depth += {'(': 1, ')': -1}.get(text[pos], 0)
+                pos += 1
+            if depth:
+                continue
+            columns, part, level = [], [], 0
+            for ch in text[m.end():pos - 1]:
+                level += {'(': 1, ')': -1}.get(ch, 0)
+                if ch == ',' and level == 0:
+                    columns.append("".join(part))
+                    part = []
+                else:
+                    part.append(ch)
+            columns.append("".join(part))
+            defs = [" ".join(c.split()) for c in columns if c.strip() and c.split()[0].upper() not in SQL_CONSTRAINT_WORDS]
+            tables.setdefault(m.group(1).strip('`"[]'), defs)
+        for m in SQL_INSERT_PATTERN.finditer(text):
+            name = m.group(1).strip('`"[]')
+            inserts[name] += 1
+            if name not in examples:
+                examples[name] = text[m.start():text.find("\n", m.start())].strip() if "\n" in text[m.start():] else text[m.start():]
+    out = [f"// Tables with DDL in sampled regions: {len(tables)}"]
+    for name, defs in tables.items():
+        out.append(f"CREATE TABLE {name} ({', '.join(_clip(d, 60) for d in defs)});")
+    if inserts:
+        out.append("// Data statements seen in sampled regions (table: count):")
+        for name, n in inserts.most_common(30):
+            out.append(f"  {name}: {n:,}  e.g. {_clip(examples[name], 120)}")
+    return out
+
+def _preview_lines(head: str, windows: List[str], size: int) -> List[str]:
+    lines = head.splitlines()
+    out = [f"// Lines{_estimate_rows(head, size).replace('rows', 'lines')}", "// Head:"]
+    out.extend(_clip(l) for l in lines[:SAMPLE_SHOW_RECORDS * 5])
+    if windows:
+        out.append("// Random lines:")
+        out.extend(_clip(w.split("\n", 1)[0]) for w in windows)
+    return out
+
+def sample_data_file(path: Path, ext: str) -> str:
+    """
+    巨大なデータファイルの構造のプレビューを作る (先頭 + 無作為な位置の領域のみを読む)。
+    JSON/NDJSON/CSV/TSV はスキーマとレコード例、YAML はキーの一覧、SQL は表ごとの DDL と件数、その他は行の例。
+    """
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            head, windows = _read_sample_regions(f, size)
+    except OSError:
+        return ""
+    kind = ext.lstrip('.').upper()
+    if ext in ('.ndjson', '.jsonl') or (ext == '.json' and head.lstrip().startswith('{') and _looks_like_ndjson(head)):
+        kind, body = "NDJSON", _preview_ndjson(head, windows, size)
+    elif ext == '.json':
+        body = _preview_json(head, windows, size)
+    elif ext in ('.csv', '.tsv'):
+        body = _preview_csv(head, windows, size, '\t' if ext == '.tsv' else ',')
+    elif ext in ('.yaml', '.yml'):
+        body = _preview_yaml(head, windows, size)
+    elif ext == '.sql':
+        body = _preview_sql(head, windows, size)
+    else:
+        body = _preview_lines(head, windows, size)
+    header = (f"// Sampled preview: {path.name} ({kind}, {format_bytes(size)}; "
+              f"read head {format_bytes(min(size, SAMPLE_HEAD_BYTES))} + {len(windows)} random regions)")
+    return "\n".join([header] + body)
+
+def _looks_like_ndjson(head: str) -> bool:
+    """先頭の2行がそれぞれ完結した JSON object なら NDJSON とみなす"""
+    lines = [l for l in head.splitlines()[:2] if l.strip()]
+    if len(lines) < 2:
+        return False
+    try:
+        return all(isinstance(json.loads(l), dict) for l in lines)
+    except ValueError:
+        return False
+
+# ==========================================
+# 3.7. Lightweight BM25 Search Engine
+# ==========================================
+class SimpleBM25:
+    """標準ライブラリのみで実装した軽量BM25検索エンジン"""
+    def __init__(self, corpus: List[str], k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.corpus_size = len(corpus)
+        self.avgdl = 0
+        self.doc_freqs = []
+        self.idf = {}
+        self.doc_len = []
+        
+        self._initialize(corpus)
+
+    def _tokenize(self, text: str) -> List[str]:
+        text = text.lower()
+        # 1. 英数字のまとまりを抽出
+        alphanumeric = re.findall(r'[a-z0-9_]+', text)
+        
+        # 2. 日本語（漢字、ひらがな、カタカナなど）の抽出とバイグラム化（2文字ずつのペア）
+        japanese_text = re.sub(r'[a-z0-9_\s\W]+', '', text)
+        bigrams = [japanese_text[i:i+2] for i in range(len(japanese_text) - 1)] if len(japanese_text) > 1 else [japanese_text] if japanese_text else []
+        
+        tokens = alphanumeric + bigrams
+        return [t for t in tokens if t]
+
+    def _initialize(self, corpus: List[str]):
+        nd = {}
+        num_doc = 0
+        for document in corpus:
+            self.doc_len.append(len(document))
+            num_doc += len(document)
+
+            frequencies = Counter(self._tokenize(document))
+            self.doc_freqs.append(frequencies)
+
+            for word, freq in frequencies.items():
+                if word not in nd:
+                    nd[word] = 0
+                nd[word] += 1
+
+        self.avgdl = num_doc / self.corpus_size if self.corpus_size > 0 else 0
+
+        # IDFの計算
+        for word, freq in nd.items():
+            # BM25+ の式を少しアレンジして負のスコアを防ぐ
+            idf_score = math.log(1 + (self.corpus_size - freq + 0.5) / (freq + 0.5))
+            self.idf[word] = idf_score
+
+    def get_scores(self, query: str, is_debug: bool = False) -> List[float]:
+        score = [0.0] * self.corpus_size
+        query_words = self._tokenize(query)
+        if is_debug:
+            print(f"[DEBUG BM25] Query tokens: {query_words}", file=sys.stderr)
+            
+        for q_word in query_words:
+            if q_word not in self.idf:
+                continue
+            for index, frequencies in enumerate(self.doc_freqs):
+                if q_word in frequencies:
+                    freq = frequencies[q_word]
+                    numerator = self.idf[q_word] * freq * (self.k1 + 1)
+                    denominator = freq + self.k1 * (1 - self.b + self.b * self.doc_len[index] / self.avgdl)
+                    score[index] += numerator / denominator
+        return score
+
+# ==========================================
+# 3.8. ONNX Semantic Search Engine
+# ==========================================
+ONNX_CACHE_DIR_NAME = ".onnx_cache"
+ENCODE_BATCH_SIZE = 32
+ONNX_MAX_AUTO_THREADS = 4  # スレッド数の自動設定時の上限 (小さなモデルでは増やしても速くならず、並列実行時に奪い合う)
+
+def default_onnx_threads() -> int:
+    return max(1, min(ONNX_MAX_AUTO_THREADS, os.cpu_count() or 1))
+
+class EmbeddingCache:
+    """文書(チャンク)本文のハッシュをキーに埋め込みベクトルを保存する永続キャッシュ (.onnx_cache/*.npz)"""
+
+    def __init__(self, cache_dir: Path, model_name: str, is_debug: bool):
+        self.is_debug = is_debug
+        self.path = cache_dir / f"embeddings_{model_name}.npz"
+        self.vectors: Dict[str, 'np.ndarray'] = {}
+        self.dirty = False
+        if self.path.exists():
+            try:
+                data = np.load(self.path, allow_pickle=False)
+                self.vectors = dict(zip(data["keys"].tolist(), data["vecs"]))
+                log_debug(f"Loaded {len(self.vectors)} cached embeddings from {self.path}", is_debug)
+            except Exception as e:
+                log_debug(f"Failed to load embedding cache: {e}", is_debug)
+
+    def get(self, key: str):
+        return self.vectors.get(key)
+
+    def put(self, key: str, vec):
+        self.vectors[key] = np.asarray(vec, dtype=np.float32)
+        self.dirty = True
+
+    def prune(self, live_keys: Set[str]):
+        """現在のコーパスに存在しないベクトルが、生きているベクトル数を超えて溜まった場合に削除する"""
+        stale = [k for k in self.vectors if k not in live_keys]
+        if len(stale) <= len(live_keys):
+            return
+        for k in stale:
+            del self.vectors[k]
+        self.dirty = self.dirty or bool(stale)
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            keys = list(self.vectors.keys())
+            vecs = np.stack([self.vectors[k] for k in keys]) if keys else np.zeros((0, 0), dtype=np.float32)
+            with open(self.path, 'wb') as f:
+                np.savez(f, keys=np.array(keys), vecs=vecs)
+            self.dirty = False
+            log_debug(f"Saved {len(keys)} embeddings to {self.path}", self.is_debug)
+        except Exception as e:
+            log_debug(f"Failed to save embedding cache: {e}", self.is_debug)
+
 class ONNXSemanticSearch:
     """ONNX Runtimeを用いたローカル・セマンティック検索 (Ruri-v3-30m Quantized対応)"""
     
-    def __init__(self, model_dir: Path, is_debug: bool):
+    def __init__(self, model_dir: Path, is_debug: bool, cache_dir: Optional[Path] = None,
+                 intra_threads: int = 0, inter_threads: int = 1, execution_mode: str = 'sequential'):
+        """
+        cache_dir を指定すると、グラフ最適化済みのモデルをそこに保存し、次回以降はそれを読み込む (最適化を省略)。
+        intra_threads=0 はCPU数 (上限 ONNX_MAX_AUTO_THREADS) に合わせる。
+        """
         self.is_debug = is_debug
+        self.intra_threads = intra_threads or default_onnx_threads()
+        self.inter_threads = max(1, inter_threads)
+        self.execution_mode = execution_mode
         self.model_path = model_dir / "model_quantized.onnx"
         self.tokenizer_path = model_dir / "tokenizer.json"
         
@@ -886,46 +2936,142 @@ class ONNXSemanticSearch:
         self.tokenizer.enable_padding(direction='right', pad_id=0, pad_type_id=0, pad_token='[PAD]')
         self.tokenizer.enable_truncation(max_length=512) 
         
+        log_debug(f"Initializing InferenceSession on CPU for Ruri-v3 (intra: {self.intra_threads}, inter: {self.inter_threads}, mode: {self.execution_mode})...", self.is_debug)
+        with PROFILER.phase("onnx_session"):
+            self.session = self._create_session(cache_dir)
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.output_name = self.session.get_outputs()[0].name
+        self.use_io_binding = True
+        log_debug("✅ Ruri-v3 model loaded successfully.", self.is_debug)
+
+    def _session_options(self, level) -> 'ort.SessionOptions':
         opts = ort.SessionOptions()
         opts.log_severity_level = 3
-        log_debug("Initializing InferenceSession on CPU for Ruri-v3...", self.is_debug)
-        self.session = ort.InferenceSession(str(self.model_path), sess_options=opts, providers=['CPUExecutionProvider'])
-        log_debug("✅ Ruri-v3 model loaded successfully.", self.is_debug)
+        opts.intra_op_num_threads = self.intra_threads
+        opts.inter_op_num_threads = self.inter_threads
+        opts.execution_mode = ort.ExecutionMode.ORT_PARALLEL if self.execution_mode == 'parallel' else ort.ExecutionMode.ORT_SEQUENTIAL
+        # 複数のダンプを並列に走らせた時、待機中のスレッドがスピンしてCPUを奪い合わないようにする
+        opts.add_session_config_entry("session.intra_op.allow_spinning", "0")
+        opts.graph_optimization_level = level
+        return opts
+
+    def _optimized_model_path(self, cache_dir: Path) -> Path:
+        """最適化済みモデルの保存先。元モデルとORTのバージョンが変わったら別ファイルになる"""
+        stat = self.model_path.stat()
+        fingerprint = hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}:{ort.__version__}".encode('utf-8')).hexdigest()[:12]
+        return cache_dir / f"{self.model_path.parent.name}.{fingerprint}.opt.onnx"
+
+    def _create_session(self, cache_dir: Optional[Path]) -> 'ort.InferenceSession':
+        providers = ['CPUExecutionProvider']
+        if cache_dir is None:
+            return ort.InferenceSession(str(self.model_path), sess_options=self._session_options(ort.GraphOptimizationLevel.ORT_ENABLE_ALL), providers=providers)
+
+        optimized_path = self._optimized_model_path(cache_dir)
+        if optimized_path.exists():
+            try:
+                # 保存済みのグラフは最適化済みのため、読み込み時の最適化は行わない
+                session = ort.InferenceSession(str(optimized_path), sess_options=self._session_options(ort.GraphOptimizationLevel.ORT_DISABLE_ALL), providers=providers)
+                PROFILER.cache_event("onnx_optimized_model", True)
+                log_debug(f"Loaded pre-optimized model: {optimized_path}", self.is_debug)
+                return session
+            except Exception as e:
+                log_debug(f"Failed to load pre-optimized model, rebuilding: {e}", self.is_debug)
+                try:
+                    optimized_path.unlink()
+                except OSError:
+                    pass
+        PROFILER.cache_event("onnx_optimized_model", False)
+
+        # 最適化したグラフを保存する (ORT_ENABLE_ALL のレイアウト変換はハードウェア依存で保存に向かないため EXTENDED まで)
+        opts = self._session_options(ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED)
+        tmp_path = optimized_path.with_name(f"{optimized_path.name}.{os.getpid()}.tmp")
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            opts.optimized_model_filepath = str(tmp_path)
+            session = ort.InferenceSession(str(self.model_path), sess_options=opts, providers=providers)
+            os.replace(tmp_path, optimized_path)
+            # 元モデルやORTの更新で使われなくなった最適化済みモデルを削除する
+            for stale in cache_dir.glob(f"{self.model_path.parent.name}.*.opt.onnx"):
+                if stale != optimized_path:
+                    stale.unlink()
+            log_debug(f"Saved optimized model: {optimized_path}", self.is_debug)
+            return session
+        except Exception as e:
+            log_debug(f"Failed to save optimized model: {e}", self.is_debug)
+            if tmp_path.exists():
+                tmp_path.unlink()
+            return ort.InferenceSession(str(self.model_path), sess_options=self._session_options(ort.GraphOptimizationLevel.ORT_ENABLE_ALL), providers=providers)
+
+    def _run(self, ort_inputs: Dict[str, 'np.ndarray']) -> 'np.ndarray':
+        """入力をIO Bindingで直接バインドして推論する (使えない環境では session.run に切り替える)"""
+        if self.use_io_binding:
+            try:
+                binding = self.session.io_binding()
+                for name, value in ort_inputs.items():
+                    binding.bind_cpu_input(name, value)
+                binding.bind_output(self.output_name)
+                self.session.run_with_iobinding(binding)
+                return binding.copy_outputs_to_cpu()[0]
+            except Exception as e:
+                log_debug(f"IO binding is unavailable, falling back to session.run: {e}", self.is_debug)
+                self.use_io_binding = False
+        return self.session.run([self.output_name], ort_inputs)[0]
 
     def encode(self, texts: List[str], prefix: str = "") -> 'np.ndarray':
-        prefixed_texts = [prefix + text for text in texts]
         log_debug(f"Encoding {len(texts)} texts with prefix: '{prefix}'", self.is_debug)
-        
+        # パディング長を抑えるため、一定件数ごとのバッチで推論する
+        batches = [self._encode_batch([prefix + t for t in texts[i:i + ENCODE_BATCH_SIZE]])
+                   for i in range(0, len(texts), ENCODE_BATCH_SIZE)]
+        return np.concatenate(batches, axis=0) if batches else np.zeros((0, 0), dtype=np.float32)
+
+    def _encode_batch(self, prefixed_texts: List[str]) -> 'np.ndarray':
         encodings = self.tokenizer.encode_batch(prefixed_texts)
         input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
         attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
         
-        input_names = [i.name for i in self.session.get_inputs()]
         ort_inputs = {
             "input_ids": input_ids,
             "attention_mask": attention_mask
         }
-        if "token_type_ids" in input_names:
+        if "token_type_ids" in self.input_names:
             ort_inputs["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
-            
-        outputs = self.session.run(None, ort_inputs)
-        
-        token_embeddings = outputs[0]
+
+        PROFILER.count("onnx_batches")
+        PROFILER.count("onnx_sequences", len(encodings))
+        PROFILER.count("onnx_tokens", int(attention_mask.sum()))
+        with PROFILER.phase("onnx_inference"):
+            token_embeddings = PROFILER.timed("onnx_inference", f"batch {input_ids.shape[0]}x{input_ids.shape[1]}", self._run, ort_inputs)
+
         input_mask_expanded = np.broadcast_to(np.expand_dims(attention_mask, -1), token_embeddings.shape)
         sum_embeddings = np.sum(token_embeddings * input_mask_expanded, 1)
         sum_mask = np.clip(input_mask_expanded.sum(1), a_min=1e-9, a_max=None)
         
         return sum_embeddings / sum_mask
 
-    def get_scores(self, query: str, corpus: List[str]) -> List[float]:
+    def encode_documents(self, corpus: List[str], embedding_cache: Optional['EmbeddingCache'] = None) -> List['np.ndarray']:
+        """検索文書をベクトル化する。キャッシュがあれば本文ハッシュで引き、未計算のものだけ推論する"""
+        if embedding_cache is None:
+            return list(self.encode(corpus, prefix="検索文書: "))
+        keys = [hashlib.sha1(text.encode('utf-8')).hexdigest() for text in corpus]
+        missing = [i for i, k in enumerate(keys) if embedding_cache.get(k) is None]
+        log_debug(f"Embedding cache: {len(corpus) - len(missing)} hit / {len(missing)} miss", self.is_debug)
+        PROFILER.cache_event("embedding", True, len(corpus) - len(missing))
+        PROFILER.cache_event("embedding", False, len(missing))
+        if missing:
+            vecs = self.encode([corpus[i] for i in missing], prefix="検索文書: ")
+            for i, vec in zip(missing, vecs):
+                embedding_cache.put(keys[i], vec)
+        return [embedding_cache.get(k) for k in keys]
+
+    def get_scores(self, query: str, corpus: List[str], embedding_cache: Optional['EmbeddingCache'] = None) -> List[float]:
         if not corpus:
             return []
         log_debug(f"Calculating semantic similarity for query: '{query}'", self.is_debug)
-        
+
         query_vec = self.encode([query], prefix="検索クエリ: ")[0]
         log_debug("✅ Query encoded.", self.is_debug)
-        
-        corpus_vecs = self.encode(corpus, prefix="検索文書: ")
+
+        corpus_vecs = self.encode_documents(corpus, embedding_cache)
         log_debug("✅ Corpus encoded.", self.is_debug)
         
         scores = []
@@ -941,6 +3087,325 @@ class ONNXSemanticSearch:
         log_debug(f"Scoring completed. Max score: {max(scores):.4f} if scores else 0.0", self.is_debug)
         return scores
 
+# ==========================================
+# 3.9. Two-stage Retrieval (Prefilter -> Rerank)
+# ==========================================
+RRF_K = 60  # Reciprocal Rank Fusion の定数 (一般的な既定値)
+
+def _normalize_for_trigrams(text: str) -> str:
+    return re.sub(r'\s+', ' ', text.lower())
+
+def _char_trigrams(text: str) -> Set[str]:
+    """空白を正規化した文字トライグラム集合 (日本語・部分一致に強い)"""
+    text = _normalize_for_trigrams(text)
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+class TrigramScorer:
+    """
+    クエリの文字トライグラムが文書に含まれる割合を返す軽量スコアラー。
+    文書の正規化 (小文字化・空白の圧縮) は初回の採点時に1回だけ行い、以降のクエリで使い回す
+    (BM25 インデックスと一緒に保持する)。
+    """
+    def __init__(self, corpus: List[str]):
+        self.corpus = corpus
+        self._docs: Optional[List[str]] = None
+
+    def get_scores(self, query: str) -> List[float]:
+        q_grams = _char_trigrams(query)
+        if not q_grams:
+            return [0.0] * len(self.corpus)
+        if self._docs is None:
+            self._docs = [_normalize_for_trigrams(doc) for doc in self.corpus]
+        return [sum(1 for g in q_grams if g in doc) / len(q_grams) for doc in self._docs]
+
+def select_candidates(primary: List[float], secondary: List[float], limit: int) -> List[int]:
+    """
+    一次スコア上位から候補を選び、足りなければ二次スコアで補充する。
+    それでも limit 件に満たなければ、語の重なりがない (0点の) 文書も (一次, 二次) スコア順に加える
+    (意味検索は語が一致しない文書も拾えるため)。文書数が limit 以下なら全件を返す。
+    """
+    if limit <= 0 or len(primary) <= limit:
+        return list(range(len(primary)))
+    candidates = []
+    seen = set()
+    for scores in (primary, secondary):
+        ranked = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+        for i in ranked:
+            if len(candidates) >= limit or scores[i] <= 0.0:
+                break
+            if i not in seen:
+                seen.add(i)
+                candidates.append(i)
+    if len(candidates) < limit:
+        rest = sorted((i for i in range(len(primary)) if i not in seen), key=lambda i: (primary[i], secondary[i]), reverse=True)
+        candidates.extend(rest[:limit - len(candidates)])
+    return candidates
+
+def reciprocal_rank_fusion(score_lists: List[List[float]], k: int = RRF_K) -> List[float]:
+    """複数のスコア列を順位のみで統合する (スケールの異なるスコアの線形結合を避ける)"""
+    size = len(score_lists[0]) if score_lists else 0
+    fused = [0.0] * size
+    for scores in score_lists:
+        ranked = sorted((i for i in range(size) if scores[i] > 0.0), key=lambda i: scores[i], reverse=True)
+        for rank, i in enumerate(ranked, start=1):
+            fused[i] += 1.0 / (k + rank)
+    return fused
+
+def hybrid_search(query: str, corpus: List[str], args, onnx_engine=None, embedding_cache: Optional[EmbeddingCache] = None,
+                  bm25: Optional[SimpleBM25] = None, trigrams: Optional[TrigramScorer] = None) -> List[tuple]:
+    """
+    BM25(またはトライグラム)で候補を絞り込んでから、候補のみをONNXで再ランキングする。
+    bm25 / trigrams に構築済みのものを渡すと再構築を省略する (同じコーパスへの繰り返し検索用)。
+    戻り値: (corpus index, combined, bm25, onnx) のリスト (combined降順)
+    """
+    if bm25 is None:
+        with PROFILER.phase("index"):
+            bm25 = SimpleBM25(corpus)
+    if trigrams is None:
+        trigrams = TrigramScorer(corpus)
+    with PROFILER.phase("search"):
+        return _rank_documents(query, corpus, args, bm25, trigrams, onnx_engine, embedding_cache)
+
+def _rank_documents(query: str, corpus: List[str], args, bm25: SimpleBM25, trigrams: TrigramScorer,
+                    onnx_engine, embedding_cache) -> List[tuple]:
+    bm25_scores = bm25.get_scores(query, args.debug)
+    onnx_scores = [0.0] * len(corpus)
+
+    if onnx_engine is not None:
+        limit = getattr(args, 'rerank_candidates', 0)
+        if limit <= 0 or len(corpus) <= limit:
+            # 全件を再採点できる規模なら絞り込みは不要
+            candidates = list(range(len(corpus)))
+        else:
+            if getattr(args, 'prefilter', 'bm25') == 'trigram':
+                primary, secondary = trigrams.get_scores(query), bm25_scores
+            elif sum(1 for s in bm25_scores if s > 0.0) >= limit:
+                # BM25 だけで候補が埋まる場合、補充用のトライグラムは採点しない (クエリごとの全文書の走査を避ける)
+                primary, secondary = bm25_scores, [0.0] * len(corpus)
+            else:
+                primary, secondary = bm25_scores, trigrams.get_scores(query)
+            candidates = select_candidates(primary, secondary, limit)
+        log_debug(f"Reranking {len(candidates)}/{len(corpus)} candidates with ONNX (prefilter: {getattr(args, 'prefilter', 'bm25')})", args.debug)
+        if candidates:
+            cand_scores = onnx_engine.get_scores(query, [corpus[i] for i in candidates], embedding_cache)
+            for i, s in zip(candidates, cand_scores):
+                onnx_scores[i] = s
+        if args.debug:
+            print(f"[DEBUG ONNX] Max score: {max(onnx_scores) if onnx_scores else 0}", file=sys.stderr)
+
+    # BM25スコアを 0.0 ~ 1.0 に正規化
+    max_bm25 = max(bm25_scores) if bm25_scores and max(bm25_scores) > 0 else 1.0
+    norm_bm25 = [s / max_bm25 for s in bm25_scores]
+    # ONNXスコアの負の値を丸める
+    norm_onnx = [max(0.0, s) for s in onnx_scores]
+
+    if onnx_engine is None:
+        combined_scores = norm_bm25
+    elif getattr(args, 'fusion', 'linear') == 'rrf':
+        combined_scores = reciprocal_rank_fusion([norm_bm25, norm_onnx])
+    else:
+        # セマンティック検索有効時は ONNXを7割、BM25を3割の重みでハイブリッド
+        combined_scores = [(0.3 * b) + (0.7 * o) for b, o in zip(norm_bm25, norm_onnx)]
+
+    return sorted(zip(range(len(corpus)), combined_scores, bm25_scores, onnx_scores), key=lambda x: x[1], reverse=True)
+
+# ==========================================
+# 3.10. Virtual Sources (Git revision / Archive)
+# ==========================================
+class VirtualSource:
+    """
+    作業ツリー以外の入力を、root 配下の仮想パスとして扱うための基底クラス。
+    サブクラスは members ({仮想パス: サイズ}) を登録し、read_bytes() と cache_key() を実装する。
+    """
+    def __init__(self, root: Path):
+        self.root = root
+        self.members: Dict[Path, int] = {}
+        self._children: Dict[Path, Set[Path]] = {}
+
+    def _add_member(self, path: Path, size: int):
+        self.members[path] = size
+        child = path
+        for parent in path.parents:
+            self._children.setdefault(parent, set()).add(child)
+            if parent == self.root:
+                break
+            child = parent
+
+    def owns(self, path: Path) -> bool:
+        return path == self.root or self.root in path.parents
+
+    def is_file(self, path: Path) -> bool:
+        return path in self.members
+
+    def is_dir(self, path: Path) -> bool:
+        return path == self.root or path in self._children
+
+    def iterdir(self, path: Path) -> List[Path]:
+        return list(self._children.get(path, ()))
+
+    def size(self, path: Path) -> int:
+        return self.members.get(path, 0)
+
+    def read(self, path: Path) -> Optional[str]:
+        return decode_content(self.read_bytes(path))
+
+    def read_bytes(self, path: Path) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def cache_key(self, path: Path) -> str:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class GitRevisionSource(VirtualSource):
+    """
+    チェックアウトせずに Git のリビジョンを読む。
+    ツリーは `git ls-tree -r -z -l` で1回だけ列挙し、内容は常駐させた1つの `git cat-file --batch` から取り出す。
+    キャッシュキーには blob の SHA を使うため、同じリビジョンの再ダンプは内容ハッシュの計算も不要。
+    """
+    def __init__(self, root: Path, rev: str):
+        super().__init__(root)
+        self.rev = rev
+        self._blobs: Dict[Path, str] = {}
+        self._proc = None
+        self._lock = threading.Lock()
+
+        res = subprocess.run(['git', 'rev-parse', '--show-toplevel'], cwd=root, capture_output=True, text=True, encoding='utf-8')
+        if res.returncode != 0:
+            raise ValueError(f"{root} はGitリポジトリではありません")
+        self.top = Path(res.stdout.strip()).resolve()
+
+        # --full-name でリポジトリ直下からのパスを得つつ、"." で root 配下に限定する
+        res = subprocess.run(['git', 'ls-tree', '-r', '-z', '-l', '--full-name', rev, '--', '.'], cwd=root, capture_output=True)
+        if res.returncode != 0:
+            raise ValueError(f"リビジョン '{rev}' を読めません: {res.stderr.decode('utf-8', 'replace').strip()}")
+        for record in res.stdout.split(b'\0'):
+            if not record:
+                continue
+            meta, _, name = record.partition(b'\t')
+            mode, obj_type, sha, size = meta.split()
+            # サブモジュール(commit)とシンボリックリンクは対象外
+            if obj_type != b'blob' or mode == b'120000':
+                continue
+            path = self.top / name.decode('utf-8', 'surrogateescape')
+            self._blobs[path] = sha.decode()
+            self._add_member(path, int(size))
+
+    def read_bytes(self, path: Path) -> Optional[bytes]:
+        sha = self._blobs.get(path)
+        if sha is None:
+            return None
+        with self._lock:
+            if self._proc is None:
+                self._proc = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=self.top, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._proc.stdin.write(f"{sha}\n".encode())
+            self._proc.stdin.flush()
+            header = self._proc.stdout.readline().split()
+            if len(header) != 3 or header[1] != b'blob':
+                return None  # "<sha> missing"
+            data = self._proc.stdout.read(int(header[2]))
+            self._proc.stdout.read(1)  # 末尾の改行
+        return data
+
+    def cache_key(self, path: Path) -> str:
+        return f"blob:{self._blobs[path]}"
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait()
+            self._proc = None
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz')
+
+def is_archive_path(path: Path) -> bool:
+    return path.is_file() and path.name.lower().endswith(ARCHIVE_SUFFIXES)
+
+def _archive_member_path(root: Path, name: str) -> Optional[Path]:
+    """メンバ名を root 配下の仮想パスに変換する (絶対パスや .. による root 外への脱出は無視)"""
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+    return root.joinpath(*parts) if parts else None
+
+class ArchiveSource(VirtualSource):
+    """
+    zip / tar / tar.gz を展開せずに読む。アーカイブ自体のパスを仮想ディレクトリの root とする。
+    構築時はメンバの一覧 (ヘッダ) だけを読み、内容は read_bytes() で要求された時に取り出す (常駐させない)。
+    - zip: キャッシュキーは中央ディレクトリの CRC とサイズ。内容はスレッドごとに開いたハンドルから並列に展開する
+    - tar: ヘッダに CRC はないため、キャッシュキーはアーカイブのパス・メンバ名・mtime・サイズから作る。
+      内容はスレッドごとに開いたハンドルでメンバの位置へシークして読む
+      (圧縮 tar は後方へのシークで先頭から展開し直すため、メンバの格納順に読むほど速い。走査はこの順で行われる)
+    """
+    def __init__(self, root: Path):
+        super().__init__(root)
+        self._crcs: Dict[Path, int] = {}
+        self._names: Dict[Path, str] = {}
+        self._infos: Dict[Path, tarfile.TarInfo] = {}
+        self._local = threading.local()
+        self._handles: List = []
+        self._lock = threading.Lock()
+        self.is_zip = root.name.lower().endswith('.zip')
+        try:
+            if self.is_zip:
+                with zipfile.ZipFile(root) as zf:
+                    for info in zf.infolist():
+                        path = _archive_member_path(root, info.filename)
+                        if info.is_dir() or path is None:
+                            continue
+                        self._add_member(path, info.file_size)
+                        self._names[path] = info.filename
+                        self._crcs[path] = info.CRC
+            else:
+                with tarfile.open(root, 'r|*') as tf:
+                    for info in tf:
+                        path = _archive_member_path(root, info.name)
+                        if not info.isfile() or path is None:
+                            continue
+                        self._add_member(path, info.size)
+                        self._infos[path] = info
+        except (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error) as e:
+            raise ValueError(f"アーカイブを読めません: {root} ({e})")
+
+    def _handle(self):
+        """このスレッド用のアーカイブのハンドル (close() でまとめて閉じる)"""
+        handle = getattr(self._local, 'handle', None)
+        if handle is None:
+            handle = self._local.handle = zipfile.ZipFile(self.root) if self.is_zip else tarfile.open(self.root, 'r:*')
+            with self._lock:
+                self._handles.append(handle)
+        return handle
+
+    def read_bytes(self, path: Path) -> Optional[bytes]:
+        if self.is_zip:
+            name = self._names.get(path)
+            if name is None:
+                return None
+            try:
+                return self._handle().read(name)
+            except (zipfile.BadZipFile, zlib.error, OSError):
+                return None
+        info = self._infos.get(path)
+        if info is None:
+            return None
+        try:
+            f = self._handle().extractfile(info)
+            return f.read() if f else b''
+        except (tarfile.TarError, EOFError, zlib.error, OSError):
+            return None
+
+    def cache_key(self, path: Path) -> str:
+        if self.is_zip:
+            return f"crc32:{self._crcs.get(path, 0):08x}:{self.size(path)}"
+        info = self._infos[path]
+        return f"tar:{compute_content_key(f'{self.root}:{info.name}:{info.mtime}')}:{info.size}"
+
+    def close(self):
+        with self._lock:
+            for handle in self._handles:
+                handle.close()
+            self._handles = []
+        self._local = threading.local()
+
 # ==========================================
 # 4. Main Workflow
 # ==========================================
@@ -973,15 +3438,371 @@ def get_git_files(root_path: Path, mode: str) -> Set[str]:
                         files.add(str((root_path / line.strip()).resolve()))
         except Exception:
             pass
-    return files
+    return files
+
+HUNK_HEADER_PATTERN = re.compile(r'^@@ -\d+(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+HUNK_CONTEXT_LINES = 3  # 定義の外側の変更に付ける前後の行数
+
+def get_git_hunks(root_path: Path, mode: str) -> Dict[str, List[Tuple[int, int, int]]]:
+    """
+    `git diff -U0` を1回だけ解析し、ファイル(絶対パス)ごとの変更ハンクを返す。
+    戻り値: {path: [(新ファイルでの開始行, 追加行数, 削除行数)]}
+    ※ 追加行数0 (削除のみ) の場合、開始行は削除位置の直前の行を指す
+    ※ 未追跡ファイルはハンクを持たないため含まれない (呼び出し側で全文扱い)
+    """
+    hunks: Dict[str, List[Tuple[int, int, int]]] = {}
+    try:
+        res = subprocess.run(['git', 'rev-parse', '--show-toplevel'], cwd=root_path, capture_output=True, text=True, encoding='utf-8')
+        if res.returncode != 0:
+            return hunks
+        top = Path(res.stdout.strip())
+
+        base = ['git', '-c', 'core.quotepath=off', 'diff', '-U0', '--no-color', '--no-ext-diff', '--no-renames']
+        if mode == 'Staged':
+            cmds = [base + ['--cached']]
+        else:
+            # 作業ツリー vs HEAD (ステージ済み+未ステージ)。HEADが無い新規リポジトリでは作業ツリー vs インデックス
+            cmds = [base + ['HEAD'], base]
+        for cmd in cmds:
+            res = subprocess.run(cmd, cwd=top, capture_output=True, text=True, encoding='utf-8', errors='replace')
+            if res.returncode == 0:
+                break
+        else:
+            return hunks
+
+        current = None
+        for line in res.stdout.splitlines():
+            if line.startswith('+++ '):
+                target = line[4:].rstrip('\t')
+                current = None if target == '/dev/null' else str((top / target[2:]).resolve())
+            elif current and line.startswith('@@'):
+                m = HUNK_HEADER_PATTERN.match(line)
+                if m:
+                    removed = int(m.group(1)) if m.group(1) is not None else 1
+                    added = int(m.group(3)) if m.group(3) is not None else 1
+                    hunks.setdefault(current, []).append((int(m.group(2)), added, removed))
+    except Exception:
+        pass
+    return hunks
+
+def merge_line_regions(regions: List[List]) -> List[List]:
+    """[開始行, 終了行, [定義名]] の並びを、重なる・隣接するものどうしでまとめる"""
+    merged = []
+    for region in sorted(regions):
+        if merged and region[0] <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], region[1])
+            merged[-1][2].extend(n for n in region[2] if n not in merged[-1][2])
+        else:
+            merged.append(region)
+    return merged
+
+def render_hunks(content: str, ext: str, hunks: List[Tuple[int, int, int]], context: int = HUNK_CONTEXT_LINES) -> str:
+    """
+    各ハンクを、変更行を含む最も内側の定義 (関数/クラス) にまとめて出力する。
+    定義の外側の変更は前後 context 行のみ。変更行には "+"、削除位置には "-" の印を付ける。
+    """
+    lines = content.splitlines()
+    if not lines:
+        return content
+    symbols = extract_symbols(content, ext)
+
+    changed: Set[int] = set()
+    removed_after: Dict[int, int] = {}
+    regions = []
+    for start, added, removed in hunks:
+        if added:
+            lo, hi = start, start + added - 1
+            changed.update(range(lo, hi + 1))
+        else:
+            lo = hi = max(start, 1)
+            removed_after[start] = removed_after.get(start, 0) + removed
+        lo, hi = max(lo, 1), min(hi, len(lines))
+        if lo > hi:
+            continue
+
+        enclosing = [s for s in symbols if s["start"] <= lo and hi <= s["end"]]
+        if enclosing:
+            s = min(enclosing, key=lambda s: s["end"] - s["start"])
+            regions.append([s["start"], s["end"], [s["name"]]])
+            continue
+        # 複数の定義にまたがる変更は、触れた定義全体 + 前後の文脈を出す
+        touched = [s for s in symbols if s["start"] <= hi and lo <= s["end"]]
+        lo = min([lo - context] + [s["start"] for s in touched])
+        hi = max([hi + context] + [s["end"] for s in touched])
+        regions.append([max(lo, 1), min(hi, len(lines)), [s["name"] for s in touched if s["depth"] == 0]])
+
+    width = len(str(len(lines)))
+    parts = []
+    for start, end, names in merge_line_regions(regions):
+        label = f" {', '.join(names)}" if names else ""
+        body = [f"// [Hunk L{start}-{end}{label}]"]
+        if start == 1 and 0 in removed_after:
+            body.append(f"- {'':>{width}} | [{removed_after[0]} line(s) removed]")
+        for no in range(start, end + 1):
+            body.append(f"{'+' if no in changed else ' '} {no:>{width}} | {lines[no - 1]}")
+            if no in removed_after:
+                body.append(f"- {'':>{width}} | [{removed_after[no]} line(s) removed]")
+        parts.append("\n".join(body))
+    return "\n// ...\n".join(parts)
+
+GREP_CONTEXT_LINES = 2  # --grep で一致行の前後に出力する行数 (デフォルト)
+
+def render_grep(content: str, ext: str, match_lines: List[int], context: int = GREP_CONTEXT_LINES,
+                definitions: bool = False) -> str:
+    """
+    一致行の前後 context 行を出力する。definitions 時は一致行を含む最も内側の定義 (関数/クラス) 全体を出力する
+    (定義の外側の一致行は前後 context 行のみ)。一致行には ">" の印を付ける。
+    """
+    lines = content.splitlines()
+    if not lines:
+        return content
+    symbols = extract_symbols(content, ext) if definitions else []
+    regions = []
+    for no in match_lines:
+        enclosing = [s for s in symbols if s["start"] <= no <= s["end"]]
+        if enclosing:
+            s = min(enclosing, key=lambda s: s["end"] - s["start"])
+            regions.append([s["start"], s["end"], [s["name"]]])
+        else:
+            regions.append([max(no - context, 1), min(no + context, len(lines)), []])
+
+    matched = set(match_lines)
+    width = len(str(len(lines)))
+    parts = []
+    for start, end, names in merge_line_regions(regions):
+        label = f" {', '.join(names)}" if names else ""
+        body = [f"// [Match L{start}-{end}{label}]"]
+        body.extend(f"{'>' if no in matched else ' '} {no:>{width}} | {lines[no - 1]}" for no in range(start, end + 1))
+        parts.append("\n".join(body))
+    return "\n// ...\n".join(parts)
+
+def should_exclude(name: str, excludes: List[str]) -> bool:
+    for pattern in excludes:
+        if fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+DIR_MTIME_GRANULARITY_NS = 2_000_000_000  # ディレクトリ mtime の粒度の想定上限 (FAT は2秒。NFS/SMB も秒単位のことがある)
+
+class DirManifest:
+    """
+    ディレクトリごとの mtime と一覧 (サブディレクトリ名・ファイルの mtime/size) の永続マニフェスト。
+    ディレクトリの mtime が前回と同じなら、一覧 (scandir) を取り直さずに記録をそのまま使う。
+    mtime が違う、または rescan 指定時は一覧を取り直す。
+    ※ ディレクトリの mtime はエントリの追加・削除・名前変更でのみ変わり、既存ファイルをその場で書き換えても
+       変わらない。そのためファイル自体の (mtime, size) は記録を信用せず、stat() で毎回取り直す。
+    ※ 一覧を取った時刻も記録し、mtime がその時刻から粒度 (DIR_MTIME_GRANULARITY_NS) 以内なら取り直す。
+       mtime の粗いファイルシステムでは、一覧の直後 (同じ刻み) に追加されたファイルで mtime が変わらないため。
+    ※ ファイル扱いの基準は scan_dir (os.walk) と同じ: ディレクトリ以外のエントリ (ソケット・FIFO・
+       リンク切れのシンボリックリンクを含む) はすべてファイルとして記録する (stat できないものは [0, -1])。
+
+    構造: {ディレクトリの絶対パス: {"mtime": ns, "scanned": ns, "dirs": [名前], "links": [名前], "files": {名前: [mtime, size]}}}
+    """
+
+    def __init__(self, data: Dict, rescan: bool = False):
+        self.dirs: Dict[str, Dict] = data.setdefault("dirs", {})
+        self.rescan = rescan
+        self.seen: Set[str] = set()
+
+    def listing(self, dirpath: str) -> Dict:
+        """ディレクトリの一覧を返す (読めない場合は OSError)"""
+        mtime = os.stat(dirpath).st_mtime_ns
+        record = self.dirs.get(dirpath)
+        # 一覧を取った時刻と mtime が粒度の範囲内で重なる記録は、同じ刻みの追加を見逃している可能性がある
+        racy = record is not None and mtime >= record.get("scanned", 0) - DIR_MTIME_GRANULARITY_NS
+        if record and not self.rescan and record.get("mtime") == mtime and not racy:
+            PROFILER.cache_event("dir_listing", True)
+        else:
+            PROFILER.cache_event("dir_listing", False)
+            scanned = time.time_ns()
+            subdirs, links, files = [], [], {}
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        # os.walk と同様、シンボリックリンクのディレクトリはたどらない
+                        (links if entry.is_symlink() else subdirs).append(entry.name)
+                        continue
+                    try:
+                        st = entry.stat()
+                        files[entry.name] = [st.st_mtime, st.st_size]
+                    except OSError:
+                        files[entry.name] = [0, -1]
+            record = {"mtime": mtime, "scanned": scanned, "dirs": sorted(subdirs), "links": sorted(links), "files": files}
+            self.dirs[dirpath] = record
+        self.seen.add(dirpath)
+        return record
+
+    def entries(self, dirpath: str) -> Tuple[List[str], List[str]]:
+        """(たどるサブディレクトリ名, ファイル名) を返す (parallel_walk 用)"""
+        record = self.listing(dirpath)
+        return record["dirs"], list(record["files"])
+
+    def walk(self, root: str, excludes: List[str], threads: int = 1):
+        """os.walk と同じ (dirpath, filenames) を、記録済みの一覧を使いながら上から順に返す"""
+        if threads > 1:
+            yield from parallel_walk(root, excludes, threads, self.entries)
+            return
+        stack = [root]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                record = self.listing(dirpath)
+            except OSError:
+                continue
+            yield dirpath, list(record["files"])
+            for name in reversed(record["dirs"]):
+                if not should_exclude(name, excludes):
+                    stack.append(os.path.join(dirpath, name))
+
+    def _parent(self, path: Path) -> Optional[Dict]:
+        parent = str(path.parent)
+        return self.dirs.get(parent) if parent in self.seen else None
+
+    def has_file(self, path: Path) -> Optional[bool]:
+        """走査時の一覧にファイルとして載っているか。今回一覧を確認していないディレクトリは None"""
+        record = self._parent(path)
+        return None if record is None else path.name in record["files"]
+
+    def stat(self, path: Path) -> Optional[Tuple[float, int]]:
+        """
+        ファイルの現在の (mtime, size) を返し、記録も更新する (読めない場合は None)。
+        一覧を再利用したディレクトリでも、その場で書き換えられたファイルを見逃さないよう毎回 stat する。
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        record = self._parent(path)
+        if record is not None and path.name in record["files"]:
+            record["files"][path.name] = [st.st_mtime, st.st_size]
+        return st.st_mtime, st.st_size
+
+    def is_dir(self, path: Path) -> Optional[bool]:
+        if str(path) in self.seen:
+            return True
+        record = self._parent(path)
+        if record is None:
+            return None
+        return path.name in record["dirs"] or path.name in record["links"]
+
+    def iterdir(self, path: Path) -> Optional[List[Path]]:
+        if str(path) not in self.seen:
+            return None
+        record = self.dirs[str(path)]
+        return [path / name for name in record["dirs"] + record["links"] + list(record["files"])]
+
+    def prune(self):
+        """今回たどらず、もう存在しないディレクトリの記録を削除する"""
+        for dirpath in [d for d in self.dirs if d not in self.seen and not os.path.isdir(d)]:
+            del self.dirs[dirpath]
+
+def scan_dir(dirpath: str) -> Tuple[List[str], List[str]]:
+    """os.walk と同じ基準で (たどるサブディレクトリ名, ファイル名) を返す (読めない場合は OSError)"""
+    subdirs, files = [], []
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                files.append(entry.name)
+            elif not entry.is_symlink():
+                # os.walk と同様、シンボリックリンクのディレクトリはたどらない (ファイル扱いにもしない)
+                subdirs.append(entry.name)
+    return subdirs, files
+
+def parallel_walk(root: str, excludes: List[str], threads: int, lister=scan_dir):
+    """
+    ワークスティーリング方式の並列ディレクトリ走査。(dirpath, filenames) を os.walk と同じ順 (前順) で返す。
+    各スレッドは自分のキューの末尾からディレクトリを取り出して lister で一覧を取り、サブディレクトリを
+    自分のキューに積む (深さ優先)。キューが空になったら他スレッドのキューの先頭 (根に近い大きな部分木) を盗む。
+    os.scandir は待ち時間の間 GIL を解放するため、1回ごとに往復が発生する NFS/SMB では待ち時間が重なって速くなる。
+    走査は順不同に進むが、返す側は親 -> 子 (一覧の順) の順に結果がそろうのを待つので、出力順はスレッド数に依らない。
+    lister(dirpath) -> (たどるサブディレクトリ名, ファイル名)。OSError のディレクトリは os.walk と同様に飛ばす。
+    """
+    queues = [deque() for _ in range(threads)]
+    queues[0].append(root)
+    results: Dict[str, object] = {}
+    cond = threading.Condition()
+    state = {"pending": 1, "stop": False}
+
+    def take(index: int) -> Optional[str]:
+        try:
+            return queues[index].pop()
+        except IndexError:
+            pass
+        for offset in range(1, threads):
+            try:
+                return queues[(index + offset) % threads].popleft()
+            except IndexError:
+                continue
+        return None
 
-def should_exclude(name: str, excludes: List[str]) -> bool:
-    for pattern in excludes:
-        if fnmatch.fnmatch(name, pattern):
-            return True
-    return False
+    def worker(index: int):
+        while not state["stop"]:
+            dirpath = take(index)
+            if dirpath is None:
+                with cond:
+                    while not state["stop"] and state["pending"] > 0 and not any(queues):
+                        cond.wait()
+                    if state["stop"] or state["pending"] == 0:
+                        return
+                continue
+            children = []
+            try:
+                subdirs, files = lister(dirpath)
+                children = [os.path.join(dirpath, d) for d in subdirs if not should_exclude(d, excludes)]
+                entry = (files, children)
+            except OSError:
+                entry = None
+            except Exception as e:  # 想定外のエラーは呼び出し側のスレッドで送出する
+                entry = e
+            queues[index].extend(reversed(children))
+            with cond:
+                results[dirpath] = entry
+                state["pending"] += len(children) - 1
+                cond.notify_all()
+
+    pool = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(threads)]
+    for t in pool:
+        t.start()
+    try:
+        stack = [root]
+        while stack:
+            dirpath = stack.pop()
+            with cond:
+                while dirpath not in results:
+                    cond.wait()
+                entry = results.pop(dirpath)
+            if isinstance(entry, Exception):
+                raise entry
+            if entry is None:
+                continue
+            files, children = entry
+            yield dirpath, files
+            stack.extend(reversed(children))
+    finally:
+        # 途中で打ち切られた場合も含め、残りのスレッドを止める
+        with cond:
+            state["stop"] = True
+            cond.notify_all()
+
+def walk_disk(root_path: Path, excludes: List[str], threads: int = 1):
+    """os.walk で (dirpath, filenames) を返す (マニフェストを使わない場合)"""
+    if threads > 1:
+        yield from parallel_walk(str(root_path), excludes, threads)
+        return
+    for dirpath, dirnames, filenames in os.walk(root_path):
+        # 除外ディレクトリのフィルタリング
+        dirnames[:] = [d for d in dirnames if not should_exclude(d, excludes)]
+        yield dirpath, filenames
 
-def collect_files(root_path: Path, args, git_allowed) -> List[Path]:
+def collect_files(root_path: Path, args, git_allowed, manifest: Optional[DirManifest] = None) -> List[Path]:
     target_files = []
     
     # 対象がディレクトリではなく単一ファイルの場合の直接処理
@@ -996,10 +3817,13 @@ def collect_files(root_path: Path, args, git_allowed) -> List[Path]:
             return [root_path]
         return []
 
-    for dirpath, dirnames, filenames in os.walk(root_path):
-        # 除外ディレクトリのフィルタリング
-        dirnames[:] = [d for d in dirnames if not should_exclude(d, args.exclude)]
-        
+    # 変更のないディレクトリは記録済みの一覧を使う (除外ディレクトリのフィルタリングは walk 内で行う)
+    if manifest is not None:
+        walked = manifest.walk(str(root_path), args.exclude, args.walk_threads)
+    else:
+        walked = walk_disk(root_path, args.exclude, args.walk_threads)
+
+    for dirpath, filenames in walked:
         # ディレクトリ構造のみモードの場合はファイルを収集しない
         if args.directories_only:
             continue
@@ -1025,6 +3849,9 @@ def collect_files(root_path: Path, args, git_allowed) -> List[Path]:
     return target_files
 
 def read_content(path: Path) -> Optional[str]:
+    # 一覧には FIFO・ソケット等も載る (os.walk と同じ) が、FIFO は開くと書き込み側を待って止まるため読まない
+    if not path.is_file():
+        return None
     for enc in ['utf-8', 'cp932', 'latin-1']:
         try:
             with open(path, 'r', encoding=enc) as f:
@@ -1033,6 +3860,133 @@ def read_content(path: Path) -> Optional[str]:
             continue
     return None
 
+def decode_content(data: Optional[bytes]) -> Optional[str]:
+    """read_content と同じ順でデコードする (改行も open() のテキストモードと同様に \\n へ正規化)"""
+    if data is None:
+        return None
+    for enc in ['utf-8', 'cp932', 'latin-1']:
+        try:
+            text = data.decode(enc)
+        except Exception:
+            continue
+        return text.replace('\r\n', '\n').replace('\r', '\n')
+    return None
+
+CONTENT_LRU_BYTES = 32 * 1024 * 1024  # 段をまたいで共有する本文の LRU の上限 (UTF-8 のバイト数)
+
+class ContentStore:
+    """
+    file_map の代わりに使う、本文を常駐させないマッピング。
+    読み込み段では存在と「本文の有無」だけを記録し、本文は解析後に捨てる。
+    本文が必要になった時点で reader から読み直す (同じサイズ上限を再適用)。
+    読んだ本文 (読み込み段で remember() されたものを含む) は上限付きの LRU に入れ、Focus・grep・全文検索・
+    チャンク分割・出力の各段で共有する (同じファイルを段ごとに読み直さない)。
+    ※ LRU に収まらない規模では、キャッシュのない初回は出力するファイルを解析時と出力時の2回読む
+       (メモリを「LRU の上限 + 最大のファイル × ワーカー数」程度に抑えるための、読み込み量とのトレードオフ)。
+    """
+
+    def __init__(self, reader, max_bytes: float, lru_bytes: int = CONTENT_LRU_BYTES):
+        self.reader = reader
+        self.max_bytes = max_bytes
+        self.has_body: Dict[Path, bool] = {}
+        self.lru_bytes = lru_bytes
+        self._lru: "OrderedDict[Path, Tuple[str, int]]" = OrderedDict()
+        self._lru_size = 0
+        self._lock = threading.Lock()
+
+    def register(self, path: Path, has_body: bool):
+        self.has_body[path] = has_body
+
+    def has_content(self, path: Path) -> bool:
+        return self.has_body.get(path, False)
+
+    def remember(self, path: Path, content: str, size: int):
+        """読んだ本文 (size は UTF-8 のバイト数) を LRU に入れ、上限を超えた分を古い順に捨てる"""
+        if not content or size > self.lru_bytes:
+            return
+        with self._lock:
+            old = self._lru.pop(path, None)
+            if old is not None:
+                self._lru_size -= old[1]
+            self._lru[path] = (content, size)
+            self._lru_size += size
+            while self._lru_size > self.lru_bytes:
+                _, (_, dropped) = self._lru.popitem(last=False)
+                self._lru_size -= dropped
+
+    def __getitem__(self, path: Path) -> str:
+        if path not in self.has_body:
+            raise KeyError(path)
+        if not self.has_body[path]:
+            return ""
+        with self._lock:
+            cached = self._lru.get(path)
+            if cached is not None:
+                self._lru.move_to_end(path)
+        PROFILER.cache_event("body", cached is not None)
+        if cached is not None:
+            return cached[0]
+        PROFILER.count("files_reread")
+        content = self.reader(path)
+        size = len(content.encode('utf-8')) if content else 0
+        if not content or size > self.max_bytes:
+            return ""
+        self.remember(path, content, size)
+        return content
+
+    def get(self, path: Path, default: str = "") -> str:
+        return self[path] if path in self.has_body else default
+
+    def __contains__(self, path) -> bool:
+        return path in self.has_body
+
+    def __iter__(self):
+        return iter(self.has_body)
+
+    def __len__(self) -> int:
+        return len(self.has_body)
+
+    def keys(self):
+        return self.has_body.keys()
+
+    def items(self):
+        """(パス, 本文) を1件ずつ読み直して返す (全件を同時には保持しない)"""
+        for path in self.has_body:
+            yield path, self[path]
+
+def run_bounded(fn, items, max_workers: Optional[int] = None, max_pending: Optional[int] = None):
+    """
+    items を fn で並列処理し、(item, 結果) を入力順に返すジェネレータ。
+    未完了のタスク数を max_pending までに抑えるため、消費側が遅ければ投入も止まる (back-pressure)。
+    fn の中で本文を読み、小さな解析結果だけを返すようにすれば、同時に保持する本文はワーカー数程度に収まる。
+    """
+    max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+    max_pending = max_pending or max_workers * 2
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(fn, item)))
+            if len(pending) >= max_pending:
+                done_item, future = pending.popleft()
+                yield done_item, future.result()
+        while pending:
+            done_item, future = pending.popleft()
+            yield done_item, future.result()
+
+def collect_virtual_files(source: "VirtualSource", args) -> List[Path]:
+    """仮想ソースのメンバを、collect_files と同じ除外・プレビュー規則で絞り込む"""
+    if args.directories_only:
+        return []
+    target_files = []
+    for f_path in source.members:
+        rel_parts = f_path.relative_to(source.root).parts
+        if any(should_exclude(part, args.exclude) for part in rel_parts):
+            continue
+        ext = f_path.suffix.lower()
+        if (ext in args.preview_exts) or args.include_non_preview:
+            target_files.append(f_path)
+    return target_files
+
 def load_gitignore_patterns(root_path: Path) -> List[str]:
     """ .gitignoreを読み込み、fnmatch用のパターンリストを返す """
     patterns = []
@@ -1054,9 +4008,184 @@ def load_gitignore_patterns(root_path: Path) -> List[str]:
     return patterns
 
 
-def print_visual_tree(node, prefix="", is_last=True):
+def iter_file_nodes(node, current_path=""):
+    """出力ツリーのファイルノードを出力順に (ルートからの相対パス, ノード) で列挙する"""
+    if "children" in node:
+        for child in node["children"]:
+            # 親パスと子要素の名前を結合して現在のパスを生成
+            child_path = f"{current_path}/{child['name']}".strip('/') if current_path else child['name']
+            yield from iter_file_nodes(child, child_path)
+    else:
+        yield (current_path if current_path else node['name']), node
+
+DEDUP_MIN_CHARS = 64  # 参照に置き換えても節約にならない短いプレビューは対象外
+
+def dedupe_file_nodes(root_node: Dict) -> Dict:
     """
-    JSON構造を再帰的に走査して、視覚的なツリーを表示する。
+    レンダリング済みプレビューのハッシュで重複を検出し、2回目以降のファイルを
+    {"name", "same_as": 最初に出現したパス} に置き換える。
+    戻り値: {"files": 置き換えた件数, "previews": 省略したプレビュー本文のリスト}
+    """
+    first_seen: Dict[str, str] = {}
+    stats = {"files": 0, "previews": []}
+    for path, node in iter_file_nodes(root_node):
+        preview = node.get("preview")
+        if not preview or len(preview) < DEDUP_MIN_CHARS:
+            continue
+        digest = hashlib.sha1(preview.encode('utf-8')).hexdigest()
+        if digest in first_seen:
+            node["same_as"] = first_seen[digest]
+            del node["preview"]
+            stats["files"] += 1
+            stats["previews"].append(preview)
+        else:
+            first_seen[digest] = path
+    return stats
+
+def render_text_block(file_path: str, node: Dict, is_debug: bool = False) -> str:
+    """ファイルノード1件分のMarkdown風テキスト"""
+    # 分割出力で1ファイルを複数パートに分けた場合はパート番号を付ける
+    part = f" (part {node['part']})" if node.get("part") else ""
+    if node.get("rollup"):
+        return f"### Directory: {file_path}/ (rollup){part}\n```\n{node.get('preview', '')}\n```\n"
+    if node.get("same_as"):
+        log_debug(f"Added duplicate reference for text output: {file_path}", is_debug)
+        return f"### File: {file_path} (same as {node['same_as']})\n"
+    if node.get("similar_to"):
+        log_debug(f"Added near-duplicate reference for text output: {file_path}", is_debug)
+        if node.get("diff"):
+            return f"### File: {file_path} (similar to {node['similar_to']}, ~{node['similarity']:.0%}; diff){part}\n```diff\n{node['diff']}\n```\n"
+        return f"### File: {file_path} ({node['note']})\n"
+    if node.get("preview") is not None and node.get("preview") != "":
+        ext = '.' + node['name'].split('.')[-1].lower() if '.' in node['name'] else ''
+        lang = TREESITTER_EXT_MAP.get(ext, "")
+        log_debug(f"Added content for text output: {file_path}", is_debug)
+        return f"### File: {file_path}{part}\n```{lang}\n{node['preview']}\n```\n"
+    log_debug(f"Added file path only for text output: {file_path}", is_debug)
+    return f"### File: {file_path} (No content preview)\n"
+
+def render_text(root_node: Dict, is_debug: bool = False) -> str:
+    """出力ツリーをMarkdown風テキストに変換する"""
+    return "\n".join(render_text_block(file_path, node, is_debug) for file_path, node in iter_file_nodes(root_node))
+
+def tree_from_file_nodes(root_name: str, items: List[Tuple[str, Dict]]) -> Dict:
+    """(ルートからの相対パス, ファイルノード) の並びから、出力ツリーと同じ形のツリーを組み立て直す"""
+    root = {"name": root_name, "children": [], "files_inside": False}
+    dirs = {"": root}
+    for rel, node in items:
+        parent = root
+        parts = rel.split('/')
+        for depth in range(1, len(parts)):
+            dir_path = '/'.join(parts[:depth])
+            if dir_path not in dirs:
+                dirs[dir_path] = {"name": parts[depth - 1], "children": [], "files_inside": False}
+                parent["children"].append(dirs[dir_path])
+            parent = dirs[dir_path]
+        parent["children"].append(node)
+    for d in dirs.values():
+        d["files_inside"] = bool(d["children"])
+    return root
+
+SNAPSHOT_LIMIT = 20  # 保持するスナップショットの数 (古いものから削除)
+CHANGE_MARKS = {"added": "+", "modified": "~", "deleted": "-"}
+
+def render_change_tree(root_name: str, changes: Dict[str, List[str]]) -> str:
+    """追加(+)/変更(~)/削除(-) されたファイルを、印付きのコンパクトなツリーにする"""
+    items = sorted((rel, {"name": f"{rel.rsplit('/', 1)[-1]} [{mark}]"})
+                   for status, mark in CHANGE_MARKS.items() for rel in changes.get(status, []))
+    tree = tree_from_file_nodes(root_name, items)
+    lines = [f"{root_name}/"]
+    for i, child in enumerate(tree["children"]):
+        lines.extend(visual_tree_lines(child, "", i == len(tree["children"]) - 1))
+    return "\n".join(lines)
+
+def render_since_header(since: Dict, root_name: str) -> str:
+    """差分ダンプ (--since) のテキスト出力の先頭に付ける変更一覧"""
+    counts = ", ".join(f"{len(since[status])} {status}" for status in CHANGE_MARKS)
+    return (f"## Changes since snapshot '{since['snapshot']}' ({since['created']}; {counts})\n"
+            f"```\n{render_change_tree(root_name, since)}\n```\n\n")
+
+def split_oversized_node(node: Dict, budget: int, count) -> List[Dict]:
+    """1ファイルだけで予算を超えるノードを、行単位で予算内のパート ("part": "k/m") に分ける"""
+    field = "diff" if node.get("diff") else "preview"
+    lines = (node.get(field) or "").splitlines()
+    pieces, current, used = [], [], 0
+    for line in lines:
+        # 行の区切り (改行) の分として1トークンを見込む
+        tokens = count(line) + 1
+        if current and used + tokens > budget:
+            pieces.append(current)
+            current, used = [], 0
+        current.append(line)
+        used += tokens
+    if current:
+        pieces.append(current)
+    if len(pieces) <= 1:
+        return [node]
+    parts = []
+    for i, piece in enumerate(pieces, 1):
+        part = dict(node)
+        part[field] = "\n".join(piece)
+        part["part"] = f"{i}/{len(pieces)}"
+        parts.append(part)
+    return parts
+
+def split_file_nodes(root_node: Dict, max_tokens: int, count, render_block, overhead: int = 0, line_count=None,
+                     dir_overhead=None) -> List[List[Tuple[str, Dict]]]:
+    """
+    出力ツリーのファイルを、1パートあたり max_tokens 以内に収まるよう出力順に詰めていく。
+    同じディレクトリのファイルは、現在のパートに収まらないが新しいパートには収まる場合、まとめて次のパートに送る
+    (ディレクトリの途中で切れにくくする)。1ファイルで予算を超える場合のみ行単位で分割する。
+    count(text) はトークン数、render_block(path, node) はファイル1件分の出力、overhead はパートごとの見出しの分、
+    line_count は巨大ファイルを行単位で分ける際に使うトークン数 (省略時は count)、
+    dir_overhead(ディレクトリの相対パス) はパート内でディレクトリが始まるたびに加える分 (JSONの入れ子など)。
+    戻り値: パートごとの [(相対パス, ノード)]
+    """
+    budget = max(1, max_tokens - overhead)
+    # ファイル単位の出力とトークン数 (区切りの改行分として+1)。同じディレクトリの連続したファイルをまとめる
+    groups: List[List[Tuple[str, Dict, int]]] = []
+    last_dir = None
+    for rel, node in iter_file_nodes(root_node):
+        parent = rel.rsplit('/', 1)[0] if '/' in rel else ""
+        dir_tokens = dir_overhead(parent) if dir_overhead and parent else 0
+        units = [(node, count(render_block(rel, node)) + 1)]
+        if units[0][1] + dir_tokens > budget:
+            # トークン数は行ごとの和と一致しないため、分割後のパートが収まるまで本文の予算を詰める
+            body_budget = budget - dir_tokens - (units[0][1] - count(node.get("diff") or node.get("preview") or ""))
+            for _ in range(5):
+                units = [(unit, count(render_block(rel, unit)) + 1)
+                         for unit in split_oversized_node(node, max(1, body_budget), line_count or count)]
+                excess = max(tokens for _, tokens in units) + dir_tokens - budget
+                if excess <= 0 or body_budget <= 1:
+                    break
+                body_budget -= excess
+        if parent != last_dir:
+            groups.append([])
+            last_dir = parent
+        for unit, tokens in units:
+            groups[-1].append((rel, unit, tokens))
+
+    chunks: List[List[Tuple[str, Dict]]] = [[]]
+    used = 0
+    for group in groups:
+        parent = group[0][0].rsplit('/', 1)[0] if '/' in group[0][0] else ""
+        dir_tokens = dir_overhead(parent) if dir_overhead and parent else 0
+        group_tokens = dir_tokens + sum(t for _, _, t in group)
+        if chunks[-1] and used + group_tokens > budget and group_tokens <= budget:
+            chunks.append([])
+            used = 0
+        used += dir_tokens
+        for rel, node, tokens in group:
+            if chunks[-1] and used + tokens > budget:
+                chunks.append([])
+                used = dir_tokens
+            chunks[-1].append((rel, node))
+            used += tokens
+    return [c for c in chunks if c]
+
+def visual_tree_lines(node, prefix="", is_last=True):
+    """
+    JSON構造を再帰的に走査して、視覚的なツリーの各行を返す。
     """
     connector = "└──" if is_last else "├──"
 
@@ -1065,8 +4194,11 @@ def print_visual_tree(node, prefix="", is_last=True):
     # "children" キーを持っている＝ディレクトリとみなして / を付与
     if "children" in node:
         name += "/"
+    elif node.get("rollup"):
+        # --depth-summary で1ノードにまとめたディレクトリ
+        name += f"/ ({node['rollup']['files']} files)"
         
-    print(f"{prefix}{connector}{name}")
+    yield f"{prefix}{connector}{name}"
 
     
     # 子要素を取得
@@ -1075,7 +4207,14 @@ def print_visual_tree(node, prefix="", is_last=True):
     # 最後の要素かどうか判定しながら再帰
     new_prefix = prefix + ("    " if is_last else "│   ")
     for i, child in enumerate(children):
-        print_visual_tree(child, new_prefix, i == len(children) - 1)
+        yield from visual_tree_lines(child, new_prefix, i == len(children) - 1)
+
+def print_visual_tree(node, prefix="", is_last=True):
+    """
+    JSON構造を再帰的に走査して、視覚的なツリーを表示する。
+    """
+    for line in visual_tree_lines(node, prefix, is_last):
+        print(line)
 
 def interactive_selection(targets: Set[Path], smart_deps: Set[Path]) -> Dict[Path, str]:
     """対話モードで各ファイルの出力形式を選択する"""
@@ -1111,138 +4250,1486 @@ def interactive_selection(targets: Set[Path], smart_deps: Set[Path]) -> Dict[Pat
     print("\n" + "="*60 + "\n")
     return file_modes
 
-def main():
-    args = parse_args()
-    root_path = Path(args.path).resolve()
-
-    # キャッシュファイルのロードをメイン関数のスコープに設定
-    global cache_dict
-    cache_dict = load_cache(root_path if root_path.is_dir() else root_path.parent, args.debug)
-    
-    # 自身のキャッシュファイルを除外リストに追加
-    args.exclude.append(CACHE_FILE_NAME)
+def count_tokens(text: str, model: str, is_debug: bool = False) -> int:
+    """tiktokenでトークン数を数える (未導入・失敗時は 4文字=1トークン で概算)"""
+    count = len(text) // 4
+    if HAS_TIKTOKEN:
+        try:
+            count = len(tiktoken.encoding_for_model(model).encode(text))
+            log_debug("Token count calculated via tiktoken.", is_debug)
+        except Exception as e:
+            log_debug(f"Tiktoken encoding failed: {e}. Falling back to heuristic calculation.", is_debug)
+    return count
+
+def make_root_labels(roots: List[Path]) -> Dict[Path, str]:
+    """複数ルート時の表示名。ディレクトリ名が重複する場合は親ディレクトリ名も付ける"""
+    names = Counter(r.name for r in roots)
+    labels = {}
+    for r in roots:
+        label = r.name if names[r.name] == 1 else f"{r.parent.name}/{r.name}"
+        labels[r] = label or str(r)
+    return labels
+
+def display_path(path: Path, roots: List[Path], root_labels: Dict[Path, str]) -> str:
+    """出力用のパス表記 (複数ルート時はルート名を先頭に付ける)"""
+    for r in roots:
+        base = r if r.is_dir() else r.parent
+        try:
+            rel = path.relative_to(base).as_posix()
+        except ValueError:
+            continue
+        return f"{root_labels[r]}/{rel}" if len(roots) > 1 else rel
+    return path.as_posix()
 
-    if args.tree:
-        # 1. プレビュー対象拡張子を空にする (＝中身を読み込むファイルをゼロにする)
-        args.preview_exts = []
-        
-        # 2. プレビュー対象外のファイルもツリーに含める設定をONにする
-        #    これにより、フィルタ(-e)で除外されていない全ファイルが「中身なし」として登録される
-        args.include_non_preview = True
-        
-        # 3. Focusモード（中身検索）はTree表示と相性が悪いため無効化しておく
-        #    (ファイル名検索として機能させるなら残しても良いが、誤解を避けるためOFF推奨)
-        args.focus = None 
+# ==========================================
+# 5. Library API (ContextBuilder)
+# ==========================================
+class ContextBuilder:
+    """
+    スキャン結果・キャッシュ・検索インデックス・ONNXモデルを保持し、同じプロセス内で
+    検索 / Focus / アウトライン / ツリー生成 / レンダリングを繰り返し呼べるようにするAPI。
+    CLI (main) もこのクラスの薄いラッパーになっている。
+
+    使用例:
+        builder = ContextBuilder(["./src"], semantic_search=True)
+        builder.scan()
+        hits = builder.search("ログイン処理の不具合")
+        root = builder.build_tree({h["path"] for h in hits}, outline=True)
+        print(builder.render(root, text=True))
+        builder.close()
+
+    オプションはCLI引数と同じ名前 (ハイフンはアンダースコア) をキーワード引数で指定する。
+    """
 
-    if args.use_gitignore:
-        git_patterns = load_gitignore_patterns(root_path)
-        args.exclude.extend(git_patterns)
-        log_debug(f"Loaded .gitignore patterns: {git_patterns}", args.debug)
+    def __init__(self, paths: Optional[List] = None, args: Optional[argparse.Namespace] = None, **options):
+        if args is None:
+            args = build_arg_parser().parse_args([])
+        for name, value in options.items():
+            if not hasattr(args, name):
+                raise TypeError(f"Unknown option: {name}")
+            setattr(args, name, value)
+        if paths is not None:
+            args.path = [str(p) for p in paths]
+        # 既定値のリストを共有しないよう複製してから書き換える
+        args.exclude = list(args.exclude)
+        args.full = list(args.full or [])
+        self.args = args
+
+        self.roots = list(dict.fromkeys(Path(p).resolve() for p in args.path))
+        self.root_labels = make_root_labels(self.roots)
+
+        # キャッシュは複数ルートの場合は共通の親ディレクトリに1つだけ置き、全ルートで共有する
+        self.workspace_root = Path(os.path.commonpath([r if r.is_dir() else r.parent for r in self.roots]))
+        self.cache_root = Path(args.cache_dir).resolve() if args.cache_dir else self.workspace_root
+        self.cache_dict = load_cache(self.cache_root, args.debug)
+        self.artifact_cache = ArtifactCache(self.cache_dict, BlobStore(self.cache_root / BLOB_DB_NAME, args.debug),
+                                            BlobStore(self.cache_root / INDEX_DB_NAME, args.debug))
+        # ディレクトリの mtime と一覧を記録し、変更のないディレクトリは走査・stat を省略する
+        self.dir_manifest = DirManifest(self.cache_dict, args.rescan)
+
+        # 自身のキャッシュファイルを除外リストに追加
+        args.exclude.extend([CACHE_FILE_NAME, BLOB_DB_NAME, f"{BLOB_DB_NAME}-journal", INDEX_DB_NAME, f"{INDEX_DB_NAME}-journal"])
+
+        if args.tree:
+            # 1. プレビュー対象拡張子を空にする (＝中身を読み込むファイルをゼロにする)
+            args.preview_exts = []
+
+            # 2. プレビュー対象外のファイルもツリーに含める設定をONにする
+            #    これにより、フィルタ(-e)で除外されていない全ファイルが「中身なし」として登録される
+            args.include_non_preview = True
+
+            # 3. Focusモード（中身検索）はTree表示と相性が悪いため無効化しておく
+            #    (ファイル名検索として機能させるなら残しても良いが、誤解を避けるためOFF推奨)
+            args.focus = None
+
+        if args.sample_data is not None and not args.tree:
+            # サンプリング対象のデータ形式もプレビュー対象に加える (既定値のリストは書き換えない)
+            args.preview_exts = list(args.preview_exts) + [e for e in DATA_SAMPLE_EXTS if e not in args.preview_exts]
+
+        if args.use_gitignore:
+            for root in self.roots:
+                git_patterns = load_gitignore_patterns(root)
+                args.exclude.extend(git_patterns)
+                log_debug(f"Loaded .gitignore patterns: {git_patterns}", args.debug)
+
+        if args.exclude != DEFAULT_EXCLUDES:
+            args.exclude = list(set(args.exclude + DEFAULT_EXCLUDES))
+
+        # --rev: 作業ツリーの代わりに指定リビジョンのツリーを仮想ソースとして読む
+        # アーカイブ (zip / tar / tar.gz) が指定されたルートは展開せずに仮想ディレクトリとして読む
+        # (読めない場合は ValueError)
+        self.sources: Dict[Path, VirtualSource] = {}
+        try:
+            for root in self.roots:
+                if is_archive_path(root):
+                    self.sources[root] = ArchiveSource(root)
+                elif args.rev:
+                    self.sources[root] = GitRevisionSource(root if root.is_dir() else root.parent, args.rev)
+        except (ValueError, OSError):
+            self.close()
+            raise
+
+        self.max_bytes = args.max_preview_size_mb * 1024 * 1024
+        self.file_map = ContentStore(self._read_target, self.max_bytes)
+        self.file_sources: Dict[Path, VirtualSource] = {}
+        self.file_hunks: Dict[str, List[Tuple[int, int, int]]] = {}
+        self.content_keys: Dict[Path, str] = {}
+        self.summaries: Dict[Path, str] = {}
+        self.file_imports: Dict[Path, List[str]] = {}
+        self.file_sketches: Dict[Path, str] = {}
+        self.global_vocab: Set[str] = set()
+        self.idf_dict: Dict[str, float] = {}
+        self._idf_current = False  # idf_dict が今回の走査結果から計算済みか
+        self.file_tags: Dict[Path, List[str]] = {}
+        self.render_stats: Dict[str, Optional[Dict]] = {}
+        self.minify_stats: Dict[Path, Tuple[int, int]] = {}
+        # --sample-data: 構造のプレビューに置き換えるファイル -> プレビューのキャッシュキー
+        self.sampled_keys: Dict[Path, str] = {}
+        self._focus_matches: Dict[Tuple[Optional[str], str], List[Path]] = {}
+        self._search_indexes: Dict[Tuple, Tuple[List[str], List[Path], List[Dict], SimpleBM25, TrigramScorer]] = {}
+        self._onnx_engine = None
+        self._onnx_loaded = False
+        self._embedding_cache: Optional[EmbeddingCache] = None
+
+    # ---- 入力 ----
+    def _source_for(self, path: Path) -> Optional[VirtualSource]:
+        for source in self.sources.values():
+            if source.owns(path):
+                return source
+        return None
 
-    if args.exclude != DEFAULT_EXCLUDES:
-        args.exclude = list(set(args.exclude + DEFAULT_EXCLUDES))
-    
-    # Check dependencies for debug
-    if args.debug:
-        log_debug(f"Tree-sitter: {'OK' if HAS_TREESITTER else 'Missing'}", True)
-        log_debug(f"NetworkX:    {'OK' if HAS_NETWORKX else 'Missing'}", True)
-
-    git_allowed = get_git_files(root_path, args.git_filter) if args.git_filter != 'None' else None
-    all_files = collect_files(root_path, args, git_allowed)
-
-    file_map = {}
-    files_to_read = []
-
-    # まず、ファイルを「読むもの」と「空で登録するもの」に振り分ける
-    for fpath in all_files:
-        ext = fpath.suffix.lower()
-        if ext in args.preview_exts:
-            files_to_read.append(fpath)
-        else:
-            # プレビュー対象外（--include-non-previewで入ったもの）は
-            # 読み込まずに空文字をセットする
-            file_map[fpath] = ""
-
-    # 必要なファイルだけを並列読み込み（IOコスト削減）
-    with ThreadPoolExecutor() as executor:
-        results = executor.map(read_content, files_to_read)
-        for fpath, content in zip(files_to_read, results):
-            # 読み込み成功、かつサイズ制限内なら格納
-            if content and len(content.encode('utf-8')) <= args.max_preview_size_mb * 1024 * 1024:
-                file_map[fpath] = content
-            else:
-                # 読み込み失敗やサイズ超過時は空文字（存在は残す）
-                file_map[fpath] = ""
-    final_targets = set(file_map.keys())
-    
-    # ファイル名によるスコープ絞り込み機能を追加
-    focus_keyword = args.focus
-    path_filter = None
+    def _sample_key(self, p: Path, ext: str) -> Optional[str]:
+        """
+        --sample-data の対象 (しきい値を超える、ディスク上のデータファイル) ならプレビューのキャッシュキーを返す。
+        本文のハッシュは全体を読む必要があるため、キーはパス・mtime・サイズから作る。
+        """
+        if self.args.sample_data is None or ext not in DATA_SAMPLE_EXTS or p in self.file_sources:
+            return None
+        stat = self.dir_manifest.stat(p)
+        if stat is None:
+            return None
+        mtime, size = stat
+        if size <= self.args.sample_data * 1024 * 1024:
+            return None
+        return compute_content_key(f"sample:{p}:{mtime}:{size}")
+
+    def _read_target(self, p: Path) -> Optional[str]:
+        sample_key = self.sampled_keys.get(p)
+        if sample_key is not None:
+            return self.artifact_cache.get_or_compute(sample_key, "sample", lambda: sample_data_file(p, p.suffix.lower()))
+        source = self.file_sources.get(p)
+        if source is None:
+            return read_content(p)
+        # サイズ上限を超えるメンバは取り出さない
+        if source.size(p) > self.max_bytes:
+            return None
+        return source.read(p)
 
-    if args.focus:
-        # "filename:keyword" の形式なら分割する
-        if ":" in args.focus:
-            parts = args.focus.split(":")
+    @staticmethod
+    def parse_focus(focus: str) -> Tuple[Optional[str], str]:
+        """"filename:keyword" の形式なら (パスフィルタ, キーワード) に分割する"""
+        if ":" in focus:
+            parts = focus.split(":")
             # 単純な分割だと Windowsパス(C:\...)と競合する可能性がゼロではないが、
             # 引数指定の文脈ではほぼファイルフィルタとして機能する
             if len(parts) == 2 and parts[0] and parts[1]:
-                path_filter = parts[0]    # 例: "app.py" や "src"
-                focus_keyword = parts[1]  # 例: "main"
+                return parts[0], parts[1]  # 例: ("app.py", "main")
+        return None, focus
+
+    @staticmethod
+    def _matches_focus(p: Path, c: str, path_filter: Optional[str], keyword: str) -> bool:
+        # 1. パスフィルタがある場合、パスに含まれていなければスキップ
+        if path_filter and (path_filter not in str(p).replace(os.sep, '/')):
+            return False
+
+        # 2. ファイル名自体にキーワードが含まれていれば無条件で追加
+        if keyword in p.name:
+            return True
 
-        # 絞り込みロジック
+        # 3. 中身に含まれる場合、「実際に関数やクラスとして定義されているか」を厳格にチェック
+        if keyword in c:
+            extracted = None
+            if HAS_TREESITTER:
+                extracted = extract_code_block_treesitter(c, p.suffix.lower(), keyword)
+            if not extracted and p.suffix.lower() == '.py':
+                extracted = extract_code_block_ast(c, keyword)
+            if not extracted:
+                extracted = extract_code_block_braces(c, keyword)
+
+            # 単なるコメントや "if __name__ == '__main__':" などではなく、
+            # ちゃんと関数・クラス定義として抽出できた場合のみターゲットとする
+            if extracted:
+                return True
+        return False
+
+    def _imports_of(self, p: Path, content) -> List[str]:
+        return self.artifact_cache.get_or_compute(self.content_keys[p], f"imports:{p.suffix.lower()}",
+                                                  lambda: sorted(extract_imports(p, _materialize(content))))
+
+    def scan(self) -> Set[Path]:
+        """
+        全ルートを走査し、各ファイルを 読み込み -> 解析 (キー・要約・Focus判定・import・MinHash) する。
+        本文は解析後に手放し、必要な時に読み直す。戻り値: 走査したファイルの集合
+        """
+        args = self.args
+
+        # Check dependencies for debug
+        if args.debug:
+            log_debug(f"Tree-sitter: {'OK' if HAS_TREESITTER else 'Missing'}", True)
+            log_debug(f"NetworkX:    {'OK' if HAS_NETWORKX else 'Missing'}", True)
+
+        # 各ルートを並列に走査する (Gitフィルタもルートごとに解決して統合)
+        with PROFILER.phase("walk"):
+            git_allowed = None
+            if args.git_filter != 'None':
+                git_allowed = set()
+                for root in self.roots:
+                    git_allowed.update(get_git_files(root if root.is_dir() else root.parent, args.git_filter))
+            # --hunks: 差分は git diff -U0 を1回だけ解析してファイルごとのハンクに振り分ける
+            self.file_hunks = {}
+            if args.hunks:
+                for root in self.roots:
+                    self.file_hunks.update(get_git_hunks(root if root.is_dir() else root.parent, args.git_filter))
+            with ThreadPoolExecutor(max_workers=len(self.roots)) as executor:
+                walked = executor.map(lambda r: collect_virtual_files(self.sources[r], args) if r in self.sources else collect_files(r, args, git_allowed, self.dir_manifest), self.roots)
+                all_files = [f for files in walked for f in files]
+            # 仮想ソース上のファイル -> ソース (読み込みとキャッシュキーの切り替え用)
+            self.file_sources = {f: src for src in self.sources.values() for f in src.members}
+
+        # Focusの判定は読み込み段で本文を見ながら行う
+        focus = self.parse_focus(args.focus) if args.focus else None
+        # 依存グラフ (--resolve-deps / --smart-context) 用の import も読み込み段で抽出しておく
+        need_imports = HAS_NETWORKX and ((args.focus and args.resolve_deps) or getattr(args, 'smart_context', False))
+        # 本文を検索するモードでは、読み込み段で trigram 索引も作っておく (次回以降は本文を読まずに絞り込める)
+        need_trigrams = bool(args.focus or getattr(args, 'grep', None))
+        focus_grams = literal_trigrams([focus[1]]) if focus else []
+        artifact_cache = self.artifact_cache
+
+        def _analyze(p: Path) -> Dict:
+            """
+            読み込み+解析段: 1ファイルの成果物 (キー・要約・Focus判定・import・MinHash) をすべて取り出して返す。
+            本文は必要になった時だけ読み (statが前回と一致し、成果物がキャッシュ済みなら読まない)、
+            本文そのものは返さない (= ここで手放す)。
+            """
+            ext = p.suffix.lower()
+            body: List[str] = []
+
+            def load() -> str:
+                if not body:
+                    content = ""
+                    # プレビュー対象外（--include-non-previewで入ったもの）は読み込まない
+                    if ext in args.preview_exts:
+                        content = PROFILER.timed("read", str(p), self._read_target, p)
+                        size = len(content.encode('utf-8')) if content else 0
+                        PROFILER.count("files_read")
+                        PROFILER.count("bytes_read", size)
+                        # 読み込み失敗やサイズ超過時は空文字（存在は残す）
+                        if not content or size > self.max_bytes:
+                            content = ""
+                        # 直後の段 (検索・出力) で読み直さずに済むよう、上限付きの LRU にも入れておく
+                        self.file_map.remember(p, content, size)
+                    body.append(content)
+                return body[0]
+
+            # 内容ハッシュ (共有キャッシュのキー) を算出
+            # (仮想ソースはソース側のキー: Gitなら blob SHA)
+            sample_key = self._sample_key(p, ext)
+            if p in self.file_sources:
+                key = self.file_sources[p].cache_key(p)
+                has_body = bool(load())
+            elif sample_key is not None:
+                # 巨大なデータファイルは全文を読まず、構造のプレビューを本文として扱う
+                self.sampled_keys[p] = key = sample_key
+                has_body = bool(load())
+            elif ext not in args.preview_exts:
+                key = artifact_cache.key_for(p, "", self.dir_manifest.stat(p))
+                has_body = False
+            else:
+                key = artifact_cache.key_for(p, load, self.dir_manifest.stat(p))
+                # 本文なしとして記録されていたファイルは、設定の変更で読めるようになった可能性があるため確かめる
+                has_body = bool(load()) if (body or key == EMPTY_CONTENT_KEY) else True
+                if has_body and key == EMPTY_CONTENT_KEY:
+                    key = artifact_cache.rekey(p, load())
+            result = {
+                "has_body": has_body,
+                "key": key,
+                "summary": PROFILER.timed("summarize", str(p), get_file_summary, artifact_cache, key, load, ext),
+            }
+            grams = None
+            if need_trigrams and has_body:
+                grams = artifact_cache.get_or_compute(key, "trigrams", lambda: compute_trigrams(load()))
+            if focus:
+                # ファイル名にもなく、trigram 索引上も本文にキーワードが含まれ得ないファイルは読まずに除外する
+                maybe = grams is None or focus[1] in p.name or contains_trigrams(decode_trigrams(grams), focus_grams)
+                result["focus"] = maybe and self._matches_focus(p, load(), *focus)
+            if need_imports:
+                result["imports"] = artifact_cache.get_or_compute(key, f"imports:{ext}", lambda: sorted(extract_imports(p, load()))) if has_body else []
+            if args.near_dup is not None:
+                result["sketch"] = artifact_cache.get_or_compute(key, "minhash", lambda: compute_minhash(load())) if has_body else ""
+            if has_body and not body:
+                PROFILER.count("files_unread")  # 成果物がすべてキャッシュ済みで読み込みを省略したファイル
+            return result
+
+        # 読み込み → 解析 を上限付きのキューで流す (同時に保持する本文はワーカー数程度)。
+        # 本文は捨て、出力時に必要なものだけ ContentStore が読み直す。
+        self.file_map = ContentStore(self._read_target, self.max_bytes)
+        self.content_keys, self.summaries, self.file_imports, self.file_sketches = {}, {}, {}, {}
+        self._focus_matches, self._search_indexes = {}, {}
+        self._idf_current = False
         focus_roots = []
-        for p, c in file_map.items():
-            # 1. パスフィルタがある場合、パスに含まれていなければスキップ
-            if path_filter and (path_filter not in str(p).replace(os.sep, '/')):
+        with PROFILER.phase("read"):
+            for fpath, result in run_bounded(_analyze, all_files):
+                self.file_map.register(fpath, result["has_body"])
+                self.content_keys[fpath] = result["key"]
+                self.summaries[fpath] = result["summary"]
+                if result.get("focus"):
+                    focus_roots.append(fpath)
+                if need_imports:
+                    self.file_imports[fpath] = result["imports"]
+                if result.get("sketch"):
+                    self.file_sketches[fpath] = result["sketch"]
+        if focus:
+            self._focus_matches[focus] = focus_roots
+
+        with PROFILER.phase("idf"):
+            self.global_vocab = set()
+            for root in self.roots:
+                self.global_vocab |= build_global_vocab((root if root.is_dir() else root.parent) / args.vocab_file, args.debug, artifact_cache)
+        return set(self.file_map.keys())
+
+    @property
+    def files(self) -> Set[Path]:
+        return set(self.file_map.keys())
+
+    # ---- 絞り込み ----
+    def dependency_graph(self):
+        """import に基づく依存グラフ (要networkx)。読み込み段で未抽出のファイルはここで読み直して補う"""
+        if not HAS_NETWORKX:
+            return None
+        for p in self.file_map:
+            if p not in self.file_imports:
+                self.file_imports[p] = self._imports_of(p, lambda p=p: self.file_map[p]) if self.file_map.has_content(p) else []
+        return build_dependency_graph(self.file_imports, self.args.debug)
+
+    def focus(self, focus: str, resolve_deps: bool = False) -> Set[Path]:
+        """キーワード (または "filename:keyword") を定義として含むファイルを返す。resolve_deps 時は依存先も含める"""
+        key = self.parse_focus(focus)
+        focus_roots = self._focus_matches.get(key)
+        if focus_roots is None:
+            # trigram 索引でキーワードを含み得るファイルに絞ってから本文を照合する
+            candidates = set(self.candidates([key[1]]))
+            focus_roots = [p for p in self.file_map.keys()
+                           if (p in candidates or key[1] in p.name) and self._matches_focus(p, self.file_map[p], *key)]
+            self._focus_matches[key] = focus_roots
+        if resolve_deps and HAS_NETWORKX:
+            return get_related_files(focus_roots, self.dependency_graph())
+        return set(focus_roots)
+
+    # ---- 本文検索 (trigram 索引 + 正規表現) ----
+    def _trigrams(self, p: Path) -> array:
+        """ファイルの trigram 配列 (内容ハッシュ単位でキャッシュ。未作成なら本文を読んで作る)"""
+        return decode_trigrams(self.artifact_cache.get_or_compute(self.content_keys[p], "trigrams",
+                                                                  lambda: compute_trigrams(self.file_map[p])))
+
+    def candidates(self, literals: List[str], targets: Optional[Set[Path]] = None) -> List[Path]:
+        """literals をすべて含み得る (本文のある) ファイルを trigram 索引で絞り込む。3バイト以上の語がなければ絞り込まない"""
+        targets = self.files if targets is None else targets
+        needed = literal_trigrams(literals)
+        with PROFILER.phase("trigram"):
+            found = [p for p in sorted(targets)
+                     if self.file_map.has_content(p) and (not needed or contains_trigrams(self._trigrams(p), needed))]
+        PROFILER.count("trigram_candidates", len(found))
+        return found
+
+    def grep(self, pattern: str, targets: Optional[Set[Path]] = None, ignore_case: bool = False) -> Dict[Path, List[int]]:
+        """
+        正規表現に一致する行番号 (1始まり) をファイルごとに返す。
+        trigram 索引で候補を絞ってから、候補の本文だけを1行ずつ照合する。不正なパターンは re.error。
+        """
+        regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        found = self.candidates(required_literals(pattern), targets)
+        hits: Dict[Path, List[int]] = {}
+        with PROFILER.phase("grep"):
+            match = lambda p: [no for no, line in enumerate(self.file_map[p].splitlines(), 1) if regex.search(line)]
+            for p, lines in run_bounded(match, found):
+                if lines:
+                    hits[p] = lines
+        return hits
+
+    def smart_dependencies(self, targets: Set[Path]) -> Set[Path]:
+        """対象ファイルが直接 import しているファイルのうち、対象に含まれないもの"""
+        smart_deps = set()
+        G = self.dependency_graph()
+        if G:
+            for p in list(targets):
+                if p in G:
+                    # 直接の依存先（importされているファイル）を取得
+                    for dep in G.successors(p):
+                        if dep not in targets:
+                            smart_deps.add(dep)
+        return smart_deps
+
+    # ---- スナップショット (差分ダンプ) ----
+    def snapshot(self, name: str, targets: Optional[Set[Path]] = None) -> int:
+        """出力したファイルのパスと内容ハッシュを名前付きで記録する (save() で保存)。戻り値: 記録したファイル数"""
+        targets = self.files if targets is None else targets
+        snapshots = self.cache_dict.setdefault("snapshots", {})
+        snapshots.pop(name, None)
+        snapshots[name] = {
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "files": {str(p): self.content_keys[p] for p in sorted(targets)},
+        }
+        while len(snapshots) > SNAPSHOT_LIMIT:
+            del snapshots[next(iter(snapshots))]
+        return len(snapshots[name]["files"])
+
+    def changes_since(self, name: str, targets: Optional[Set[Path]] = None) -> Dict:
+        """
+        スナップショットと現在の対象ファイルを内容ハッシュで比較する。
+        内容ハッシュは走査時に stat し直して求めたもの (DirManifest.stat) をそのまま使う。
+        戻り値: {"snapshot", "created", "added", "modified", "deleted" (表示パスのリスト), "targets" (追加+変更のパス集合)}。
+        未知の名前は KeyError
+        """
+        snapshots = self.cache_dict.get("snapshots", {})
+        if name not in snapshots:
+            available = ", ".join(snapshots) or "none"
+            raise KeyError(f"Unknown snapshot: {name} (available: {available})")
+        recorded = snapshots[name]["files"]
+        targets = self.files if targets is None else targets
+        added = [p for p in targets if str(p) not in recorded]
+        modified = [p for p in targets if str(p) in recorded and recorded[str(p)] != self.content_keys[p]]
+        # 今回の対象から外れただけのファイルは削除扱いにしない (走査範囲内で実際に無くなったものだけ)
+        deleted = []
+        for path_str in recorded:
+            path = Path(path_str)
+            if path in self.file_map or not any(path == r or r in path.parents for r in self.roots):
                 continue
+            # 仮想ソース (アーカイブ・--rev) はメンバ一覧に残っていれば除外されただけとみなす
+            source = self._source_for(path)
+            if not (source.is_file(path) if source is not None else path.exists()):
+                deleted.append(path)
+        return {
+            "snapshot": name,
+            "created": snapshots[name]["created"],
+            "added": sorted(self.display_path(p) for p in added),
+            "modified": sorted(self.display_path(p) for p in modified),
+            "deleted": sorted(self.display_path(p) for p in deleted),
+            "targets": set(added) | set(modified),
+        }
+
+    def tags(self, targets: Optional[Set[Path]] = None) -> Dict[Path, List[str]]:
+        """
+        対象ファイルのタグ。DFは targets に依らず、走査した本文のあるファイル全体をコーパスとして
+        走査ごとに1回だけ差分更新する (タグは内容キー単位でキャッシュされるため、一部だけのDFで計算しない)
+        """
+        args = self.args
+        target_list = sorted(self.files if targets is None else targets)
+
+        # DFは前回の集計を引き継ぎ、内容が変わったファイルの分だけ差し引き・加算する
+        if not self._idf_current:
+            log_debug("Updating document frequencies for TF-IDF tagging...", args.debug)
+            with PROFILER.phase("idf"):
+                corpus_docs = {str(p): (self.content_keys[p], self.summaries[p]) for p in sorted(self.files) if self.file_map.has_content(p)}
+                self.idf_dict = CorpusStats(self.cache_dict, self.artifact_cache).update(corpus_docs)
+            self._idf_current = True
+
+        # 本文はキャッシュにない (= 変更された) ファイルの分だけ読み直す
+        def _tags(p):
+            return get_file_tags(self.artifact_cache, self.content_keys[p], lambda: self.file_map.get(p, ""), p.suffix.lower(),
+                                 self.summaries[p], self.global_vocab, self.idf_dict, args.debug)
+
+        with PROFILER.phase("tag"):
+            with ThreadPoolExecutor() as executor:
+                tags = dict(zip(target_list, executor.map(lambda p: PROFILER.timed("tag", str(p), _tags, p), target_list)))
+        self.file_tags.update(tags)
+        return tags
+
+    def outline(self, path) -> str:
+        """ファイルのアウトライン (内容ハッシュ単位でキャッシュ)"""
+        path = self.resolve(path)
+        if not self.file_map.has_content(path):
+            return ""
+        return get_file_outline(self.artifact_cache, self.content_keys[path], lambda: self.file_map[path], path.suffix.lower())
+
+    # ---- 検索 ----
+    def _onnx(self):
+        """ONNXエンジンは最初の意味検索で1回だけ読み込み、以降の検索で使い回す"""
+        args = self.args
+        if self._onnx_loaded:
+            return self._onnx_engine
+        self._onnx_loaded = True
+        if getattr(args, 'semantic_search', False):
+            if HAS_ONNX:
+                ruri_model_dir = Path(__file__).resolve().parent / "ruri_30m_quantized"
+                try:
+                    log_debug(f"Initializing ONNX engine from: {ruri_model_dir}", args.debug)
+                    with PROFILER.phase("onnx_load"):
+                        self._onnx_engine = ONNXSemanticSearch(ruri_model_dir, args.debug, self.cache_root / ONNX_CACHE_DIR_NAME,
+                                                               args.onnx_threads, args.onnx_inter_threads, args.onnx_execution_mode)
+                except FileNotFoundError as e:
+                    print(f"[ERROR] {e}", file=sys.stderr)
+                    log_debug("Fallback to BM25 only due to missing ONNX model.", args.debug)
+            else:
+                print("[WARNING] --semantic-search is enabled, but ONNX dependencies are missing. Falling back to BM25.", file=sys.stderr)
+                log_debug("ONNX runtime dependencies are missing. Install with: pip install onnxruntime tokenizers numpy", args.debug)
+        else:
+            log_debug("Semantic search is DISABLED. Using BM25 only.", args.debug)
+
+        # 埋め込みは本文(チャンク)のハッシュでキャッシュし、変更のない文書は再推論しない
+        if self._onnx_engine is not None:
+            self._embedding_cache = EmbeddingCache(self.cache_root / ONNX_CACHE_DIR_NAME, self._onnx_engine.model_path.parent.name, args.debug)
+        return self._onnx_engine
+
+    def _search_index(self, target_list: List[Path], chunks: bool):
+        """検索対象のドキュメント（要約＋タグ、またはチャンク）とBM25インデックス。対象が同じなら使い回す"""
+        search_full = getattr(self.args, 'search_full', False)
+        index_key = (tuple(target_list), chunks, search_full)
+        if index_key in self._search_indexes:
+            return self._search_indexes[index_key]
+
+        missing = [p for p in target_list if p not in self.file_tags]
+        if missing:
+            self.tags(set(missing))
+        search_corpus = []
+        doc_paths = []   # search_corpus と同じ並びで、各文書の元ファイルを保持
+        doc_chunks = []  # チャンク検索時のみ: 各文書に対応するチャンク
+        with PROFILER.phase("index"):
+            for item in target_list:
+                # 要約とタグは解析済み (内容ハッシュ単位でキャッシュ済み)
+                cached_content = format_summary_block(self.summaries[item], self.file_tags[item])
+
+                # チャンク検索: 定義単位のチャンクをそれぞれ独立した文書としてインデックスする
+                # (分割結果は内容ハッシュ単位でキャッシュ済みなら本文を読まない)
+                if chunks:
+                    ext = item.suffix.lower()
+                    file_chunks = self.artifact_cache.get_or_compute(self.content_keys[item], f"chunks:{ext}",
+                                                                     lambda: extract_chunks(self.file_map[item], ext))
+                    for chunk in file_chunks:
+                        label = f"{item.name} {chunk['name']}".strip()
+                        search_corpus.append(f"{label}\n{chunk['text']}")
+                        doc_paths.append(item)
+                        doc_chunks.append(chunk)
+                    continue
+
+                # 全文検索フラグがONの場合は、ファイル本文もコーパスに結合する
+                if search_full:
+                    search_corpus.append(f"{cached_content}\n\n{self.file_map[item]}")
+                else:
+                    search_corpus.append(cached_content)
+                doc_paths.append(item)
+            bm25 = SimpleBM25(search_corpus)
+        self._search_indexes[index_key] = (search_corpus, doc_paths, doc_chunks, bm25, TrigramScorer(search_corpus))
+        return self._search_indexes[index_key]
+
+    def search(self, query: str, targets: Optional[Set[Path]] = None, top_k: Optional[int] = None,
+               chunks: Optional[bool] = None) -> List[Dict]:
+        """
+        要約+タグ (chunks=True なら定義単位のチャンク) を BM25 (+ONNX再ランキング) で検索する。
+        戻り値: [{"path", "score", "bm25", "onnx", "chunk"(チャンク検索時)}] (スコア降順、0より大きい上位 top_k 件)
+        """
+        args = self.args
+        top_k = args.top_k if top_k is None else top_k
+        chunks = getattr(args, 'search_chunks', False) if chunks is None else chunks
+        target_list = sorted(self.files if targets is None else targets)
+        log_debug(f"Starting BM25 search for query: '{query}'", args.debug)
+
+        search_corpus, doc_paths, doc_chunks, bm25, trigrams = self._search_index(target_list, chunks)
+        if not search_corpus:
+            return []
+
+        # 二段階検索 (BM25/トライグラムで候補抽出 -> ONNXで再ランキング -> 線形結合 or RRF)
+        onnx_engine = self._onnx()
+        scored_results = hybrid_search(query, search_corpus, args, onnx_engine, self._embedding_cache, bm25, trigrams)
 
-            # 2. ファイル名自体にキーワードが含まれていれば無条件で追加
-            if focus_keyword in p.name:
-                focus_roots.append(p)
+        if self._embedding_cache is not None:
+            # 保持中のインデックスに含まれない文書の埋め込みは捨てる
+            live = {hashlib.sha1(t.encode('utf-8')).hexdigest() for index in self._search_indexes.values() for t in index[0]}
+            self._embedding_cache.prune(live)
+            self._embedding_cache.save()
+
+        hits = []
+        for doc_index, c_score, b_score, o_score in scored_results:
+            # 足切りを撤廃し、関連性がある(0.0より大きい)上位 top_k 件を抽出
+            if c_score <= 0.0 or len(hits) >= top_k:
+                break
+            file_path = doc_paths[doc_index]
+            hit = {"path": file_path, "score": c_score, "bm25": b_score, "onnx": o_score}
+            label = file_path.name
+            if doc_chunks:
+                chunk = doc_chunks[doc_index]
+                label = f"{file_path.name} L{chunk['start']}-{chunk['end']} {chunk['name']}".rstrip()
+                hit["chunk"] = chunk
+            log_debug(f"Search HIT [Rank {len(hits)+1}] [Combined: {c_score:.3f} | BM25: {b_score:.3f}, ONNX: {o_score:.3f}] - {label}", args.debug)
+            hits.append(hit)
+        return hits
+
+    # ---- 出力 ----
+    def display_path(self, path: Path) -> str:
+        return display_path(path, self.roots, self.root_labels)
+
+    def resolve(self, path) -> Path:
+        """
+        表示パス (ルートからの相対パス)・絶対パス・末尾一致のいずれかで走査済みのファイルを引く。
+        見つからない、または末尾一致が複数ある場合は KeyError。
+        """
+        if isinstance(path, Path) and path in self.file_map:
+            return path
+        text = str(path).replace(os.sep, '/').strip('/')
+        by_display = {self.display_path(p): p for p in self.file_map}
+        if text in by_display:
+            return by_display[text]
+        candidate = Path(path).resolve()
+        if candidate in self.file_map:
+            return candidate
+        matches = [p for name, p in by_display.items() if name.endswith('/' + text)]
+        if len(matches) == 1:
+            return matches[0]
+        if matches:
+            raise KeyError(f"Ambiguous path: {path} ({', '.join(sorted(self.display_path(p) for p in matches))})")
+        raise KeyError(f"File not found: {path}")
+
+    def summary(self, path) -> str:
+        """ファイルの要約とタグ"""
+        path = self.resolve(path)
+        if path not in self.file_tags:
+            self.tags({path})
+        return format_summary_block(self.summaries[path] or "(No summary provided)", self.file_tags[path])
+
+    def _is_file(self, path: Path) -> bool:
+        # 仮想ソース配下はディスクではなくソースの一覧をたどる
+        source = self._source_for(path)
+        if source:
+            return source.is_file(path)
+        # 走査時に一覧を確認済みのディレクトリはマニフェストから答える
+        is_dir = self.dir_manifest.is_dir(path)
+        if is_dir is not None:
+            return not is_dir and bool(self.dir_manifest.has_file(path))
+        return path.is_file()
+
+    def _is_dir(self, path: Path) -> bool:
+        source = self._source_for(path)
+        if source:
+            return source.is_dir(path)
+        is_dir = self.dir_manifest.is_dir(path)
+        return path.is_dir() if is_dir is None else is_dir
+
+    def _iterdir(self, path: Path) -> List[Path]:
+        source = self._source_for(path)
+        if source:
+            return source.iterdir(path)
+        listed = self.dir_manifest.iterdir(path)
+        return list(path.iterdir()) if listed is None else listed
+
+    def rollup(self, path: Path, targets: Optional[Set[Path]] = None) -> Optional[Tuple[str, Dict]]:
+        """
+        ディレクトリ配下の対象ファイルのロールアップ (merge_rollup の結果) を (キー, ロールアップ) で返す。
+        サブディレクトリから順にまとめ、子の内容ハッシュから作ったキーでキャッシュするため、
+        再計算されるのは内容が変わったファイルの祖先ディレクトリだけ。対象ファイルがなければ None。
+        """
+        args = self.args
+        targets = self.files if targets is None else targets
+        try:
+            items = sorted(self._iterdir(path), key=lambda x: (not self._is_dir(x), x.name.lower()))
+        except Exception:
+            return None
+        entries: List[Tuple[str, str]] = []
+        subdirs: Dict[str, Dict] = {}
+        files: Dict[str, Path] = {}
+        for item in items:
+            if should_exclude(item.name, args.exclude):
                 continue
+            if self._is_dir(item):
+                child = self.rollup(item, targets)
+                if child:
+                    entries.append((item.name + "/", child[0]))
+                    subdirs[item.name] = child[1]
+            elif item in targets:
+                entries.append((item.name, self.content_keys[item]))
+                files[item.name] = item
+
+        if not entries:
+            return None
 
-            # 3. 中身に含まれる場合、「実際に関数やクラスとして定義されているか」を厳格にチェック
-            if focus_keyword in c:
-                extracted = None
-                if HAS_TREESITTER:
-                    extracted = extract_code_block_treesitter(c, p.suffix.lower(), focus_keyword)
-                if not extracted and p.suffix.lower() == '.py':
-                    extracted = extract_code_block_ast(c, focus_keyword)
-                if not extracted:
-                    extracted = extract_code_block_braces(c, focus_keyword)
-                
-                # 単なるコメントや "if __name__ == '__main__':" などではなく、
-                # ちゃんと関数・クラス定義として抽出できた場合のみターゲットとする
-                if extracted:
-                    focus_roots.append(p)
-
-        if args.resolve_deps and HAS_NETWORKX:
-            G = build_dependency_graph(file_map, args.debug)
-            final_targets = get_related_files(focus_roots, G)
+        def _compute() -> Dict:
+            children = []
+            for name, _ in entries:
+                if name.endswith("/"):
+                    children.append((name[:-1], subdirs[name[:-1]]))
+                    continue
+                item = files[name]
+                if not self.file_map.has_content(item):
+                    children.append((name, {"summary": "", "tags": []}))
+                    continue
+                key, ext = self.content_keys[item], item.suffix.lower()
+                load = lambda: self.file_map[item]
+                summary = get_file_summary(self.artifact_cache, key, load, ext)
+                tags = get_file_tags(self.artifact_cache, key, load, ext, summary, self.global_vocab, self.idf_dict, args.debug)
+                children.append((name, {"summary": summary, "tags": tags}))
+            return merge_rollup(children)
+
+        key = rollup_key(entries)
+        return key, self.artifact_cache.get_or_compute(key, "rollup", _compute)
+
+    def build_tree(self, targets: Optional[Set[Path]] = None, *, full: Optional[List[str]] = None,
+                   outline: Optional[bool] = None, summary_only: Optional[bool] = None,
+                   focus: Optional[str] = None, chunk_hits: Optional[Dict[Path, List[Dict]]] = None,
+                   smart_deps: Optional[Set[Path]] = None, output_modes: Optional[Dict[Path, str]] = None,
+                   depth_summary: Optional[int] = None, grep_hits: Optional[Dict[Path, List[int]]] = None) -> Optional[Dict]:
+        """
+        対象ファイルからディレクトリツリー (JSON出力と同じ構造の dict) を組み立てる。
+        未指定のオプションはCLI引数 (コンストラクタのオプション) の値を使う。
+        focus にはキーワードを渡す ("filename:keyword" 形式も可)。
+        depth_summary を指定すると、その深さ (ルート=0) のディレクトリを配下ごと1つのロールアップノードにまとめる。
+        grep_hits ({ファイル: 一致行}) のファイルは、一致行の周辺 (または一致行を含む定義) のみを出力する。
+        """
+        args = self.args
+        final_targets = self.files if targets is None else set(targets)
+        full = args.full if full is None else full
+        outline = getattr(args, 'outline', False) if outline is None else outline
+        summary_only = getattr(args, 'summary_only', False) if summary_only is None else summary_only
+        depth_summary = getattr(args, 'depth_summary', None) if depth_summary is None else depth_summary
+        focus_keyword = self.parse_focus(focus)[1] if focus else None
+        chunk_hits = chunk_hits or {}
+        grep_hits = grep_hits or {}
+        smart_deps = smart_deps or set()
+        file_output_modes = output_modes or {}
+        file_map, artifact_cache, content_keys = self.file_map, self.artifact_cache, self.content_keys
+        self._rendered_nodes: Dict[int, Path] = {}  # id(ファイルノード) -> 元ファイル (類似ファイル検出用)
+        self.minify_stats = {}
+
+        def build_tree(current_path, depth=0):
+            # 共通処理: ファイルノードの生成
+            def _create_file_node(item: Path):
+                # 本文は読み込み段で手放しているため、出力に必要なモードのときだけ読み直す
+                has_body = file_map.has_content(item)
+                load_body = lambda: file_map[item]
+                is_smart_dep = item in smart_deps
+
+                # インタラクティブモードでのユーザー選択を取得（最優先）
+                interactive_mode = file_output_modes.get(item)
+
+                # 各出力モードの判定
+                is_full = interactive_mode == 'f' or any(f in item.name for f in full)
+                is_outline = interactive_mode == 'o' or (not interactive_mode and outline) or is_smart_dep
+                is_summary = interactive_mode == 's' or (not interactive_mode and summary_only)
+
+                # チャンク検索でヒットしたファイルは、該当チャンクのみを出力する
+                is_chunk = item in chunk_hits and not interactive_mode and not is_full
+                # --grep で一致したファイルは、一致行の周辺のみを出力する
+                is_grep = item in grep_hits and not interactive_mode and not is_full
+                # --hunks 時は変更箇所を含む定義のみを出力する
+                is_hunk = str(item) in self.file_hunks and not interactive_mode and not is_full
+
+                if is_full:
+                    content = self.minify(item, load_body()) # 全文出力モード（本文をそのまま出力する）
+
+                elif is_chunk:
+                    content = render_chunks(chunk_hits[item])
+
+                elif is_grep and has_body:
+                    content = render_grep(load_body(), item.suffix.lower(), grep_hits[item], args.grep_context, args.grep_defs)
+
+                elif is_hunk and has_body:
+                    content = render_hunks(load_body(), item.suffix.lower(), self.file_hunks[str(item)])
+
+                elif is_outline and has_body:
+                    outline_text = get_file_outline(artifact_cache, content_keys[item], load_body, item.suffix.lower())
+                    if is_smart_dep:
+                        content = f"// [Smart Context: Auto-resolved Dependency Outline]\n{outline_text}"
+                    else:
+                        content = outline_text
+
+                elif is_summary and has_body:
+                    # 要約とタグは内容ハッシュ単位のキャッシュから取得 (未解析ならここで解析してキャッシュに乗せる)
+                    key = content_keys[item]
+                    ext = item.suffix.lower()
+                    summary_text = get_file_summary(artifact_cache, key, load_body, ext)
+                    tags = get_file_tags(artifact_cache, key, load_body, ext, summary_text, self.global_vocab, self.idf_dict, args.debug)
+                    content = format_summary_block(summary_text or "(No summary provided)", tags)
+
+                else:
+                    content = self.minify(item, load_body())
+
+                if focus_keyword:
+                    extracted = None
+                    if HAS_TREESITTER:
+                        extracted = extract_code_block_treesitter(content, item.suffix.lower(), focus_keyword)
+                    if not extracted and item.suffix.lower() == '.py':
+                        extracted = extract_code_block_ast(content, focus_keyword)
+                    if not extracted:
+                        extracted = extract_code_block_braces(content, focus_keyword)
+                    if extracted:
+                        content = extracted
+
+                if content and args.max_file_tokens:
+                    # 行数ではなくトークン数で上限をかける (超える場合は中間を省略)。
+                    # 末尾の改行は --preview-lines と同じく行単位に分けて結合し直すことで落とす
+                    preview_text = "\n".join(self.cap_tokens(content, item.suffix.lower(), args.max_file_tokens).splitlines())
+                elif content:
+                    lines = content.splitlines()[:args.preview_lines]
+                    preview_text = "\n".join(lines)
+                else:
+                    preview_text = ""
+                node = {"name": item.name, "preview": preview_text}
+                self._rendered_nodes[id(node)] = item
+                return node
+
+            # 1. パスが単一ファイルの場合の直接処理
+            if self._is_file(current_path):
+                if current_path in final_targets:
+                    return PROFILER.timed("build_tree", str(current_path), _create_file_node, current_path)
+                return None
+
+            # 2. パスがディレクトリの場合の再帰処理
+            node = {"name": current_path.name}
+            if depth_summary is not None and depth >= depth_summary and not args.directories_only and self._is_dir(current_path):
+                # 指定の深さ以下は1ノードにまとめる (配下のファイルの要約・タグから作ったロールアップ)
+                with PROFILER.phase("rollup"):
+                    rolled = self.rollup(current_path, final_targets)
+                if not rolled:
+                    return None
+                node["rollup"] = {"files": rolled[1]["files"], "dirs": rolled[1]["dirs"] + 1}
+                node["preview"] = format_rollup(rolled[1])
+                return node
+            if self._is_dir(current_path):
+                children = []
+                try:
+                    items = sorted(self._iterdir(current_path), key=lambda x: (not self._is_dir(x), x.name.lower()))
+                except Exception:
+                    items = [] # 権限エラー等でアクセスできないディレクトリはスキップ
+
+                for item in items:
+                    try:
+                        if should_exclude(item.name, args.exclude):
+                            continue
+
+                        if self._is_dir(item):
+                            child = build_tree(item, depth + 1)
+                            # 子ディレクトリを追加する条件を緩和
+                            if child:
+                                if args.directories_only:
+                                    children.append(child)
+                                elif child.get("children") or child.get("files_inside") or child.get("rollup"):
+                                    children.append(child)
+
+                        elif item in final_targets:
+                            children.append(PROFILER.timed("build_tree", str(item), _create_file_node, item))
+                    except Exception as e:
+                        # 個別のファイル処理でエラーが起きても全体を止めないが、デバッグログには残す
+                        log_debug(f"Error processing {item.name}: {e}", args.debug)
+                        continue
+
+                node["children"] = children
+                node["files_inside"] = len(children) > 0
+
+                # 自身を返す条件を緩和
+                if args.directories_only:
+                    return node
+
+                return node if node["files_inside"] else None
+
+            return None
+
+        with PROFILER.phase("build_tree"):
+            if len(self.roots) == 1:
+                return build_tree(self.roots[0])
+            # 複数ルート: 共通の親を仮想ルートとし、各ルートをルート名付きの子ノードとしてぶら下げる
+            root_children = []
+            for root in self.roots:
+                child = build_tree(root)
+                if child:
+                    child["name"] = self.root_labels[root]
+                    root_children.append(child)
+            if not root_children and not args.directories_only:
+                return None
+            return {"name": self.workspace_root.name, "children": root_children, "files_inside": bool(root_children)}
+
+    def render(self, root_node: Dict, text: Optional[bool] = None, dedup: Optional[bool] = None,
+               near_dup: Optional[float] = None) -> str:
+        """
+        build_tree() の結果を Markdown風テキスト (text=True) または JSON 文字列にする。
+        同一内容のファイルは参照 ("same_as") に、類似ファイルは代表+差分 ("similar_to") にまとめ、
+        その統計を self.render_stats に残す。
+        """
+        args = self.args
+        text = args.text if text is None else text
+        self._collapse(root_node, dedup, near_dup)
+
+        if text:
+            log_debug("Generating Markdown text output...", args.debug)
+            with PROFILER.phase("serialize"):
+                return render_text(root_node, args.debug)
+        log_debug("Generating JSON output...", args.debug)
+        with PROFILER.phase("serialize"):
+            return json.dumps(root_node, ensure_ascii=False, indent=None, separators=(',', ':'))
+
+    def block_tokens(self, text: str) -> int:
+        """出力ブロックのトークン数。ブロック本文のハッシュ単位でキャッシュし、変わらないブロックは数え直さない"""
+        model = self.args.model
+        return self.artifact_cache.get_or_compute(compute_content_key(text), f"tokens:{model}", lambda: count_tokens(text, model))
+
+    def minify(self, path: Path, content: str, level: Optional[int] = None) -> str:
+        """
+        全文出力する本文を --minify のレベルで縮める (内容ハッシュ+レベル単位でキャッシュ)。
+        縮んだファイルは前後のトークン数を self.minify_stats に記録する。
+        """
+        level = self.args.minify if level is None else level
+        if not level or not content or path not in self.content_keys:
+            return content
+        ext = path.suffix.lower()
+        with PROFILER.phase("minify"):
+            minified = self.artifact_cache.get_or_compute(self.content_keys[path], f"minify:{level}:{ext}",
+                                                          lambda: minify_content(content, ext, level))
+        if minified != content:
+            before, after = self.block_tokens(content), self.block_tokens(minified)
+            if after < before:
+                self.minify_stats[path] = (before, after)
+        return minified
+
+    def minify_report(self, limit: int = 10) -> List[str]:
+        """直前の build_tree() で縮めたファイルの節約トークン数 (多い順に limit 件まで)"""
+        rows = sorted(((before - after, p, before, after) for p, (before, after) in self.minify_stats.items()),
+                      key=lambda r: (-r[0], str(r[1])))
+        lines = [f"   {self.display_path(p)}: {before:,} -> {after:,} tokens (-{saved:,})" for saved, p, before, after in rows[:limit]]
+        if len(rows) > limit:
+            lines.append(f"   ... and {len(rows) - limit} more files")
+        return lines
+
+    def cap_tokens(self, content: str, ext: str, max_tokens: int) -> str:
+        """本文を max_tokens 以内に収める (超える場合は先頭と末尾を残して中間を省略)。収まる本文のトークン数はキャッシュを使う"""
+        if self.block_tokens(content) <= max_tokens:
+            return content
+        PROFILER.count("files_elided")
+        with PROFILER.phase("elide"):
+            return elide_middle(content, ext, max_tokens, lambda text: count_tokens(text, self.args.model))
+
+    def render_parts(self, root_node: Dict, max_tokens: int, text: Optional[bool] = None, dedup: Optional[bool] = None,
+                     near_dup: Optional[float] = None) -> List[Tuple[str, int]]:
+        """
+        render() と同じ出力を、1パートあたり max_tokens 以内に収まるようファイル/ディレクトリの境界で分割する。
+        各パートには「Part i/n」の見出しが付く。トークン数はファイル単位のキャッシュ済みの値を合算した概算。
+        戻り値: [(パートの本文, トークン数)]
+        """
+        args = self.args
+        text = args.text if text is None else text
+        self._collapse(root_node, dedup, near_dup)
+        root_name = root_node["name"]
+
+        dir_overhead = None
+        if text:
+            render_block = lambda rel, node: render_text_block(rel, node)
+            line_count = lambda line: count_tokens(line, args.model)
+            header = self._part_header(text, root_name, 999, 999, 99999, max_tokens)
         else:
-            final_targets = set(focus_roots)
-            
-        # extract処理用に引数を書き換えておく（抽出関数にはキーワードだけ渡すため）
-        args.focus = focus_keyword
+            render_block = lambda rel, node: json.dumps(node, ensure_ascii=False, separators=(',', ':'))
+            # JSONでは改行・引用符がエスケープされ、ディレクトリごとに入れ子のノードが付く
+            line_count = lambda line: count_tokens(json.dumps(line, ensure_ascii=False)[1:-1], args.model)
+            skeleton = lambda name: json.dumps({"name": name, "children": [], "files_inside": True}, ensure_ascii=False, separators=(',', ':')) + ","
+            dir_overhead = lambda parent: sum(count_tokens(skeleton(name), args.model) for name in parent.split('/'))
+            header = skeleton(root_name) + json.dumps({"part": self._part_header(text, root_name, 999, 999, 0, 0)})
+        header_tokens = count_tokens(header, args.model)
+
+        with PROFILER.phase("split"):
+            chunks = split_file_nodes(root_node, max_tokens, self.block_tokens, render_block, header_tokens, line_count, dir_overhead)
+            chunk_tokens = []
+            for chunk in chunks:
+                tokens = sum(self.block_tokens(render_block(rel, node)) + 1 for rel, node in chunk)
+                if dir_overhead:
+                    tokens += sum(dir_overhead(d) for d in {rel.rsplit('/', 1)[0] for rel, _ in chunk if '/' in rel})
+                chunk_tokens.append(tokens)
+
+        parts = []
+        with PROFILER.phase("serialize"):
+            for i, (chunk, tokens) in enumerate(zip(chunks, chunk_tokens), 1):
+                header = self._part_header(text, root_name, i, len(chunks), len(chunk), tokens)
+                if text:
+                    body = header + "\n".join(render_text_block(rel, node, args.debug) for rel, node in chunk)
+                else:
+                    body = json.dumps({"part": header, **tree_from_file_nodes(root_name, chunk)}, ensure_ascii=False, indent=None, separators=(',', ':'))
+                parts.append((body, tokens + header_tokens))
+        return parts
+
+    @staticmethod
+    def _part_header(text: bool, root_name: str, index: int, total: int, files: int, tokens: int) -> str:
+        if text:
+            return f"# Part {index}/{total}: {root_name} ({files} files, ~{tokens:,} tokens)\n\n"
+        return f"{index}/{total}"
+
+    def _collapse(self, root_node: Dict, dedup: Optional[bool], near_dup: Optional[float]):
+        args = self.args
+        dedup = not args.no_dedup if dedup is None else dedup
+        near_dup = args.near_dup if near_dup is None else near_dup
+        self.render_stats = {"dedup": None, "near_dup": None}
+
+        # 同一内容のファイルは2回目以降を参照 ("same_as") に置き換える
+        if dedup:
+            with PROFILER.phase("dedup"):
+                self.render_stats["dedup"] = dedupe_file_nodes(root_node)
+
+        # 類似ファイルは代表1件 + 差分 ("similar_to") にまとめる
+        if near_dup is not None:
+            with PROFILER.phase("near_dup"):
+                rendered_nodes = getattr(self, '_rendered_nodes', {})
+                node_sketches = {nid: self.file_sketches[p] for nid, p in rendered_nodes.items() if self.file_sketches.get(p)}
+                self.render_stats["near_dup"] = collapse_near_duplicates(root_node, node_sketches, near_dup)
+
+    def savings_note(self) -> str:
+        """直前の render() でまとめたファイルの節約トークン数 (例: " (dedup: 2 duplicate files, ~120 tokens saved)")"""
+        model = self.args.model
+        saved_notes = []
+        dedup_stats = self.render_stats.get("dedup")
+        near_dup_stats = self.render_stats.get("near_dup")
+        if dedup_stats and dedup_stats["files"]:
+            saved = count_tokens("\n".join(dedup_stats["previews"]), model)
+            saved_notes.append(f"dedup: {dedup_stats['files']} duplicate files, ~{saved:,} tokens saved")
+        if near_dup_stats and near_dup_stats["files"]:
+            saved = count_tokens("\n".join(near_dup_stats["previews"]), model) - count_tokens("\n".join(near_dup_stats["diffs"]), model)
+            saved_notes.append(f"near-dup: {near_dup_stats['files']} similar files, ~{saved:,} tokens saved")
+        if self.minify_stats:
+            saved = sum(before - after for before, after in self.minify_stats.values())
+            saved_notes.append(f"minify: {len(self.minify_stats)} files, ~{saved:,} tokens saved")
+        return f" ({'; '.join(saved_notes)})" if saved_notes else ""
+
+    # ---- 後始末 ----
+    def save(self):
+        """キャッシュ (成果物・DF) を保存する"""
+        if self.cache_dict:
+            self.artifact_cache.prune()
+            self.dir_manifest.prune()
+            save_cache(self.cache_root, self.cache_dict, self.args.debug)
+            log_debug("Cache saved successfully.", self.args.debug)
+
+    def close(self):
+        for source in self.sources.values():
+            source.close()
+        self.sources = {}
+        self.artifact_cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-    # --- [NEW] Global Vocab & TF-IDF Setup ---
-    global_vocab = build_global_vocab(root_path / args.vocab_file, args.debug)
-    
-    log_debug("Computing IDF for TF-IDF tagging...", args.debug)
-    all_summaries = []
-    for p in final_targets:
-        c = file_map.get(p, "")
-        if c:
-            all_summaries.append(extract_summary(c, p.suffix.lower(), False))
-    idf_dict = compute_idf(all_summaries)
+# ==========================================
+# 6. Tool Server (stdio JSON-RPC)
+# ==========================================
+# 1行1メッセージの JSON-RPC 2.0 (MCPの stdio トランスポートと同じ形式)。
+# initialize / tools/list / tools/call を受け付け、ツールの定義は JSON Schema で返す。
+SERVER_NAME = "sp-tree"
+SERVER_PROTOCOL_VERSION = "2024-11-05"
+PAGE_CACHE_SIZE = 32  # ページ送り用に保持しておく結果の件数
+
+_PAGE_PROPERTY = {"type": "integer", "minimum": 1, "description": "結果が長い場合のページ番号 (1始まり)。応答の next_page を指定して続きを取得する"}
+_PATH_PROPERTY = {"type": "string", "description": "ファイルパス (ルートからの相対パス。末尾一致でも可 例: 'auth/login.py')"}
+
+TOOL_DEFINITIONS = [
+    {
+        "name": "search",
+        "description": "自然言語クエリでプロジェクト内のファイル(要約+タグ)を検索し、関連度順のパスとスコアを返す。chunks=true なら関数/クラス単位で検索し、行範囲を返す。",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "query": {"type": "string", "description": "検索クエリ"},
+                "top_k": {"type": "integer", "minimum": 1, "description": "返す件数 (省略時は --top-k)"},
+                "chunks": {"type": "boolean", "description": "関数/クラス単位のチャンクで検索する"},
+                "page": _PAGE_PROPERTY,
+            },
+            "required": ["query"],
+        },
+    },
+    {
+        "name": "focus",
+        "description": "指定した関数名・クラス名を定義しているファイルを探し、その定義部分のコードを返す。'filename:keyword' 形式でファイルを絞り込める。",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "keyword": {"type": "string", "description": "関数名・クラス名 (例: 'login_user', 'app.py:main')"},
+                "resolve_deps": {"type": "boolean", "description": "依存ファイルも含める (要networkx)"},
+                "page": _PAGE_PROPERTY,
+            },
+            "required": ["keyword"],
+        },
+    },
+    {
+        "name": "grep",
+        "description": "正規表現に一致する行を、ファイルごとに前後の行 (行番号付き、一致行に '>' 印) とともに返す。",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "pattern": {"type": "string", "description": "正規表現 (Python の re 構文)"},
+                "ignore_case": {"type": "boolean", "description": "大文字小文字を区別しない"},
+                "page": _PAGE_PROPERTY,
+            },
+            "required": ["pattern"],
+        },
+    },
+    {
+        "name": "outline",
+        "description": "ファイルの関数やクラスのシグネチャ(アウトライン)を返す。",
+        "inputSchema": {
+            "type": "object",
+            "properties": {"path": _PATH_PROPERTY, "page": _PAGE_PROPERTY},
+            "required": ["path"],
+        },
+    },
+    {
+        "name": "summary",
+        "description": "ファイル冒頭の要約コメントとタグを返す。",
+        "inputSchema": {
+            "type": "object",
+            "properties": {"path": _PATH_PROPERTY},
+            "required": ["path"],
+        },
+    },
+    {
+        "name": "read_range",
+        "description": "ファイルの指定行範囲を行番号付きで返す。",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "path": _PATH_PROPERTY,
+                "start": {"type": "integer", "minimum": 1, "description": "開始行 (1始まり, 省略時: 1)"},
+                "end": {"type": "integer", "minimum": 1, "description": "終了行 (この行を含む, 省略時: 最終行)"},
+                "page": _PAGE_PROPERTY,
+            },
+            "required": ["path"],
+        },
+    },
+    {
+        "name": "tree",
+        "description": "プロジェクトのファイル構成をツリー形式で返す。path を指定するとそのディレクトリ配下のみ。",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "path": {"type": "string", "description": "起点のディレクトリ (ルートからの相対パス, 省略時: 全体)"},
+                "page": _PAGE_PROPERTY,
+            },
+            "required": [],
+        },
+    },
+    {
+        "name": "rescan",
+        "description": "ファイルの追加・変更を反映するため、プロジェクトを再走査する (変更のないファイルはキャッシュを使う)。",
+        "inputSchema": {"type": "object", "properties": {}, "required": []},
+    },
+]
+
+class ToolError(Exception):
+    """ツールの引数不正・対象なしなど、呼び出し側に返すエラー"""
+
+def split_pages(text: str, page_size: int) -> List[str]:
+    """行の途中で切らないように page_size 文字以内のページに分割する (1行が長すぎる場合のみ行内で切る)"""
+    if page_size <= 0 or len(text) <= page_size:
+        return [text]
+    pages, current, size = [], [], 0
+    for line in text.splitlines(keepends=True):
+        while len(line) > page_size:
+            if current:
+                pages.append("".join(current))
+                current, size = [], 0
+            pages.append(line[:page_size])
+            line = line[page_size:]
+        if size + len(line) > page_size and current:
+            pages.append("".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line)
+    if current:
+        pages.append("".join(current))
+    return pages
+
+class ToolServer:
+    """
+    ContextBuilder を保持したまま、標準入出力で JSON-RPC のツール呼び出しに応答する。
+    インデックス・キャッシュ・ONNXモデルは呼び出し間で使い回し、長い結果はページ単位で返す。
+    """
+
+    def __init__(self, builder: ContextBuilder, page_size: int = 20000):
+        self.builder = builder
+        self.page_size = page_size
+        self._pages: "OrderedDict[str, List[str]]" = OrderedDict()
+        self._tools = {
+            "search": self._search,
+            "focus": self._focus,
+            "grep": self._grep,
+            "outline": self._outline,
+            "summary": self._summary,
+            "read_range": self._read_range,
+            "tree": self._tree,
+            "rescan": self._rescan,
+        }
+
+    # ---- ツール ----
+    def _search(self, query: str, top_k: Optional[int] = None, chunks: bool = False) -> str:
+        hits = self.builder.search(query, top_k=top_k, chunks=chunks)
+        if not hits:
+            return "No related files found."
+        lines = []
+        for rank, hit in enumerate(hits, 1):
+            line = f"{rank}. {self.builder.display_path(hit['path'])} (score: {hit['score']:.3f})"
+            if "chunk" in hit:
+                chunk = hit["chunk"]
+                line += f" L{chunk['start']}-{chunk['end']} {chunk['name']}".rstrip()
+            else:
+                first = (self.builder.summaries.get(hit["path"]) or "").strip().splitlines()
+                if first:
+                    line += f" - {first[0]}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def _focus(self, keyword: str, resolve_deps: bool = False) -> str:
+        targets = self.builder.focus(keyword, resolve_deps)
+        if not targets:
+            return f"No definition found for: {keyword}"
+        root_node = self.builder.build_tree(targets, full=[], outline=False, summary_only=False, focus=keyword)
+        if not root_node:
+            return f"No definition found for: {keyword}"
+        return self.builder.render(root_node, text=True, near_dup=None)
+
+    def _grep(self, pattern: str, ignore_case: bool = False) -> str:
+        try:
+            hits = self.builder.grep(pattern, ignore_case=ignore_case)
+        except re.error as e:
+            raise ToolError(f"Invalid pattern: {e}")
+        if not hits:
+            return f"No match for: {pattern}"
+        root_node = self.builder.build_tree(set(hits), full=[], outline=False, summary_only=False, grep_hits=hits)
+        return self.builder.render(root_node, text=True, near_dup=None)
+
+    def _outline(self, path: str) -> str:
+        return self.builder.outline(path) or "(No outline: empty or unreadable file)"
+
+    def _summary(self, path: str) -> str:
+        return self.builder.summary(path)
+
+    def _read_range(self, path: str, start: int = 1, end: Optional[int] = None) -> str:
+        target = self.builder.resolve(path)
+        lines = self.builder.file_map.get(target, "").splitlines()
+        if not lines:
+            return "(empty or unreadable file)"
+        start = max(1, start)
+        end = len(lines) if end is None else min(end, len(lines))
+        if start > end:
+            raise ToolError(f"Invalid range: {start}-{end} (file has {len(lines)} lines)")
+        width = len(str(end))
+        body = "\n".join(f"{n:>{width}} | {lines[n - 1]}" for n in range(start, end + 1))
+        return f"// {self.builder.display_path(target)} L{start}-{end} / {len(lines)}\n{body}"
+
+    def _tree(self, path: Optional[str] = None) -> str:
+        prefix = (path or "").replace(os.sep, '/').strip('/')
+        root = {"name": prefix or self.builder.workspace_root.name, "children": []}
+        for rel in sorted(self.builder.display_path(p) for p in self.builder.files):
+            if prefix:
+                if not rel.startswith(prefix + '/'):
+                    continue
+                rel = rel[len(prefix) + 1:]
+            node = root
+            parts = rel.split('/')
+            for part in parts[:-1]:
+                child = next((c for c in node["children"] if c["name"] == part and "children" in c), None)
+                if child is None:
+                    child = {"name": part, "children": []}
+                    node["children"].append(child)
+                node = child
+            node["children"].append({"name": parts[-1]})
+        if not root["children"]:
+            raise ToolError(f"No files under: {path}")
+
+        def _sort(node):
+            node["children"].sort(key=lambda c: ("children" not in c, c["name"].lower()))
+            for child in node["children"]:
+                if "children" in child:
+                    _sort(child)
+        _sort(root)
+        lines = [f"{root['name']}/"]
+        for i, child in enumerate(root["children"]):
+            lines.extend(visual_tree_lines(child, "", i == len(root["children"]) - 1))
+        return "\n".join(lines)
+
+    def _rescan(self) -> str:
+        files = self.builder.scan()
+        self._pages.clear()
+        self.builder.save()
+        return f"Rescanned {len(files)} files."
+
+    # ---- JSON-RPC ----
+    def call_tool(self, name: str, arguments: Dict) -> Dict:
+        """ツールを実行し、結果の該当ページを返す。同じ引数の2ページ目以降は実行せずに保持済みの結果から返す"""
+        if name not in self._tools:
+            raise ToolError(f"Unknown tool: {name}")
+        arguments = dict(arguments or {})
+        page = arguments.pop("page", 1)
+        if not isinstance(page, int) or page < 1:
+            raise ToolError("page must be a positive integer")
+        cache_key = json.dumps([name, arguments], sort_keys=True, ensure_ascii=False)
+        pages = self._pages.get(cache_key)
+        if pages is None or page == 1:
+            try:
+                with PROFILER.phase(f"tool:{name}"):
+                    text = self._tools[name](**arguments)
+            except TypeError as e:
+                raise ToolError(f"Invalid arguments for {name}: {e}")
+            except KeyError as e:
+                raise ToolError(e.args[0] if e.args else str(e))
+            pages = split_pages(text, self.page_size)
+            self._pages[cache_key] = pages
+            while len(self._pages) > PAGE_CACHE_SIZE:
+                self._pages.popitem(last=False)
+        self._pages.move_to_end(cache_key)
+        if page > len(pages):
+            raise ToolError(f"page {page} is out of range (pages: {len(pages)})")
+        return {
+            "content": [{"type": "text", "text": pages[page - 1]}],
+            "page": page,
+            "pages": len(pages),
+            "next_page": page + 1 if page < len(pages) else None,
+        }
+
+    def handle(self, request: Dict) -> Optional[Dict]:
+        """1件のリクエストを処理して応答を返す (通知には応答しない)"""
+        req_id = request.get("id")
+        method = request.get("method")
+        params = request.get("params") or {}
+
+        def _error(code: int, message: str) -> Dict:
+            return {"jsonrpc": "2.0", "id": req_id, "error": {"code": code, "message": message}}
+
+        if not isinstance(method, str):
+            return _error(-32600, "Invalid Request")
+        if method == "initialize":
+            result = {
+                "protocolVersion": SERVER_PROTOCOL_VERSION,
+                "serverInfo": {"name": SERVER_NAME, "version": "1.0"},
+                "capabilities": {"tools": {}},
+            }
+        elif method == "ping":
+            result = {}
+        elif method == "tools/list":
+            result = {"tools": TOOL_DEFINITIONS}
+        elif method == "tools/call":
+            try:
+                result = self.call_tool(params.get("name"), params.get("arguments"))
+            except ToolError as e:
+                result = {"content": [{"type": "text", "text": str(e)}], "isError": True}
+            except Exception as e:
+                log_debug(f"Tool {params.get('name')} failed: {e}", self.builder.args.debug)
+                result = {"content": [{"type": "text", "text": f"Error: {e}"}], "isError": True}
+        elif req_id is None:
+            return None  # notifications/initialized などの通知は無視する
+        else:
+            return _error(-32601, f"Method not found: {method}")
+        if req_id is None:
+            return None
+        return {"jsonrpc": "2.0", "id": req_id, "result": result}
+
+    def serve(self, stdin=None, stdout=None):
+        """標準入力から1行ずつリクエストを読み、標準出力に1行ずつ応答を書く (EOFで終了)"""
+        stdin = stdin or sys.stdin
+        stdout = stdout or sys.stdout
+        for line in stdin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as e:
+                response = {"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": f"Parse error: {e}"}}
+            else:
+                if not isinstance(request, dict):
+                    response = {"jsonrpc": "2.0", "id": None, "error": {"code": -32600, "message": "Invalid Request"}}
+                else:
+                    response = self.handle(request)
+            if response is not None:
+                stdout.write(json.dumps(response, ensure_ascii=False) + "\n")
+                stdout.flush()
+
+def run_server(builder: ContextBuilder):
+    """CLI (--serve): 一度だけ走査してインデックスを温めた状態で常駐する"""
+    args = builder.args
+    builder.scan()
+    builder.save()
+    log_debug(f"Serving {len(builder.files)} files on stdio.", args.debug)
+    try:
+        ToolServer(builder, args.page_size).serve()
+    finally:
+        builder.save()
+
+def main():
+    args = parse_args()
+    if args.profile:
+        PROFILER.enabled = True
+        PROFILER.top_n = args.profile_top
+    builder = None
+    try:
+        try:
+            builder = ContextBuilder(args=args)
+        except (ValueError, OSError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return
+        if args.serve:
+            run_server(builder)
+        else:
+            run_dump(builder)
+    finally:
+        if builder is not None:
+            builder.close()
+        if args.profile:
+            PROFILER.emit(args.profile)
+
+def part_path(outfile: str, index: int, total: int) -> Path:
+    """分割出力のファイル名 (例: context.md -> context.part01.md)"""
+    path = Path(outfile)
+    return path.with_name(f"{path.stem}.part{index:0{max(2, len(str(total)))}d}{path.suffix}")
+
+def write_parts(builder: ContextBuilder, parts: List[Tuple[str, int]]):
+    """CLI (--split-tokens): 分割した各パートを連番ファイル / 1つずつクリップボード / 標準出力に出す"""
+    args = builder.args
+    total_tokens = sum(tokens for _, tokens in parts)
+    print(f"[Tokens: {total_tokens:,} in {len(parts)} parts of <= {args.split_tokens:,}]{builder.savings_note()}", file=sys.stderr)
+    for line in builder.minify_report():
+        print(line, file=sys.stderr)
+
+    if args.outfile:
+        for i, (part, _) in enumerate(parts, 1):
+            path = part_path(args.outfile, i, len(parts))
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(part)
+            print(f"Saved to {path}")
+
+    # キャッシュの保存 (ブロック単位のトークン数も含む)
+    builder.save()
+
+    if args.copy:
+        if HAS_PYPERCLIP:
+            # 1パートずつコピーし、貼り付けが済んだらEnterで次のパートに進む
+            for i, (part, tokens) in enumerate(parts, 1):
+                pyperclip.copy(part)
+                print(f">> Copied part {i}/{len(parts)} (~{tokens:,} tokens) to clipboard! <<", file=sys.stderr)
+                if i < len(parts):
+                    print("   Enter で次のパートをコピー (q で中止): ", end="", file=sys.stderr, flush=True)
+                    answer = sys.stdin.readline()
+                    if not answer or answer.strip().lower() == 'q':
+                        break
+        else:
+            print(">> [ERROR] クリップボードへのコピーに失敗しました。", file=sys.stderr)
+            print(">> 必要なライブラリが見つかりません: pip install pyperclip", file=sys.stderr)
+            print(">> 代わりに標準出力に表示します:\n", file=sys.stderr)
+            print("\n".join(part for part, _ in parts))
+    elif not args.outfile:
+        print("\n".join(part for part, _ in parts))
+
+def run_dump(builder: ContextBuilder):
+    """CLI: ContextBuilder の各段階を引数に従って順に呼び出し、結果を出力する"""
+    args = builder.args
+    builder.scan()
+    final_targets = builder.files
+
+    if args.focus:
+        final_targets = builder.focus(args.focus, args.resolve_deps)
 
     # 対象ファイルのタグを前もって生成・保持 (タグ検索とDry-run用)
-    file_tags_map = {}
-    for item in list(final_targets):
-        content = file_map.get(item, "")
-        summary_text = extract_summary(content, item.suffix.lower(), False)
-        tags = extract_tags(content, summary_text, item.suffix.lower(), args.debug, global_vocab, idf_dict)
-        file_tags_map[item] = tags
+    file_tags_map = builder.tags(final_targets)
 
     # --- [NEW] Strict Tag Filtering ---
     if args.tag:
@@ -1258,6 +5745,15 @@ def main():
         if not final_targets:
             print(">> 指定されたタグを持つファイルは見つかりませんでした。", file=sys.stderr)
 
+    # --- Grep (Regex) Logic ---
+    grep_hits: Dict[Path, List[int]] = {}
+    if args.grep:
+        grep_hits = builder.grep(args.grep, final_targets, args.grep_ignore_case)
+        final_targets = set(grep_hits)
+        log_debug(f"Grep '{args.grep}': {sum(len(v) for v in grep_hits.values())} lines in {len(grep_hits)} files", args.debug)
+        if not final_targets:
+            print(">> パターンに一致する行は見つかりませんでした。", file=sys.stderr)
+
     # --- [NEW] Dry-Run Mode ---
     if args.dry_run:
         print("\n" + "="*60)
@@ -1268,140 +5764,63 @@ def main():
         else:
             for item in sorted(final_targets):
                 tags_str = ", ".join(file_tags_map.get(item, []))
-                print(f"📄 {item.relative_to(root_path)} \n   └─ [Tags: {tags_str}]\n")
+                print(f"📄 {builder.display_path(item)} \n   └─ [Tags: {tags_str}]\n")
         print("="*60 + "\n")
         sys.exit(0)
 
     # --- BM25 Search Logic ---
+    chunk_hits: Dict[Path, List[Dict]] = {}
+    summary_only = getattr(args, 'summary_only', False)
     if args.search and final_targets:
-        log_debug(f"Starting BM25 search for query: '{args.search}'", args.debug)
-        
-        # 1. 検索対象のドキュメント（要約＋タグ）を準備
-        search_corpus = []
-        target_list = list(final_targets) # インデックスと同期させるためリスト化
-        
-        # 検索には必ず要約とタグが必要なため、一度キャッシュから引っ張るかパースする
-        # (ここでパースしたものはキャッシュに乗るため、後続のツリー構築ではHITする)
-        for item in target_list:
-            content = file_map[item]
-            item_str = str(item.resolve())
-            try:
-                current_mtime = os.path.getmtime(item)
-            except Exception:
-                current_mtime = 0
-            
-            # キャッシュから要約コンテンツを取得
-            cached_content = ""
-            if item_str in cache_dict and cache_dict[item_str].get("mtime") == current_mtime:
-                cached_content = cache_dict[item_str].get("cached_content", "")
-            else:
-                summary_text = extract_summary(content, item.suffix.lower(), False)
-                # 変更: vocabとidf辞書を渡してTF-IDF抽出を行う
-                tags = extract_tags(content, summary_text, item.suffix.lower(), False, global_vocab, idf_dict)
-                if tags:
-                    tag_str = ", ".join(tags)
-                    cached_content = f"{summary_text}\n\n[Tags: {tag_str}]"
-                else:
-                    cached_content = summary_text
-                
-                # ここでひっそりキャッシュを更新しておく
-                cache_dict[item_str] = {
-                    "mtime": current_mtime,
-                    "cached_content": cached_content
-                }
-            
-            # 変更: 全文検索フラグがONの場合は、ファイル本文もコーパスに結合する
-            if getattr(args, 'search_full', False):
-                search_corpus.append(f"{cached_content}\n\n{content}")
-            else:
-                search_corpus.append(cached_content)
-
-        # 2. 検索エンジンの初期化とスコアリング
-        if search_corpus:
-            bm25_scores = [0.0] * len(search_corpus)
-            onnx_scores = [0.0] * len(search_corpus)
-
-            # BM25スコアリング (キーワード一致)
-            bm25 = SimpleBM25(search_corpus)
-            bm25_scores = bm25.get_scores(args.search, args.debug)
-
-            # ONNXスコアリング (意味の一致)
-            onnx_scores = [0.0] * len(search_corpus)
-            if getattr(args, 'semantic_search', False):
-                if HAS_ONNX:
-                    ruri_model_dir = Path(__file__).resolve().parent / "ruri_30m_quantized"
-                    try:
-                        log_debug(f"Initializing ONNX engine from: {ruri_model_dir}", args.debug)
-                        onnx_engine = ONNXSemanticSearch(ruri_model_dir, args.debug)
-                        onnx_scores = onnx_engine.get_scores(args.search, search_corpus)
-                        if args.debug:
-                            print(f"[DEBUG ONNX] Max score: {max(onnx_scores) if onnx_scores else 0}", file=sys.stderr)
-                    except FileNotFoundError as e:
-                        print(f"[ERROR] {e}", file=sys.stderr)
-                        log_debug("Fallback to BM25 only due to missing ONNX model.", args.debug)
-                else:
-                    print("[WARNING] --semantic-search is enabled, but ONNX dependencies are missing. Falling back to BM25.", file=sys.stderr)
-                    log_debug("ONNX runtime dependencies are missing. Install with: pip install onnxruntime tokenizers numpy", args.debug)
-            else:
-                log_debug("Semantic search is DISABLED. Using BM25 only.", args.debug)
-
-            # 3. ハイブリッド・スコアリング (正規化と結合)
-            # BM25スコアを 0.0 ~ 1.0 に正規化
-            max_bm25 = max(bm25_scores) if bm25_scores and max(bm25_scores) > 0 else 1.0
-            norm_bm25 = [s / max_bm25 for s in bm25_scores]
-            
-            # ONNXスコアの負の値を丸める
-            norm_onnx = [max(0.0, s) for s in onnx_scores]
-
-            # セマンティック検索有効時は ONNXを7割、BM25を3割の重みでハイブリッド
-            if getattr(args, 'semantic_search', False) and HAS_ONNX:
-                combined_scores = [(0.3 * b) + (0.7 * o) for b, o in zip(norm_bm25, norm_onnx)]
-            else:
-                combined_scores = norm_bm25
-
-            # スコア付きでソート
-            scored_results = sorted(zip(target_list, combined_scores, bm25_scores, onnx_scores), key=lambda x: x[1], reverse=True)
-            
-            search_hits = set()
-            hit_count = 0
-            for file_path, c_score, b_score, o_score in scored_results:
-                # 足切りを撤廃し、関連性がある(0.0より大きい)上位 top_k 件を抽出
-                if c_score > 0.0:
-                    log_debug(f"Search HIT [Rank {hit_count+1}] [Combined: {c_score:.3f} | BM25: {b_score:.3f}, ONNX: {o_score:.3f}] - {file_path.name}", args.debug)
-                    search_hits.add(file_path)
-                    hit_count += 1
-                    
-                    if hit_count >= args.top_k:
-                        break
-            
-            if search_hits:
-                # 1. 検索でヒットした「目的のファイル」を全文出力リストに自動追加する
+        hits = builder.search(args.search, final_targets)
+        search_hits = set()
+        for hit in hits:
+            if "chunk" in hit:
+                chunk_hits.setdefault(hit["path"], []).append(hit["chunk"])
+            search_hits.add(hit["path"])
+
+        if search_hits:
+            # 1. 検索でヒットした「目的のファイル」を全文出力リストに自動追加する
+            #    (チャンク検索時は全文ではなく、ヒットしたチャンクのみを出力する)
+            if not chunk_hits:
                 args.full.extend([p.name for p in search_hits])
-                
-                # 2. ターゲットの絞り込みを解除し、プロジェクトの全ファイルを対象に残す
-                # final_targets = search_hits  <- この行を削除（またはコメントアウト）
-                
-                # 3. 目的以外のファイル（プロジェクト全体）は要約出力モードにする
-                args.summary_only = True 
-            else:
-                log_debug("No related files found for the query.", args.debug)
-                final_targets = set() # ヒットしなかった場合は空にする
+
+            # 2. ターゲットの絞り込みは解除し、プロジェクトの全ファイルを対象に残す
+            # 3. 目的以外のファイル（プロジェクト全体）は要約出力モードにする
+            summary_only = True
+        else:
+            log_debug("No related files found for the query.", args.debug)
+            final_targets = set() # ヒットしなかった場合は空にする
 
     # --- Smart Context Logic ---
     smart_deps = set()
     if getattr(args, 'smart_context', False) and HAS_NETWORKX and final_targets:
         log_debug("Resolving smart context (dependencies)...", args.debug)
-        G = build_dependency_graph(file_map, args.debug)
-        if G:
-            for p in list(final_targets):
-                if p in G:
-                    # 直接の依存先（importされているファイル）を取得
-                    for dep in G.successors(p):
-                        if dep not in final_targets:
-                            smart_deps.add(dep)
-            if smart_deps:
-                log_debug(f"Found {len(smart_deps)} dependency files for smart context.", args.debug)
-                final_targets.update(smart_deps)
+        smart_deps = builder.smart_dependencies(final_targets)
+        if smart_deps:
+            log_debug(f"Found {len(smart_deps)} dependency files for smart context.", args.debug)
+            final_targets.update(smart_deps)
+
+    # --- Delta Dump (Snapshot) Logic ---
+    since = None
+    snapshot_targets = set(final_targets)
+    if args.since:
+        try:
+            since = builder.changes_since(args.since, final_targets)
+        except KeyError as e:
+            print(f"Error: {e.args[0]}", file=sys.stderr)
+            return
+        final_targets = since.pop("targets")
+        smart_deps &= final_targets
+        log_debug(f"Changes since '{args.since}': {len(since['added'])} added, {len(since['modified'])} modified, {len(since['deleted'])} deleted", args.debug)
+        if not final_targets and not since["deleted"]:
+            print(f">> スナップショット '{args.since}' からの変更はありません。", file=sys.stderr)
+            if args.snapshot:
+                builder.snapshot(args.snapshot, snapshot_targets)
+                builder.save()
+            return
+    if args.snapshot:
+        builder.snapshot(args.snapshot, snapshot_targets)
 
     # --- Interactive Mode Logic ---
     file_output_modes = {}
@@ -1412,132 +5831,18 @@ def main():
         smart_deps = {p for p in smart_deps if file_output_modes.get(p) != 'x'}
 
     # Build Tree
-    def build_tree(current_path):
-        # 共通処理: ファイルノードの生成
-        def _create_file_node(item: Path):
-            content = file_map[item]
-            is_smart_dep = item in smart_deps
-            
-            # インタラクティブモードでのユーザー選択を取得（最優先）
-            interactive_mode = file_output_modes.get(item) if 'file_output_modes' in locals() or 'file_output_modes' in globals() else None
-            
-            # 各出力モードの判定
-            is_full = interactive_mode == 'f' or any(f in item.name for f in getattr(args, 'full', []))
-            is_outline = interactive_mode == 'o' or (not interactive_mode and getattr(args, 'outline', False)) or is_smart_dep
-            is_summary = interactive_mode == 's' or (not interactive_mode and getattr(args, 'summary_only', False))
-
-            if is_full:
-                pass # 全文出力モード（contentを書き換えずにそのままにする）
-                
-            elif is_outline and content:
-                outline_text = extract_outline(content, item.suffix.lower(), args.debug)
-                if is_smart_dep:
-                    content = f"// [Smart Context: Auto-resolved Dependency Outline]\n{outline_text}"
-                else:
-                    content = outline_text
-                
-            elif is_summary and content:
-                item_str = str(item.resolve())
-                try:
-                    current_mtime = os.path.getmtime(item)
-                except Exception:
-                    current_mtime = 0
-                
-                # キャッシュヒットチェック
-                if item_str in cache_dict and cache_dict[item_str].get("mtime") == current_mtime:
-                    log_debug(f"Cache HIT for: {item.name}", args.debug)
-                    content = cache_dict[item_str].get("cached_content", "")
-                else:
-                    log_debug(f"Cache MISS (or updated) for: {item.name}. Parsing...", args.debug)
-                    
-                    # 1. 要約の抽出
-                    summary_text = extract_summary(content, item.suffix.lower(), args.debug)
-                    if not summary_text:
-                        summary_text = "(No summary provided)"
-                    
-                    # 2. 構造タグと自然言語タグの両方を抽出
-                    tags = extract_tags(content, summary_text, item.suffix.lower(), args.debug, global_vocab, idf_dict)
-                
-                    # 3. コンテキストの結合とキャッシュ保存 (※エラーを防ぐため else ブロックの中に移動)
-                    if tags:
-                        tag_str = ", ".join(tags)
-                        content = f"{summary_text}\n\n[Tags: {tag_str}]"
-                    else:
-                        content = summary_text
-                        
-                    cache_dict[item_str] = {
-                        "mtime": current_mtime,
-                        "cached_content": content
-                    }
-                    
-            if args.focus:
-                extracted = None
-                if HAS_TREESITTER:
-                    extracted = extract_code_block_treesitter(content, item.suffix.lower(), args.focus)
-                if not extracted and item.suffix.lower() == '.py':
-                    extracted = extract_code_block_ast(content, args.focus)
-                if not extracted:
-                    extracted = extract_code_block_braces(content, args.focus)
-                if extracted:
-                    content = extracted
-            
-            if content:
-                lines = content.splitlines()[:args.preview_lines]
-                preview_text = "\n".join(lines)
-            else:
-                preview_text = ""
-            return {"name": item.name, "preview": preview_text}
-
-        # 1. パスが単一ファイルの場合の直接処理
-        if current_path.is_file():
-            if current_path in final_targets:
-                return _create_file_node(current_path)
-            return None
-
-        # 2. パスがディレクトリの場合の再帰処理
-        node = {"name": current_path.name}
-        if current_path.is_dir():
-            children = []
-            try:
-                items = sorted(current_path.iterdir(), key=lambda x: (not x.is_dir(), x.name.lower()))
-            except Exception:
-                items = [] # 権限エラー等でアクセスできないディレクトリはスキップ
-
-            for item in items:
-                try:
-                    if should_exclude(item.name, args.exclude):
-                        continue
-                    
-                    if item.is_dir():
-                        child = build_tree(item)
-                        # 子ディレクトリを追加する条件を緩和
-                        if child:
-                            if args.directories_only:
-                                children.append(child)
-                            elif child.get("children") or child.get("files_inside"):
-                                children.append(child)
-                                
-                    elif item in final_targets:
-                        children.append(_create_file_node(item))
-                except Exception as e:
-                    # 個別のファイル処理でエラーが起きても全体を止めないが、デバッグログには残す
-                    log_debug(f"Error processing {item.name}: {e}", args.debug)
-                    continue
-            
-            node["children"] = children
-            node["files_inside"] = len(children) > 0
-            
-            # 自身を返す条件を緩和
-            if args.directories_only:
-                return node
-            
-            return node if node["files_inside"] else None
-        
-        return None
+    root_node = builder.build_tree(final_targets, summary_only=summary_only, focus=args.focus,
+                                   chunk_hits=chunk_hits, smart_deps=smart_deps, output_modes=file_output_modes,
+                                   grep_hits=grep_hits)
+    if since is not None:
+        # 削除のみの場合もツリー差分は出力する
+        root_name = root_node["name"] if root_node else (builder.roots[0].name if len(builder.roots) == 1 else builder.workspace_root.name)
+        if root_node is None:
+            root_node = {"name": root_name, "children": [], "files_inside": False}
+        since_header = render_since_header(since, root_name)
+        if not args.text:
+            root_node = {"since": since, **root_node}
 
-
-    root_node = build_tree(root_path)
-    
     # Output
     if root_node:
         try:
@@ -1554,56 +5859,33 @@ def main():
                     print_visual_tree(child, prefix="", is_last=is_last)
                 
                 return # ツリー表示だけして終了
-            
-            if args.text:
-                log_debug("Generating Markdown text output...", args.debug)
-                def generate_text_from_tree(node, current_path=""):
-                    text_parts = []
-                    # ディレクトリの場合
-                    if "children" in node:
-                        for child in node["children"]:
-                            # 親パスと子要素の名前を結合して現在のパスを生成
-                            child_path = f"{current_path}/{child['name']}".strip('/') if current_path else child['name']
-                            text_parts.extend(generate_text_from_tree(child, child_path))
-                    # ファイル単体の場合
-                    else:
-                        file_path = current_path if current_path else node['name']
-                        if node.get("preview") is not None and node.get("preview") != "":
-                            ext = '.' + node['name'].split('.')[-1].lower() if '.' in node['name'] else ''
-                            lang = TREESITTER_EXT_MAP.get(ext, "")
-                            text_parts.append(f"### File: {file_path}\n```{lang}\n{node['preview']}\n```\n")
-                            log_debug(f"Added content for text output: {file_path}", args.debug)
-                        else:
-                            text_parts.append(f"### File: {file_path} (No content preview)\n")
-                            log_debug(f"Added file path only for text output: {file_path}", args.debug)
-                    return text_parts
-
-                text_lines = generate_text_from_tree(root_node)
-                output_str = "\n".join(text_lines)
-            else:
-                log_debug("Generating JSON output...", args.debug)
-                output_str = json.dumps(root_node, ensure_ascii=False, indent=None, separators=(',', ':'))
-            
+
+            if args.split_tokens:
+                parts = builder.render_parts(root_node, args.split_tokens)
+                if since is not None and args.text:
+                    parts[0] = (since_header + parts[0][0], parts[0][1] + count_tokens(since_header, args.model))
+                write_parts(builder, parts)
+                return
+
+            output_str = builder.render(root_node)
+            if since is not None and args.text:
+                output_str = since_header + output_str
+
             # Token Count
-            count = len(output_str) // 4
-            if HAS_TIKTOKEN:
-                try:
-                    count = len(tiktoken.encoding_for_model(args.model).encode(output_str))
-                    log_debug("Token count calculated via tiktoken.", args.debug)
-                except Exception as e:
-                    log_debug(f"Tiktoken encoding failed: {e}. Falling back to heuristic calculation.", args.debug)
-                    pass
-            print(f"[Tokens: {count:,}]", file=sys.stderr)
+            with PROFILER.phase("token_count"):
+                count = count_tokens(output_str, args.model, args.debug)
+                saved_note = builder.savings_note()
+            print(f"[Tokens: {count:,}]{saved_note}", file=sys.stderr)
+            for line in builder.minify_report():
+                print(line, file=sys.stderr)
 
             if args.outfile:
                 with open(args.outfile, 'w', encoding='utf-8') as f:
                     f.write(output_str)
                 print(f"Saved to {args.outfile}")
                 
-            # キャッシュの保存 (コピー処理などをスキップしないよう独立したif文にする)
-            if cache_dict:
-                save_cache(root_path if root_path.is_dir() else root_path.parent, cache_dict, args.debug)
-                log_debug("Cache saved successfully.", args.debug)
+            # キャッシュの保存 (コピー処理などをスキップしないよう独立した処理にする)
+            builder.save()
             
             # コピー指定がある場合の処理
             if args.copy:
@@ -0,0 +1,266 @@
+"""
+ContextBuilder (sp_tree_json_std_lib.py) の公開APIの振る舞いテスト。
+小さなフィクスチャのツリー (一時ディレクトリ) に対して scan / search / focus / grep /
+build_tree / render / snapshot / changes_since を呼び、結果を確かめる。
+"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sp_tree_json_std_lib import ContextBuilder  # noqa: E402
+
+FIXTURE = {
+    "src/auth/login.py": (
+        '"""Login handling: password hashing and user sessions."""\n'
+        "import hashlib\n"
+        "\n"
+        "\n"
+        "def hash_password(password):\n"
+        "    return hashlib.sha256(password.encode()).hexdigest()\n"
+        "\n"
+        "\n"
+        "def login_user(name, password):\n"
+        "    # compare the hashed password with the stored one\n"
+        "    return hash_password(password) == STORED.get(name)\n"
+        "\n"
+        "\n"
+        "STORED = {}\n"
+    ),
+    "src/db/store.py": (
+        '"""Key-value store used by the application."""\n'
+        "\n"
+        "\n"
+        "class Store:\n"
+        "    def get(self, key):\n"
+        "        # login_user is mentioned here only in a comment\n"
+        "        return None\n"
+    ),
+    "src/app.js": "// Entry point of the web app\nfunction main() {\n  return 1;\n}\n",
+    "README.md": "# Demo\nA tiny project used by the tests.\n",
+}
+
+
+def write_tree(root: Path, files):
+    for rel, content in files.items():
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content, encoding="utf-8")
+
+
+def file_nodes(node, prefix=""):
+    """build_tree() の結果から {表示パス: ファイルノード} を集める"""
+    found = {}
+    for child in node.get("children", []):
+        path = f"{prefix}{child['name']}"
+        if "children" in child:
+            found.update(file_nodes(child, path + "/"))
+        else:
+            found[path] = child
+    return found
+
+
+class ContextBuilderTestCase(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name).resolve() / "proj"
+        write_tree(self.root, FIXTURE)
+        self.builder = self.make_builder()
+
+    def tearDown(self):
+        self.builder.close()
+        self._tmp.cleanup()
+
+    def make_builder(self, paths=None, **options):
+        builder = ContextBuilder(paths or [self.root], **options)
+        builder.scan()
+        return builder
+
+    def display(self, paths):
+        return sorted(self.builder.display_path(p) for p in paths)
+
+
+class ScanTest(ContextBuilderTestCase):
+    def test_scan_returns_every_previewable_file(self):
+        self.assertEqual(self.display(self.builder.files), sorted(FIXTURE))
+
+    def test_scan_honours_exclude(self):
+        builder = self.make_builder(exclude=["db"])
+        try:
+            self.assertEqual(sorted(builder.display_path(p) for p in builder.files),
+                             ["README.md", "src/app.js", "src/auth/login.py"])
+        finally:
+            builder.close()
+
+    def test_summary_uses_the_module_docstring(self):
+        self.assertIn("Login handling", self.builder.summary("auth/login.py"))
+
+    def test_resolve_rejects_unknown_paths(self):
+        with self.assertRaises(KeyError):
+            self.builder.resolve("missing.py")
+
+
+class SearchTest(ContextBuilderTestCase):
+    def test_search_ranks_the_matching_file_first(self):
+        hits = self.builder.search("password hashing")
+        self.assertTrue(hits)
+        self.assertEqual(self.builder.display_path(hits[0]["path"]), "src/auth/login.py")
+        self.assertTrue(all(hit["score"] > 0 for hit in hits))
+
+    def test_search_respects_top_k(self):
+        self.assertLessEqual(len(self.builder.search("store app login", top_k=1)), 1)
+
+    def test_search_without_matches_is_empty(self):
+        self.assertEqual(self.builder.search("zzzqqq"), [])
+
+    def test_chunk_search_returns_the_defining_chunk(self):
+        hits = self.builder.search("hash_password hashlib sha256", chunks=True)
+        self.assertTrue(hits)
+        chunk = hits[0]["chunk"]
+        self.assertEqual(self.builder.display_path(hits[0]["path"]), "src/auth/login.py")
+        self.assertIn("hashlib", chunk["text"])
+        self.assertLessEqual(chunk["start"], chunk["end"])
+
+
+class FocusAndGrepTest(ContextBuilderTestCase):
+    def test_focus_finds_the_definition_not_a_comment(self):
+        self.assertEqual(self.display(self.builder.focus("login_user")), ["src/auth/login.py"])
+
+    def test_focus_with_path_filter(self):
+        self.assertEqual(self.display(self.builder.focus("db:Store")), ["src/db/store.py"])
+        self.assertEqual(self.builder.focus("auth:Store"), set())
+
+    def test_grep_returns_line_numbers(self):
+        hits = self.builder.grep(r"def \w+_password")
+        self.assertEqual({self.builder.display_path(p): lines for p, lines in hits.items()},
+                         {"src/auth/login.py": [5]})
+
+    def test_grep_ignore_case(self):
+        self.assertEqual(self.builder.grep("ENTRY POINT"), {})
+        self.assertEqual(self.display(self.builder.grep("ENTRY POINT", ignore_case=True)), ["src/app.js"])
+
+
+class BuildTreeAndRenderTest(ContextBuilderTestCase):
+    def test_build_tree_includes_only_targets(self):
+        targets = self.builder.focus("login_user")
+        root = self.builder.build_tree(targets, full=["*"])
+        self.assertEqual(sorted(file_nodes(root)), ["src/auth/login.py"])
+
+    def test_render_text_contains_file_headers_and_bodies(self):
+        text = self.builder.render(self.builder.build_tree(full=["*"]), text=True)
+        for rel in FIXTURE:
+            self.assertIn(f"### File: {rel}", text)
+        self.assertIn("def login_user(name, password):", text)
+
+    def test_render_json_round_trips(self):
+        data = json.loads(self.builder.render(self.builder.build_tree(full=["*"]), text=False))
+        self.assertEqual(sorted(file_nodes(data)), sorted(FIXTURE))
+
+    def test_summary_only_omits_bodies(self):
+        text = self.builder.render(self.builder.build_tree(full=[], summary_only=True), text=True)
+        self.assertIn("### File: src/auth/login.py", text)
+        self.assertNotIn("hashlib.sha256", text)
+
+    def test_focus_output_is_limited_to_the_definition(self):
+        targets = self.builder.focus("hash_password")
+        text = self.builder.render(self.builder.build_tree(targets, full=[], focus="hash_password"), text=True)
+        self.assertIn("def hash_password(password):", text)
+        self.assertNotIn("STORED = {}", text)
+
+
+class ChangesSinceTest(ContextBuilderTestCase):
+    def test_unknown_snapshot_raises_key_error(self):
+        with self.assertRaises(KeyError):
+            self.builder.changes_since("missing")
+
+    def test_no_changes(self):
+        self.builder.snapshot("base")
+        changes = self.builder.changes_since("base")
+        self.assertEqual((changes["added"], changes["modified"], changes["deleted"]), ([], [], []))
+        self.assertEqual(changes["targets"], set())
+
+    def test_added_modified_and_deleted_files(self):
+        self.builder.snapshot("base")
+        self.builder.save()
+        login = self.root / "src/auth/login.py"
+        stat = login.stat()
+        # 同じサイズ・ディレクトリの mtime はそのままで、中身だけをその場で書き換える
+        login.write_text(FIXTURE["src/auth/login.py"].replace("STORED = {}", "STORED = []"), encoding="utf-8")
+        os.utime(login, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        (self.root / "src/new.py").write_text("x = 1\n", encoding="utf-8")
+        (self.root / "README.md").unlink()
+
+        self.builder.scan()
+        changes = self.builder.changes_since("base")
+        self.assertEqual(changes["added"], ["src/new.py"])
+        self.assertEqual(changes["modified"], ["src/auth/login.py"])
+        self.assertEqual(changes["deleted"], ["README.md"])
+        self.assertEqual(self.display(changes["targets"]), ["src/auth/login.py", "src/new.py"])
+
+    def test_snapshot_survives_a_new_builder(self):
+        self.builder.snapshot("base")
+        self.builder.save()
+        self.builder.close()
+        self.builder = self.make_builder()
+        self.assertEqual(self.builder.changes_since("base")["modified"], [])
+
+    def test_excluded_files_are_not_reported_as_deleted(self):
+        self.builder.snapshot("base")
+        self.builder.save()
+        self.builder.close()
+        self.builder = self.make_builder(exclude=["db"])
+        self.assertEqual(self.builder.changes_since("base")["deleted"], [])
+
+
+class ArchiveChangesSinceTest(unittest.TestCase):
+    """仮想ソース (zip) 上の changes_since: 除外されただけのメンバを削除扱いにしない"""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.base = Path(self._tmp.name).resolve()
+        self.archive = self.base / "snapshot.zip"
+        self.write_archive({"a.py": "def a():\n    return 1\n", "lib/b.py": "def b():\n    return 2\n"})
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def write_archive(self, members):
+        with zipfile.ZipFile(self.archive, "w") as zf:
+            for name, content in members.items():
+                zf.writestr(name, content)
+
+    def changes(self, **options):
+        with ContextBuilder([self.archive], cache_dir=str(self.base), **options) as builder:
+            builder.scan()
+            return builder.changes_since("base")
+
+    def take_snapshot(self):
+        with ContextBuilder([self.archive], cache_dir=str(self.base)) as builder:
+            builder.scan()
+            self.assertEqual(sorted(builder.display_path(p) for p in builder.files), ["snapshot.zip/a.py", "snapshot.zip/lib/b.py"])
+            builder.snapshot("base")
+            builder.save()
+
+    def test_excluded_member_is_not_deleted(self):
+        self.take_snapshot()
+        self.assertEqual(self.changes(exclude=["lib"])["deleted"], [])
+
+    def test_removed_member_is_deleted(self):
+        self.take_snapshot()
+        self.write_archive({"a.py": "def a():\n    return 1\n"})
+        self.assertEqual(self.changes()["deleted"], ["snapshot.zip/lib/b.py"])
+
+    def test_modified_member(self):
+        self.take_snapshot()
+        self.write_archive({"a.py": "def a():\n    return 3\n", "lib/b.py": "def b():\n    return 2\n"})
+        changes = self.changes()
+        self.assertEqual((changes["modified"], changes["deleted"]), (["snapshot.zip/a.py"], []))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,194 @@
+"""
+ToolServer (--serve) の JSON-RPC の往復テスト。
+handle() / serve() にリクエストを渡し、応答の形・ツール呼び出しのページ送り・エラー応答を確かめる。
+"""
+import io
+import json
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sp_tree_json_std_lib import (  # noqa: E402
+    SERVER_PROTOCOL_VERSION, TOOL_DEFINITIONS, ContextBuilder, ToolServer,
+)
+
+LONG_FILE = "".join(f"line_{n} = {n}\n" for n in range(1, 201))
+
+
+class ToolServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        root = Path(self._tmp.name).resolve() / "proj"
+        (root / "src").mkdir(parents=True)
+        (root / "src/long.py").write_text(LONG_FILE, encoding="utf-8")
+        (root / "src/auth.py").write_text(
+            '"""Password hashing helpers."""\n\n\ndef hash_password(password):\n    return password[::-1]\n',
+            encoding="utf-8")
+        self.builder = ContextBuilder([root])
+        self.builder.scan()
+        self.server = ToolServer(self.builder, page_size=500)
+        self._next_id = 0
+
+    def tearDown(self):
+        self.builder.close()
+        self._tmp.cleanup()
+
+    def request(self, method, params=None, notify=False):
+        message = {"jsonrpc": "2.0", "method": method}
+        if params is not None:
+            message["params"] = params
+        if not notify:
+            self._next_id += 1
+            message["id"] = self._next_id
+        response = self.server.handle(message)
+        if response is not None:
+            self.assertEqual(response["jsonrpc"], "2.0")
+            self.assertEqual(response["id"], message.get("id"))
+        return response
+
+    def call(self, name, **arguments):
+        """tools/call を送り、result を返す"""
+        return self.request("tools/call", {"name": name, "arguments": arguments})["result"]
+
+    def assertToolError(self, result, fragment):
+        self.assertTrue(result.get("isError"))
+        self.assertIn(fragment, result["content"][0]["text"])
+
+
+class ProtocolTest(ToolServerTestCase):
+    def test_initialize(self):
+        result = self.request("initialize", {})["result"]
+        self.assertEqual(result["protocolVersion"], SERVER_PROTOCOL_VERSION)
+        self.assertIn("tools", result["capabilities"])
+
+    def test_ping(self):
+        self.assertEqual(self.request("ping")["result"], {})
+
+    def test_tools_list_matches_the_registered_tools(self):
+        tools = self.request("tools/list")["result"]["tools"]
+        self.assertEqual([t["name"] for t in tools], [t["name"] for t in TOOL_DEFINITIONS])
+        self.assertEqual(sorted(t["name"] for t in tools), sorted(self.server._tools))
+        for tool in tools:
+            self.assertEqual(tool["inputSchema"]["type"], "object")
+
+    def test_unknown_method_is_an_error(self):
+        error = self.request("resources/list")["error"]
+        self.assertEqual(error["code"], -32601)
+        self.assertIn("resources/list", error["message"])
+
+    def test_notifications_get_no_response(self):
+        self.assertIsNone(self.request("notifications/initialized", notify=True))
+        self.assertIsNone(self.request("ping", notify=True))
+
+    def test_missing_method_is_an_invalid_request(self):
+        response = self.server.handle({"jsonrpc": "2.0", "id": 7})
+        self.assertEqual(response["error"]["code"], -32600)
+        self.assertEqual(response["id"], 7)
+
+
+class ToolCallTest(ToolServerTestCase):
+    def test_search(self):
+        result = self.call("search", query="password hashing")
+        self.assertFalse(result.get("isError"))
+        self.assertTrue(result["content"][0]["text"].startswith("1. src/auth.py"))
+
+    def test_outline_and_summary(self):
+        self.assertIn("hash_password", self.call("outline", path="auth.py")["content"][0]["text"])
+        self.assertIn("Password hashing", self.call("summary", path="src/auth.py")["content"][0]["text"])
+
+    def test_read_range(self):
+        text = self.call("read_range", path="long.py", start=3, end=4)["content"][0]["text"]
+        self.assertEqual(text.splitlines(), ["// src/long.py L3-4 / 200", "3 | line_3 = 3", "4 | line_4 = 4"])
+
+    def test_unknown_tool(self):
+        self.assertToolError(self.call("delete_everything"), "Unknown tool")
+
+    def test_unexpected_argument(self):
+        self.assertToolError(self.call("summary", path="auth.py", verbose=True), "Invalid arguments for summary")
+
+    def test_missing_file(self):
+        self.assertToolError(self.call("summary", path="missing.py"), "File not found")
+
+    def test_invalid_grep_pattern(self):
+        self.assertToolError(self.call("grep", pattern="("), "Invalid pattern")
+
+    def test_invalid_range(self):
+        self.assertToolError(self.call("read_range", path="long.py", start=10, end=5), "Invalid range")
+
+
+class PagingTest(ToolServerTestCase):
+    def test_pages_cover_the_whole_result(self):
+        first = self.call("read_range", path="long.py")
+        self.assertGreater(first["pages"], 1)
+        self.assertEqual((first["page"], first["next_page"]), (1, 2))
+        texts = [first["content"][0]["text"]]
+        page = first
+        while page["next_page"] is not None:
+            page = self.call("read_range", path="long.py", page=page["next_page"])
+            self.assertLessEqual(len(page["content"][0]["text"]), self.server.page_size)
+            texts.append(page["content"][0]["text"])
+        self.assertEqual(page["page"], first["pages"])
+        full = self.server._read_range("long.py")
+        self.assertEqual("".join(texts), full)
+
+    def test_later_pages_are_served_from_the_kept_result(self):
+        self.call("read_range", path="long.py")
+        calls = []
+        original = self.server._tools["read_range"]
+        self.server._tools["read_range"] = lambda **kw: calls.append(kw) or original(**kw)
+        self.call("read_range", path="long.py", page=2)
+        self.assertEqual(calls, [])
+        # 1ページ目の要求は常に実行し直す
+        self.call("read_range", path="long.py", page=1)
+        self.assertEqual(len(calls), 1)
+
+    def test_page_out_of_range(self):
+        pages = self.call("read_range", path="long.py")["pages"]
+        self.assertToolError(self.call("read_range", path="long.py", page=pages + 1), "out of range")
+
+    def test_page_must_be_positive(self):
+        self.assertToolError(self.call("read_range", path="long.py", page=0), "positive integer")
+        self.assertToolError(self.call("read_range", path="long.py", page="2"), "positive integer")
+
+    def test_short_result_is_a_single_page(self):
+        result = self.call("summary", path="auth.py")
+        self.assertEqual((result["page"], result["pages"], result["next_page"]), (1, 1, None))
+
+
+class ServeTest(ToolServerTestCase):
+    def serve(self, *lines):
+        stdout = io.StringIO()
+        self.server.serve(io.StringIO("".join(line + "\n" for line in lines)), stdout)
+        return [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+    def test_round_trip_over_lines(self):
+        responses = self.serve(
+            json.dumps({"jsonrpc": "2.0", "id": 1, "method": "initialize", "params": {}}),
+            json.dumps({"jsonrpc": "2.0", "method": "notifications/initialized"}),
+            "",
+            json.dumps({"jsonrpc": "2.0", "id": 2, "method": "tools/call",
+                        "params": {"name": "summary", "arguments": {"path": "auth.py"}}}),
+        )
+        self.assertEqual([r["id"] for r in responses], [1, 2])
+        self.assertIn("Password hashing", responses[1]["result"]["content"][0]["text"])
+
+    def test_malformed_json_is_a_parse_error(self):
+        (response,) = self.serve('{"jsonrpc": "2.0", "id": 1, "method": ')
+        self.assertEqual(response["error"]["code"], -32700)
+        self.assertIsNone(response["id"])
+
+    def test_non_object_request_is_invalid(self):
+        responses = self.serve("[1, 2]", '"ping"')
+        self.assertEqual([r["error"]["code"] for r in responses], [-32600, -32600])
+
+    def test_processing_continues_after_an_error(self):
+        responses = self.serve("not json", json.dumps({"jsonrpc": "2.0", "id": 3, "method": "ping"}))
+        self.assertEqual(responses[0]["error"]["code"], -32700)
+        self.assertEqual(responses[1], {"jsonrpc": "2.0", "id": 3, "result": {}})
+
+
+if __name__ == "__main__":
+    unittest.main()